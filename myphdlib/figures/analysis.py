@@ -2,6 +2,7 @@ import numpy as np
 from myphdlib.interface.factory import SessionFactory
 from scipy.optimize import curve_fit as fitCurve
 import h5py
+import hashlib
 
 def g(x, a, mu, sigma, d):
     """
@@ -9,6 +10,190 @@ def g(x, a, mu, sigma, d):
 
     return a * np.exp(-((x - mu) / 4 / sigma) ** 2) + d
 
+def _splitGaussianMixturesParameters(params, k):
+    """
+    Split parameters (... x [d, A1-Ak, B1-Bk, C1-Ck]) into the offset and the components
+    """
+
+    params = np.asarray(params, dtype=float)
+    d = params[..., 0]
+    A = params[..., 1: 1 + k]
+    B = params[..., 1 + k: 1 + 2 * k]
+    C = params[..., 1 + 2 * k: 1 + 3 * k]
+
+    return d, A, B, C
+
+def evaluateGaussianMixtures(x, params, k):
+    """
+    Evaluate a mixture of k gaussians (a * exp(-((x - b) / 4 / c) ** 2) + d) for one or many parameter sets
+
+    keywords
+    --------
+    params
+        Parameters ordered as [d, A1-Ak, B1-Bk, C1-Ck] (P or N x P)
+
+    returns
+    -------
+    y
+        Model evaluated at x (N points or N sets x N points)
+    """
+
+    x = np.asarray(x, dtype=float)
+    d, A, B, C = _splitGaussianMixturesParameters(params, k)
+    u = (x[..., None, :] - B[..., :, None]) / 4 / C[..., :, None]
+    y = np.sum(A[..., :, None] * np.exp(-u ** 2), axis=-2) + d[..., None]
+
+    return y
+
+def differentiateGaussianMixtures(x, params, k):
+    """
+    Analytic jacobian of a mixture of k gaussians with respect to its parameters (N points x P or N sets x N points x P)
+    """
+
+    x = np.asarray(x, dtype=float)
+    d, A, B, C = _splitGaussianMixturesParameters(params, k)
+    u = (x[..., None, :] - B[..., :, None]) / 4 / C[..., :, None]
+    e = np.exp(-u ** 2)
+    aE = A[..., :, None] * e
+    J = np.concatenate([
+        np.ones([*d.shape, 1, x.size]),
+        e,
+        aE * u / 2 / C[..., :, None],
+        aE * 2 * u ** 2 / C[..., :, None],
+    ], axis=-2)
+
+    return np.swapaxes(J, -1, -2)
+
+def _solveBoundedStep(H, gradient, fixed, shift=None):
+    """
+    Solve the (damped) normal equations for the parameters which are not fixed
+
+    Fixed parameters move by shift (zero by default) and the free parameters
+    are solved for given that move
+    """
+
+    free = np.invert(fixed)
+    if shift is None:
+        shift = np.zeros(gradient.shape)
+    shift = shift * fixed
+    gradient = (gradient + np.einsum('nqr,nr->nq', H, shift)) * free
+    H = H * free[:, :, None] * free[:, None, :] + np.eye(H.shape[-1]) * fixed[:, None, :]
+    try:
+        step = np.linalg.solve(H, -gradient[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        step = np.stack([np.linalg.lstsq(h, -v, rcond=None)[0] for h, v in zip(H, gradient)])
+
+    return step + shift
+
+def fitGaussianMixtures(
+    x,
+    Y,
+    p0,
+    bounds,
+    k,
+    maxiter=200,
+    ftol=1e-10,
+    xtol=1e-10,
+    ):
+    """
+    Fit a mixture of k gaussians to many curves sampled at the same points at once
+
+    Every curve is fit with a projected Levenberg-Marquardt algorithm and all
+    curves take their steps together as stacked linear systems. Parameters
+    which sit at a bound (and are pushed against it by the gradient) are held
+    fixed for the step, and every step is projected back onto the bounds.
+
+    keywords
+    --------
+    Y
+        Curves (N points or N curves x N points)
+    p0
+        Initial parameters ([d, A1-Ak, B1-Bk, C1-Ck], shared or one set per curve)
+    bounds
+        Lower and upper bounds (2 x P, shared or N curves x 2 x P)
+
+    returns
+    -------
+    popt
+        Optimal parameters (P or N curves x P)
+    """
+
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    single = Y.ndim == 1
+    Y = np.atleast_2d(Y)
+    nCurves, nParams = Y.shape[0], 1 + 3 * k
+
+    #
+    bounds = np.asarray(bounds, dtype=float)
+    if bounds.ndim == 2:
+        bounds = np.broadcast_to(bounds, (nCurves, 2, nParams))
+    lower, upper = bounds[:, 0, :], bounds[:, 1, :]
+    p = np.clip(np.broadcast_to(np.asarray(p0, dtype=float), (nCurves, nParams)), lower, upper).copy()
+
+    #
+    def computeCost(p, rows):
+        r = evaluateGaussianMixtures(x, p, k) - Y[rows]
+        return 0.5 * np.sum(r ** 2, axis=1), r
+
+    cost, residuals = computeCost(p, np.arange(nCurves))
+    damping = np.full(nCurves, 1e-3)
+    active = np.isfinite(cost)
+    eye = np.eye(nParams)
+
+    #
+    for iteration in range(maxiter):
+        rows = np.where(active)[0]
+        if rows.size == 0:
+            break
+
+        # Normal equations
+        J = differentiateGaussianMixtures(x, p[rows], k)
+        g = np.einsum('npq,np->nq', J, residuals[rows])
+        H = np.einsum('npq,npr->nqr', J, J)
+
+        # Hold parameters at a bound fixed if the gradient points outside
+        fixed = np.logical_or(
+            np.logical_and(p[rows] <= lower[rows], g > 0),
+            np.logical_and(p[rows] >= upper[rows], g < 0)
+        )
+        fixed = np.logical_or(fixed, lower[rows] == upper[rows])
+
+        # Damped step (parameters which would leave the bounds are moved to the bound and the step is recomputed)
+        diagonal = np.maximum(np.diagonal(H, axis1=1, axis2=2), 1e-12)
+        Hd = H + damping[rows, None, None] * eye * diagonal[:, None, :]
+        step = _solveBoundedStep(Hd, g, fixed)
+        clipped = np.clip(p[rows] + step, lower[rows], upper[rows]) - p[rows]
+        outside = clipped != step
+        step = _solveBoundedStep(Hd, g, np.logical_or(fixed, outside), np.where(outside, clipped, 0))
+        candidate = np.clip(p[rows] + step, lower[rows], upper[rows])
+        costCandidate, residualsCandidate = computeCost(candidate, rows)
+
+        # Accept steps which decrease the cost
+        accepted = np.logical_and(np.isfinite(costCandidate), costCandidate < cost[rows])
+        improvement = np.where(accepted, cost[rows] - costCandidate, 0)
+        stepSize = np.max(np.abs(candidate - p[rows]), axis=1)
+        scale = np.max(np.abs(p[rows]), axis=1) + xtol
+        p[rows[accepted]] = candidate[accepted]
+        residuals[rows[accepted]] = residualsCandidate[accepted]
+        cost[rows[accepted]] = costCandidate[accepted]
+        damping[rows] = np.where(accepted, np.maximum(damping[rows] / 10, 1e-12), damping[rows] * 10)
+
+        # Check for convergence
+        converged = np.any([
+            np.logical_and(accepted, improvement <= ftol * cost[rows]),
+            np.logical_and(accepted, stepSize <= xtol * scale),
+            np.all(np.logical_or(g == 0, fixed), axis=1),
+            damping[rows] > 1e12,
+        ], axis=0)
+        active[rows[converged]] = False
+
+    #
+    if single:
+        return p[0]
+
+    return p
+
 class GaussianMixturesModel():
     """
     """
@@ -41,7 +226,8 @@ class GaussianMixturesModel():
             y,
             p0=p0,
             bounds=bounds,
-            maxfev=self._maxfev
+            maxfev=self._maxfev,
+            jac=self.jacobian
         )
 
         return
@@ -61,16 +247,13 @@ class GaussianMixturesModel():
     @property
     def f(self):
         def inner(x, d, *params):
-            if self.k == 1:
-                A, B, C = [params[0]], [params[1]], [params[2]]
-            else:
-                A, B, C = np.split(np.array(params), 3)
-            y = np.zeros(x.size)
-            for i in range(self.k):
-                a, b, c = A[i], B[i], C[i]
-                y += a * np.exp(-((x - b) / 4 / c) ** 2)
-            y += d
-            return y
+            return evaluateGaussianMixtures(x, np.concatenate([[d], params]), self.k)
+        return inner
+
+    @property
+    def jacobian(self):
+        def inner(x, d, *params):
+            return differentiateGaussianMixtures(x, np.concatenate([[d], params]), self.k)
         return inner
 
     @property
@@ -80,6 +263,283 @@ class GaussianMixturesModel():
     def k(self, value):
         self._k = value
 
+class UnitRegistry():
+    """
+    Hashed index of unit keys (date, animal, cluster) across sessions
+
+    Maps each unit key to its global index and to its session, and keeps a
+    structured array of the keys for vectorized set operations
+    """
+
+    def __init__(self, ukeys, sessions=None):
+        """
+        """
+
+        self._ukeys = ukeys
+        self._keys = self.toStructuredArray(ukeys)
+        self._indices = dict()
+        for iUnit, ukey in enumerate(self._keys.tolist()):
+            if ukey not in self._indices:
+                self._indices[ukey] = iUnit
+
+        #
+        self._sessions = dict()
+        if sessions is not None:
+            for session in sessions:
+                key = (str(session.date), session.animal)
+                if key not in self._sessions:
+                    self._sessions[key] = session
+
+        return
+
+    @staticmethod
+    def toStructuredArray(ukeys):
+        """
+        Convert a list of unit keys to a structured array
+        """
+
+        ukeys = list(ukeys)
+        nDateCharacters = max([len(str(ukey[0])) for ukey in ukeys], default=1)
+        nAnimalCharacters = max([len(str(ukey[1])) for ukey in ukeys], default=1)
+        dtype = [
+            ('date', f'U{nDateCharacters}'),
+            ('animal', f'U{nAnimalCharacters}'),
+            ('cluster', np.int64)
+        ]
+        keys = np.array(
+            [(str(date), str(animal), int(cluster)) for (date, animal, cluster) in ukeys],
+            dtype=dtype
+        )
+
+        return keys
+
+    @staticmethod
+    def fromFile(hdf):
+        """
+        Read the unit keys saved to an hdf file as a structured array
+        """
+
+        with h5py.File(hdf, 'r') as stream:
+            dates = np.char.decode(np.array(stream['ukeys/date']).ravel())
+            animals = np.char.decode(np.array(stream['ukeys/animal']).ravel())
+            clusters = np.array(stream['ukeys/cluster']).ravel().astype(np.int64)
+        keys = np.empty(dates.size, dtype=[
+            ('date', dates.dtype),
+            ('animal', animals.dtype),
+            ('cluster', np.int64)
+        ])
+        keys['date'] = dates
+        keys['animal'] = animals
+        keys['cluster'] = clusters
+
+        return keys
+
+    @staticmethod
+    def promote(*keys):
+        """
+        Cast structured arrays of unit keys to a common dtype
+
+        The width of each string field is the maximum across the arrays such
+        that no key is truncated (e.g., 'mlati10' cast to U6 would become
+        'mlati1')
+        """
+
+        fields = keys[0].dtype.names
+        dtype = [
+            (field, np.result_type(*[k.dtype[field] for k in keys]))
+                for field in fields
+        ]
+
+        return tuple([k.astype(dtype) for k in keys])
+
+    def index(self, ukey):
+        """
+        Return the global index of a unit (or None if the unit is not registered)
+        """
+
+        date, animal, cluster = ukey
+
+        return self._indices.get((str(date), str(animal), int(cluster)))
+
+    def session(self, date, animal):
+        """
+        Return the session for a date and animal (or None)
+        """
+
+        return self._sessions.get((str(date), animal))
+
+    def locate(self, ukey):
+        """
+        Return the session and the single unit object for a unit key
+        """
+
+        date, animal, cluster = ukey
+        session = self.session(date, animal)
+        if session is None:
+            return None, None
+
+        return session, session.population.indexByCluster(cluster)
+
+    def intersect(self, ukeys):
+        """
+        Return a mask which indicates which registered units are also in ukeys
+        """
+
+        if type(ukeys) != np.ndarray:
+            ukeys = self.toStructuredArray(ukeys)
+        if ukeys.size == 0 or self._keys.size == 0:
+            return np.full(self._keys.size, False)
+
+        reference, query = self.promote(self._keys, ukeys)
+
+        return np.isin(reference, query)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    @property
+    def ukeys(self):
+        return self._ukeys
+
+    def __len__(self):
+        return self._keys.size
+
+class FitResultCache():
+    """
+    Fit results keyed by a hash of the inputs of the fit and persisted to an hdf file
+
+    Entries are read from the file the first time the cache is queried and
+    new entries are appended to the file by flush. Every value stored under
+    the same path must have the same size.
+
+    Usage
+    -----
+    cache = FitResultCache(hdf)
+    key = cache.hash(peth, params1, maximumAmplitudeShift)
+    if key not in cache:
+        cache[key] = fit(peth)
+    cache.flush()
+    """
+
+    def __init__(self, hdf=None, path='cache/fits'):
+        """
+        """
+
+        self._hdf = hdf
+        self._path = path
+        self._entries = None
+        self._pending = dict()
+
+        return
+
+    @staticmethod
+    def hash(*args):
+        """
+        Return a digest of the shape and content of each argument
+        """
+
+        sha = hashlib.sha1()
+        for arg in args:
+            if type(arg) == str:
+                sha.update(arg.encode())
+                continue
+            value = np.ascontiguousarray(arg, dtype=np.float64)
+            sha.update(str(value.shape).encode())
+            sha.update(value)
+
+        return sha.hexdigest()
+
+    def _load(self):
+        """
+        """
+
+        self._entries = dict()
+        if self._hdf is None:
+            return
+        try:
+            stream = h5py.File(self._hdf, 'r')
+        except OSError:
+            return
+        with stream:
+            if f'{self._path}/keys' not in stream:
+                return
+            keys = np.char.decode(np.array(stream[f'{self._path}/keys']))
+            values = np.array(stream[f'{self._path}/values'])
+        for key, value in zip(keys, values):
+            self._entries[key] = value
+
+        return
+
+    def __contains__(self, key):
+        if self._entries is None:
+            self._load()
+        return key in self._entries
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self._entries[key].copy()
+
+    def __setitem__(self, key, value):
+        if key in self:
+            return
+        value = np.asarray(value, dtype=np.float64).ravel()
+        self._entries[key] = value
+        self._pending[key] = value
+        return
+
+    def __len__(self):
+        if self._entries is None:
+            self._load()
+        return len(self._entries)
+
+    def flush(self):
+        """
+        Append new entries to the hdf file
+        """
+
+        if self._hdf is None or len(self._pending) == 0:
+            return
+        keys = np.array(list(self._pending.keys()), dtype='S40')
+        values = np.vstack(list(self._pending.values()))
+
+        #
+        with h5py.File(self._hdf, 'a') as stream:
+
+            # Entries with a different size are discarded
+            if f'{self._path}/values' in stream:
+                if stream[f'{self._path}/values'].shape[1] != values.shape[1]:
+                    del stream[self._path]
+            if f'{self._path}/values' not in stream:
+                stream.create_dataset(f'{self._path}/keys', shape=(0,), maxshape=(None,), dtype='S40')
+                stream.create_dataset(f'{self._path}/values', shape=(0, values.shape[1]), maxshape=(None, values.shape[1]), dtype=np.float64)
+
+            #
+            n = stream[f'{self._path}/keys'].shape[0]
+            for path, data in zip(('keys', 'values'), (keys, values)):
+                ds = stream[f'{self._path}/{path}']
+                ds.resize(n + data.shape[0], axis=0)
+                ds[n:] = data
+
+        self._pending = dict()
+
+        return
+
+    def clear(self):
+        """
+        Remove every entry (from memory and from the hdf file)
+        """
+
+        self._entries = dict()
+        self._pending = dict()
+        if self._hdf is not None:
+            with h5py.File(self._hdf, 'a') as stream:
+                if self._path in stream:
+                    del stream[self._path]
+
+        return
+
 class AnalysisBase():
     """
     """
@@ -97,6 +557,8 @@ class AnalysisBase():
 
         self._ukeys = None
         self._ukey = None
+        self._registry = None
+        self._registryKeys = None
         if mount:
             self._factory = SessionFactory(mount=tag)
         else:
@@ -133,12 +595,8 @@ class AnalysisBase():
     @ukey.setter
     def ukey(self, value):
         date, animal, cluster = value
-        if self.session is None or str(self.session.date) != date:
-            self._session = None
-            for session in self.sessions:
-                if str(session.date) == date and session.animal == animal:
-                    self._session = session
-                    break
+        if self.session is None or str(self.session.date) != date or self.session.animal != animal:
+            self._session = self.registry.session(date, animal)
         self._unit = self.session.population.indexByCluster(cluster)
         self._ukey = value
         return
@@ -146,6 +604,20 @@ class AnalysisBase():
     @property
     def ukeys(self):
         return self._ukeys
+
+    @property
+    def registry(self):
+        """
+        Unit registry for the current list of unit keys (rebuilt if the list changes)
+        """
+
+        # NOTE: The snapshot holds the same key objects, so comparing it to the list is cheap
+        ukeys = self._ukeys if self._ukeys is not None else list()
+        if self._registry is None or self._registryKeys != ukeys:
+            self._registry = UnitRegistry(ukeys, self._sessions)
+            self._registryKeys = list(ukeys)
+
+        return self._registry
     
     @property
     def hdf(self):
@@ -156,12 +628,7 @@ class AnalysisBase():
         """
         """
 
-        iUnit = None
-        for i, (date, animal, cluster) in enumerate(self.ukeys):
-            if date == self.ukey[0] and animal == self.ukey[1] and cluster == self.ukey[2]:
-                iUnit = i
-                break
-
+        iUnit = self.registry.index(self.ukey)
         if iUnit is None:
             raise Exception('Could not determine unit index')
 
@@ -186,14 +653,7 @@ class AnalysisBase():
         """
 
         if self.hdf is not None:
-            with h5py.File(self.hdf, 'r') as stream:
-                dates = np.array(stream['ukeys/date'])
-                animals = np.array(stream['ukeys/animal'])
-                clusters = np.array(stream['ukeys/cluster'])
-            self._ukeys = [
-                (date.item().decode(), animal.item().decode(), int(cluster.item().decode())) for (date, animal, cluster)
-                    in zip(dates, animals, clusters)
-            ]
+            self._ukeys = UnitRegistry.fromFile(self.hdf).tolist()
             return
 
         kwargs = {
@@ -271,14 +731,7 @@ class AnalysisBase():
         """
         """
 
-        date, animal, cluster = ukey
-        unitIndex = None
-        for iUnit, (d, a, c) in enumerate(self.ukeys):
-            if d == date and a == animal and c == cluster:
-                unitIndex = iUnit
-                break
-
-        return unitIndex
+        return self.registry.index(ukey)
 
     def _intersectUnitKeys(
         self,
@@ -287,21 +740,15 @@ class AnalysisBase():
         """
         """
 
-        with h5py.File(self.hdf, 'r') as stream:
-            dates = np.array(stream['ukeys/date'])
-            animals = np.array(stream['ukeys/animal'])
-            clusters = np.array(stream['ukeys/cluster'])
-        referenceUnitKeys = [
-            (date.item().decode(), animal.item().decode(), int(cluster.item().decode())) for (date, animal, cluster)
-                in zip(dates, animals, clusters)
-        ]
-
-
-        #
-        mask = np.full(len(referenceUnitKeys), False)
-        for i, ukey in enumerate(referenceUnitKeys):
-            if ukey in ukeys:
-                mask[i] = True
+        referenceUnitKeys = UnitRegistry.fromFile(self.hdf)
+        if ukeys is self.ukeys:
+            queryUnitKeys = self.registry.keys
+        else:
+            queryUnitKeys = UnitRegistry.toStructuredArray(ukeys)
+        if referenceUnitKeys.size == 0 or queryUnitKeys.size == 0:
+            return np.full(referenceUnitKeys.size, False)
+        referenceUnitKeys, queryUnitKeys = UnitRegistry.promote(referenceUnitKeys, queryUnitKeys)
+        mask = np.isin(referenceUnitKeys, queryUnitKeys)
 
         return mask
 
@@ -310,7 +757,8 @@ class AnalysisBase():
         hdf,
         path,
         dataset,
-        nUnitsPerChunk=100
+        nUnitsPerChunk=100,
+        metadata=None,
         ):
         """
         """
@@ -338,15 +786,19 @@ class AnalysisBase():
                 # iUnit1 - Unit index for filtered units
                 # iUnit2 - Unit index for unfiltered units
                 # iUnit3 - Unit index for target unit within data chunk
-                for iUnit1, iUnit2 in enumerate(np.where(mask)[0]):
-                    indices = np.where(np.arange(start, stop) == iUnit2)[0]
-                    if len(indices) == 1:
-                        iUnit3 = indices.item()
-                    else:
-                        continue
+                iUnit2 = np.where(mask)[0]
+                withinChunk = np.logical_and(iUnit2 >= start, iUnit2 < stop)
+                iUnit1 = np.where(withinChunk)[0]
+                iUnit3 = iUnit2[withinChunk] - start
+                if iUnit1.size != 0:
                     data[iUnit3] = dataset[iUnit1]
                 ds[start: stop, :, :] = data
 
+            #
+            if metadata is not None:
+                for key, value in metadata.items():
+                    ds.attrs[key] = value
+
         return
     
     def _initializeStore(
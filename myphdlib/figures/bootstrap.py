@@ -1,16 +1,48 @@
+import os
 import h5py
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.signal import find_peaks as findPeaks
 from matplotlib.colors import LinearSegmentedColormap
-from myphdlib.general.toolkit import psth2
-from myphdlib.figures.modulation import BasicSaccadicModulationAnalysis
-from myphdlib.figures.analysis import GaussianMixturesModel
+from myphdlib.general.toolkit import psth2, binRelativeTimestamps, kde2
+from myphdlib.figures.modulation import BasicSaccadicModulationAnalysis, fitPerisaccadicPeth
+from myphdlib.figures.analysis import GaussianMixturesModel, UnitRegistry
 import seaborn as sns
 import pandas as pd
 from itertools import product
 from scipy.stats import spearmanr
+import hashlib
 from multiprocessing import Pool
+from contextlib import nullcontext
+
+def _generateNullSampleForUnit(job):
+    """
+    Refit every resampled PETH of a single unit
+
+    Workers only receive the inputs for the unit (the resampled PETHs
+    (N bins x N runs), the extra-saccadic fit parameters, the time bins,
+    and the amplitude bounds)
+    """
+
+    iUnit, peths, params1, tProbe, nComponents, maximumAmplitudeShift = job
+    nRuns = peths.shape[1]
+    sample = np.full([nRuns, nComponents], np.nan)
+
+    # Every run is refit at once
+    runMask = np.invert(np.isnan(peths).all(0))
+    if runMask.sum() == 0:
+        return iUnit, sample
+    dr, params2 = fitPerisaccadicPeth(
+        peths[:, runMask].T,
+        params1,
+        tProbe,
+        nComponents,
+        maximumAmplitudeShift=maximumAmplitudeShift
+    )
+    if dr is not None:
+        sample[runMask, :] = dr
+
+    return iUnit, sample
 
 class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
     """
@@ -50,6 +82,9 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
         }
         self.tProbe = None
 
+        # Seed used to draw the trials for the resampled PETHs
+        self.seed = None
+
         # Example neurons
         self.examples = (
             ('2023-07-12', 'mlati9', 710),
@@ -93,6 +128,7 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
             path='bootstrap/peths',
             dataset=self.peths['resampled'],
             nUnitsPerChunk=nUnitsPerChunk,
+            metadata=None if self.seed is None else {'seed': self.seed},
         )
 
         #
@@ -145,6 +181,8 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
             ds = stream['clustering/peths/standard']
             if 't' in ds.attrs.keys():
                 self.tProbe = np.array(ds.attrs['t'])
+            if 'bootstrap/peths' in stream and 'seed' in stream['bootstrap/peths'].attrs.keys():
+                self.seed = int(stream['bootstrap/peths'].attrs['seed'])
 
         return
 
@@ -157,10 +195,26 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
         buffer=1,
         rate=None,
         minimumTrialCount=1,
+        seed=None,
         ):
         """
+        Resample the extra-saccadic PETH of each unit
+
+        The trials are drawn with a random number generator seeded with seed.
+        If seed is None the last seed (e.g., loaded from the namespace) is
+        reused, or a new one is generated, such that re-running the analysis
+        reproduces the same resampled PETHs (and null samples).
         """
 
+        #
+        if seed is None:
+            seed = self.seed
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.seed = seed
+        generator = np.random.default_rng(seed)
+
+        #
         t, nTrials, nBins = psth2(
             np.zeros(1),
             np.zeros(1),
@@ -223,60 +277,54 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
                 returnTimestamps=True
             )
 
-            #
+            # Draw the trials for each run (N runs x N trials selection matrix)
+            selection = np.zeros([nRuns, trialIndicesExtrasaccadic.size])
             for iRun in range(nRuns):
-
-                # Use kernel density estimation (takes a long time)
-                trialIndices = np.random.choice(
+                trialIndices = generator.choice(
                     np.arange(trialIndicesExtrasaccadic.size),
                     size=nTrialsForResampling,
                     replace=False
                 )
+                selection[iRun, trialIndices] = 1
+
+            # Use KDE (all runs are estimated at once)
+            H = binRelativeTimestamps(spikeTimestamps, responseWindowBuffered)
+            tKde = np.around(np.arange(responseWindow[0], responseWindow[1], binsize) + (binsize / 2), 3)
+            fr = kde2(
+                H,
+                responseWindowBuffered,
+                tKde,
+                sigma=smoothingKernelWidth,
+                weights=selection,
+                nTrials=nTrialsForResampling
+            )
 
-                # Use raw PSTH
-                # sample = list()
-                # for iTrial in trialIndices:
-                #     for ts in spikeTimestamps[iTrial]:
-                #         sample.append(ts)
-                # sample = np.array(sample)
-
-                # Use KDE
-                sample = np.concatenate([spikeTimestamps[i] for i in trialIndices])
-                try:
-                    t, fr = self.unit.kde(
-                        probeTimestamps[trialIndices],
-                        responseWindow=responseWindow,
-                        binsize=binsize,
-                        sigma=smoothingKernelWidth,
-                        sample=sample,
-                        nTrials=nTrialsForResampling,
-                    )
-                except:
-                    continue
+            # Runs with too few spikes are skipped
+            nSpikes = selection @ H.sum(1)
+            fr[nSpikes < 3, :] = np.nan
 
-                # Standardize PSTH
-                self.peths['resampled'][iUnit, :, iRun] = (fr - mu) / sigma
+            # Standardize PSTH
+            self.peths['resampled'][iUnit, :, :] = ((fr - mu) / sigma).T
 
         return
     
     def _generateNullSample(
         self,
         iUnit,
+        maximumAmplitudeShift=100,
         ):
         """
         """
 
-        ukey = self.ukeys[iUnit]
-        peths = self.peths['resampled'][iUnit]
-        nRuns = peths.shape[0]
-        sample = np.full(nRuns, np.nan)
-        for iRun in range(nRuns):
-            peth = peths[iRun]
-            dr, params2 = super()._fitPerisaccadicPeth(
-                ukey,
-                peth=peth
-            )
-            sample[iRun] = dr
+        nComponents = int(np.nanmax(self.model['k']))
+        iUnit, sample = _generateNullSampleForUnit((
+            iUnit,
+            self.peths['resampled'][iUnit],
+            self.model['params1'][iUnit],
+            self.tProbe,
+            nComponents,
+            maximumAmplitudeShift,
+        ))
 
         return sample
 
@@ -286,8 +334,20 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
         useFilter=True,
         parallelize=True,
         key='real',
+        nWorkers=None,
+        chunksize=1,
+        restart=False,
+        maximumAmplitudeShift=100,
         ):
         """
+        Generate the null distribution of amplitude changes for each unit
+
+        Units are dispatched to the workers in chunks of chunksize and each
+        unit's sample is written to scratch/null/<key>/samples (if the
+        namespace and its unit keys exist) as soon as it is complete (units which are done are flagged in
+        scratch/null/<key>/complete).
+        An interrupted run resumes with the units which are not done yet
+        unless restart is True.
         """
 
         #
@@ -298,41 +358,93 @@ class BoostrappedSaccadicModulationAnalysis(BasicSaccadicModulationAnalysis):
         samples = np.full([nUnits, nRuns, nComponents], np.nan)
 
         #
-        if parallelize:
-            with Pool(None) as pool:
-                samples_ = pool.map(
-                    self._generateNullSample,
-                    np.arange(len(self.ukeys))
-                )
-            samples = np.array(samples_)
+        unitIndices = np.arange(nUnits)
+        if useFilter:
+            unitIndices = unitIndices[self.filter[unitIndices].astype(bool)]
+
+        # Progress is only saved if the namespace (and its unit keys) exists
+        checkpoint = False
+        if self.hdf is not None and os.path.exists(self.hdf):
+            with h5py.File(self.hdf, 'r') as stream:
+                checkpoint = 'ukeys' in stream
+
+        # Map each unit to its row in the namespace
+        samplesPath, completePath = f'scratch/null/{key}/samples', f'scratch/null/{key}/complete'
+        rowIndices = np.full(nUnits, -1)
+        if checkpoint:
+            registry = UnitRegistry(UnitRegistry.fromFile(self.hdf).tolist())
+            for iUnit, ukey in enumerate(self.ukeys):
+                iRow = registry.index(ukey)
+                rowIndices[iUnit] = -1 if iRow is None else iRow
+            nRows = len(registry)
+
+        # Inputs are hashed such that saved samples are only reused for the same inputs
+        sha = hashlib.sha1(np.ascontiguousarray(self.peths['resampled'][:, :, :nRuns], dtype=np.float64))
+        sha.update(np.ascontiguousarray(self.model['params1'], dtype=np.float64))
+        sha.update(np.ascontiguousarray(self.tProbe, dtype=np.float64))
+        sha.update(f'{maximumAmplitudeShift}'.encode())
+        checksum = sha.hexdigest()
 
         #
-        else:
-            for iUnit in range(nUnits):
-
-                #
-                if useFilter and self.filter[iUnit] == False:
-                    continue
-
-                #
-                self.ukey = self.ukeys[iUnit]
-                end = '\r' if iUnit + 1 != nUnits else None
-                print(f'Generating null samples for unit {iUnit + 1} out of {nUnits}', end=end)
+        with h5py.File(self.hdf, 'a') if checkpoint else nullcontext() as stream:
+
+            # Resume from the samples already saved to the namespace
+            if stream is not None:
+                shape = (nRows, nRuns, nComponents)
+                resume = all([
+                    restart == False,
+                    completePath in stream,
+                    samplesPath in stream,
+                ])
+                if resume:
+                    resume = stream[completePath].attrs.get('checksum') == checksum and stream[samplesPath].shape == shape
+                if resume:
+                    complete = np.array(stream[completePath])
+                else:
+                    for path in (samplesPath, completePath):
+                        if path in stream:
+                            del stream[path]
+                    stream.create_dataset(samplesPath, shape=shape, dtype=np.float64, fillvalue=np.nan)
+                    ds = stream.create_dataset(completePath, shape=(nRows,), dtype=bool, fillvalue=False)
+                    ds.attrs['checksum'] = checksum
+                    complete = np.full(nRows, False)
 
                 #
-                sample = np.full([nRuns, nComponents], np.nan)
-                for iRun in range(nRuns):
-                    peth = self.peths['resampled'][iUnit, :, iRun]
-                    if np.isnan(peth).all():
-                        continue
-                    dr, params2 = super()._fitPerisaccadicPeth(
-                        self.ukey,
-                        peth=peth
-                    )
-                    sample[iRun, :] = dr
+                done = np.array([rowIndices[iUnit] != -1 and complete[rowIndices[iUnit]] for iUnit in unitIndices], dtype=bool)
+                for iUnit in unitIndices[done]:
+                    samples[iUnit] = np.array(stream[samplesPath][rowIndices[iUnit]])
+                if done.sum() != 0:
+                    print(f'Resuming null sample generation ({done.sum()} out of {unitIndices.size} units already done)')
+                unitIndices = unitIndices[np.invert(done)]
 
-                #
-                samples[iUnit, :, :] = sample
+            #
+            jobs = (
+                (
+                    iUnit,
+                    self.peths['resampled'][iUnit, :, :nRuns],
+                    self.model['params1'][iUnit],
+                    self.tProbe,
+                    nComponents,
+                    maximumAmplitudeShift,
+                )
+                    for iUnit in unitIndices
+            )
+            with Pool(nWorkers) if parallelize else nullcontext() as pool:
+                if parallelize:
+                    results = pool.imap_unordered(_generateNullSampleForUnit, jobs, chunksize=chunksize)
+                else:
+                    results = map(_generateNullSampleForUnit, jobs)
+                for count, (iUnit, sample) in enumerate(results):
+                    end = '\r' if count + 1 != unitIndices.size else None
+                    print(f'Generating null samples for unit {count + 1} out of {unitIndices.size}', end=end)
+                    samples[iUnit] = sample
+
+                    # Save progress
+                    iRow = rowIndices[iUnit]
+                    if stream is not None and iRow != -1:
+                        stream[samplesPath][iRow] = sample
+                        stream[completePath][iRow] = True
+                        stream.flush()
 
         #
         self.samples[key] = samples
@@ -94,6 +94,7 @@ class FictiveSaccadesAnalysis(
             'fictive': None,
         }
         self.filter = None
+        self.seed = None
 
         #
         self.windows = np.array([
@@ -151,6 +152,8 @@ class FictiveSaccadesAnalysis(
                         self.tProbe = ds.attrs['t']
                     if path == 'fictive/templates/nasal':
                         self.tSaccade = ds.attrs['t']
+                    if path == 'fictive/peths/resampled' and 'seed' in ds.attrs.keys():
+                        self.seed = int(ds.attrs['seed'])
                     value = np.array(ds)
                     if 'filter' in parts:
                         value = value.astype(bool)
@@ -240,6 +243,7 @@ class FictiveSaccadesAnalysis(
                 path='fictive/peths/resampled',
                 dataset=self.peths['resampled'],
                 nUnitsPerChunk=nUnitsPerChunk,
+                metadata=None if self.seed is None else {'seed': self.seed},
             )
 
         #
@@ -499,11 +503,12 @@ class FictiveSaccadesAnalysis(
     def fitPerisaccadicPeths(
         self,
         maximumAmplitudeShift=200,
-        key='fictive'
+        key='fictive',
+        useCache=True,
         ):
         """
         """
-        super().fitPerisaccadicPeths(maximumAmplitudeShift, key)
+        super().fitPerisaccadicPeths(maximumAmplitudeShift, key, useCache)
         return
 
     def downsampleExtrasaccadicPeths(
@@ -529,10 +534,23 @@ class FictiveSaccadesAnalysis(
         useFilter=True,
         parallelize=True,
         key='fictive',
+        nWorkers=None,
+        chunksize=1,
+        restart=False,
+        maximumAmplitudeShift=100,
         ):
         """
         """
-        super().generateNullSamples(nRuns, useFilter, parallelize, key)
+        super().generateNullSamples(
+            nRuns,
+            useFilter,
+            parallelize,
+            key,
+            nWorkers=nWorkers,
+            chunksize=chunksize,
+            restart=restart,
+            maximumAmplitudeShift=maximumAmplitudeShift
+        )
         return
 
     def computeProbabilityValues(
@@ -3,7 +3,91 @@ import numpy as np
 from scipy.signal import find_peaks as findPeaks
 from matplotlib import pylab as plt
 from myphdlib.general.toolkit import psth2
-from myphdlib.figures.analysis import AnalysisBase, GaussianMixturesModel, g
+from myphdlib.figures.analysis import AnalysisBase, GaussianMixturesModel, FitResultCache, g, fitGaussianMixtures
+
+# Version of the peri-saccadic fit (bump when the solver or its output changes to invalidate cached fits)
+FIT_VERSION = 'fitPerisaccadicPeth-2'
+
+def fitPerisaccadicPeth(
+    peth,
+    params1,
+    tProbe,
+    nComponents,
+    maximumAmplitudeShift=100,
+    ):
+    """
+    Refit the extra-saccadic GMM (params1) to a peri-saccadic PETH, freeing the amplitude of one component at a time
+
+    Only depends on its arguments such that it can be called from worker
+    processes. Many PETHs (N PETHs x N bins) which share params1 can be
+    refit at once. Each refit is initialized with the solution of the
+    previous one.
+
+    returns
+    -------
+    dr
+        Change in the amplitude of each component (or N PETHs x N components)
+    params2
+        Parameters of the refit (only the first component is stored)
+    """
+
+    #
+    if np.isnan(params1).all():
+        return None, None
+    abcd = params1[np.invert(np.isnan(params1))]
+    abc, d = abcd[:-1], abcd[-1]
+    A1, B1, C1 = np.split(abc, 3)
+    order = np.arange(A1.size) # NOTE: This is unnecessary, but I left it
+    k = A1.size
+
+    #
+    peths = np.atleast_2d(peth)
+    nPeths = peths.shape[0]
+    valid = np.invert(np.isnan(peths).any(1))
+    d = np.full(nPeths, d)
+    dr = np.full([nPeths, nComponents], np.nan)
+
+    #
+    nParams = params1.size
+    params2 = np.full([nPeths, nComponents, nParams], np.nan)
+    p0 = np.hstack([
+        d[:, None],
+        np.tile(np.concatenate([A1, B1, C1]), (nPeths, 1))
+    ])
+    for i, iComp in enumerate(order):
+
+        # Refit
+        amplitudeBoundaries = np.vstack([A1 - 0.001, A1 + 0.001]).T
+        amplitudeBoundaries[iComp, 0] -= maximumAmplitudeShift
+        amplitudeBoundaries[iComp, 1] += maximumAmplitudeShift
+        bounds = np.stack([
+            np.vstack([
+                [[d_ - 0.001, d_ + 0.001]],
+                amplitudeBoundaries,
+                np.vstack([B1 - 0.001, B1 + 0.001]).T,
+                np.vstack([C1 - 0.001, C1 + 0.001]).T,
+            ]).T
+                for d_ in d
+        ])
+        popt = np.full([nPeths, 1 + 3 * k], np.nan)
+        popt[valid] = fitGaussianMixtures(tProbe, peths[valid], p0[valid], bounds[valid], k)
+
+        # Warm-start the next refit from this solution (it only differs by which amplitude is free)
+        p0[valid] = popt[valid]
+        if i == 0:
+            d, abc = popt[:, 0], popt[:, 1:]
+            params2[:, iComp, :abc.shape[1]] = abc
+            params2[:, iComp, -1] = d
+
+        #
+        A2 = popt[:, 1: 1 + k]
+        dr[:, i] = A2[:, iComp] - A1[iComp]
+
+    #
+    if np.ndim(peth) == 1:
+        return dr[0], params2[0]
+
+    return dr, params2
 
 class BasicSaccadicModulationAnalysis(AnalysisBase):
     """
@@ -350,50 +434,13 @@ class BasicSaccadicModulationAnalysis(AnalysisBase):
             peth = self.peths['peri'][self.iUnit]
 
         #
-        params1 = self.model['params1'][self.iUnit]
-        if np.isnan(params1).all():
-            return None, None
-        abcd = params1[np.invert(np.isnan(params1))]
-        abc, d = abcd[:-1], abcd[-1]
-        A1, B1, C1 = np.split(abc, 3)
-        order = np.arange(A1.size) # NOTE: This is unnecessary, but I left it
-        k = A1.size
-
-        #
-        nComponents = int(np.nanmax(self.model['k']))
-        dr = np.full(nComponents, np.nan)
-
-        #
-        nParams = params1.size
-        params2 = np.full([nComponents, nParams], np.nan)
-        for i, iComp in enumerate(order):
-
-            # Refit
-            amplitudeBoundaries = np.vstack([A1 - 0.001, A1 + 0.001]).T
-            amplitudeBoundaries[iComp, 0] -= maximumAmplitudeShift
-            amplitudeBoundaries[iComp, 1] += maximumAmplitudeShift
-            bounds = np.vstack([
-                [[d - 0.001, d + 0.001]],
-                amplitudeBoundaries,
-                np.vstack([B1 - 0.001, B1 + 0.001]).T,
-                np.vstack([C1 - 0.001, C1 + 0.001]).T,
-            ]).T
-            p0 = np.concatenate([
-                np.array([d]),
-                A1,
-                B1,
-                C1
-            ])
-            gmm = GaussianMixturesModel(k)
-            gmm.fit(self.tProbe, peth, p0, bounds)
-            if i == 0:
-                d, abc = gmm._popt[0], gmm._popt[1:]
-                params2[iComp, :abc.size] = abc
-                params2[iComp, -1] = d
-
-            #
-            A2 = np.split(gmm._popt[1:], 3)[0]
-            dr[i] = A2[iComp] - A1[iComp]
+        dr, params2 = fitPerisaccadicPeth(
+            peth,
+            self.model['params1'][self.iUnit],
+            self.tProbe,
+            nComponents=int(np.nanmax(self.model['k'])),
+            maximumAmplitudeShift=maximumAmplitudeShift,
+        )
 
         return dr, params2
 
@@ -553,41 +600,72 @@ class BasicSaccadicModulationAnalysis(AnalysisBase):
         self,
         maximumAmplitudeShift=200,
         key='real',
+        useCache=True,
         ):
         """
+        Refit the peri-saccadic PETHs of each unit
+
+        Results are cached in the hdf file (cache/fits) and keyed by a hash of
+        the fit version, the PETH, the extra-saccadic fit parameters, the time
+        bins, and the amplitude bounds such that PETHs which did not change
+        are not refit
         """
 
         #
         nUnits, nBins, nWindows = self.peths['peri'].shape
         nParams = self.model['params1'].shape[1]
         nComponents = int((nParams - 1) / 3)
+        nComponentsFit = int(np.nanmax(self.model['k']))
         self.mi[key] = np.full([nUnits, nWindows, nComponents], np.nan)
         self.model['params2'] = np.full([nUnits, nParams, nWindows, nComponents], np.nan)
+        cache = FitResultCache(self.hdf if useCache else None)
+        nPeths, nRefit = 0, 0
 
         #
-        for ukey in self.ukeys:
+        try:
+            for ukey in self.ukeys:
 
-            #
-            self.ukey = ukey
+                #
+                self.ukey = ukey
 
-            #
-            end = '\r' if self.iUnit + 1 != nUnits else None
-            print(f'Re-fitting peri-saccadic PETHs for unit {self.iUnit + 1} out of {nUnits}', end=end)
+                #
+                end = '\r' if self.iUnit + 1 != nUnits else None
+                print(f'Re-fitting peri-saccadic PETHs for unit {self.iUnit + 1} out of {nUnits}', end=end)
 
-            #
-            for iWin in range(nWindows):
-                peth = self.peths['peri'][self.iUnit, :, iWin]
-                if np.isnan(peth).all():
-                    continue
-                dr, params2 = self._fitPerisaccadicPeth(
-                    ukey=self.ukeys[self.iUnit],
-                    peth=peth,
-                    maximumAmplitudeShift=maximumAmplitudeShift
-                )
-                if all([dr is None, params2 is None]):
+                #
+                params1 = self.model['params1'][self.iUnit]
+                if np.isnan(params1).all():
                     continue
-                self.mi[key][self.iUnit, iWin, :] = dr
-                # self.model['params2'][self.iUnit, :, iWin, :] = params2.T
+                peths = self.peths['peri'][self.iUnit].T
+                windowIndices = np.where(np.invert(np.isnan(peths).all(1)))[0]
+                keys = [
+                    cache.hash(FIT_VERSION, peths[iWin], params1, self.tProbe, nComponentsFit, maximumAmplitudeShift)
+                        for iWin in windowIndices
+                ]
+
+                # Refit the PETHs which are not cached (all at once)
+                missing = [i for i, digest in enumerate(keys) if digest not in cache]
+                nPeths += len(keys)
+                nRefit += len(missing)
+                if len(missing) != 0:
+                    dr, params2 = self._fitPerisaccadicPeth(
+                        ukey=self.ukeys[self.iUnit],
+                        peth=peths[windowIndices[missing]],
+                        maximumAmplitudeShift=maximumAmplitudeShift
+                    )
+                    for j, i in enumerate(missing):
+                        cache[keys[i]] = np.concatenate([dr[j], params2[j].ravel()])
+
+                #
+                for iWin, digest in zip(windowIndices, keys):
+                    self.mi[key][self.iUnit, iWin, :] = cache[digest][:nComponentsFit]
+                    # self.model['params2'][self.iUnit, :, iWin, :] = params2.T
+
+        finally:
+            cache.flush()
+
+        #
+        print(f'{nRefit} out of {nPeths} peri-saccadic PETHs re-fit ({nPeths - nRefit} cached)')
 
         return
 
@@ -2,6 +2,8 @@ import os
 import re
 import numpy as np
 import pathlib as pl
+from functools import partial
+from multiprocessing import Pool
 from scipy.signal import find_peaks
 
 # Number of samples in a single LabJack dat file
@@ -13,47 +15,91 @@ NCHANNELS = 9
 class LabJackError(Exception):
     pass
 
-def readDataFile(dat, line_length_range=(94, np.inf)):
+def _findDataOffset(buffer):
+    """
+    Find the byte offset of the first line of data in a labjack dat file
+    """
+
+    #
+    iline = 0
+    offset = 0
+    while True:
+        stop = buffer.find(b'\n', iline)
+        if stop == -1:
+            break
+        line = buffer[iline: stop + 1]
+        if line.count(b'\t') >= 6 and line.endswith(b'\r\n') and line.startswith(b'Time') == False:
+            return iline
+        offset = iline
+        iline = stop + 1
+
+    # No data line found (mimics the behavior of the original line scan)
+    if iline < len(buffer):
+        offset = iline
+
+    return offset
+
+def readDataFile(dat, line_length_range=(94, np.inf), dtype=np.float64):
     """
     Read a single labjack dat file into a numpy array
     """
 
     # read out the binary file
     with open(dat, 'rb') as stream:
-        lines = stream.readlines()
+        buffer = stream.read()
 
     # Corrupted or empty dat files
-    if len(lines) == 0:
-        data = np.full((NSAMPLES, NCHANNELS), np.nan)
+    if len(buffer) == 0:
+        data = np.full((NSAMPLES, NCHANNELS), np.nan, dtype=dtype)
         return data
 
-    #
-    for iline, line in enumerate(lines):
-        if bool(re.search('.*\t.*\t.*\t.*\t.*\t.*\t.*\r\n', line.decode())) and line.decode().startswith('Time') == False:
-            break
-
     # split into header and content
-    header  = lines[:iline ]
-    content = lines[ iline:]
+    offset = _findDataOffset(buffer)
+    content = buffer[offset:]
 
-    # extract data and convert to float or int
-    nrows = len(content)
-    ncols = len(content[0].decode().rstrip('\r\n').split('\t'))
-    shape = (nrows, ncols)
-    data = np.zeros(shape)
-    for iline, line in enumerate(content):
-        elements = line.decode().rstrip('\r\n').split('\t')
-        elements = [float(el) for el in elements]
-        data[iline, :] = elements
+    # Parse the content in a single pass
+    ncols = content.split(b'\n', 1)[0].count(b'\t') + 1
+    values = np.fromstring(content, dtype=dtype, sep=' ')
+    if values.size % ncols != 0:
+        raise LabJackError(f'Failed to parse labjack data file: {dat}')
+    data = values.reshape(-1, ncols)
 
-    return np.array(data)
+    return data
 
-def loadLabjackData(labjack_folder, fileNumberRange=(None, None)):
+def _readDataFiles(files, nProcesses=None, dtype=np.float64):
     """
-    Concatenate the dat files into a matrix of the shape N samples x N channels
+    Read a sequence of labjack dat files in parallel and concatenate them
+    """
+
+    #
+    nFiles = len(files)
+    data = np.full((nFiles * NSAMPLES, NCHANNELS), np.nan, dtype=dtype)
+    if nFiles == 0:
+        return data
+    if nProcesses is None:
+        nProcesses = min(nFiles, os.cpu_count())
+
+    # Copy each block into the preallocated matrix as it arrives
+    irow = 0
+    with Pool(nProcesses) as pool:
+        iterable = pool.imap(partial(readDataFile, dtype=dtype), files, chunksize=8)
+        for mat in iterable:
+            if mat.shape[1] != data.shape[1]:
+                raise LabJackError(f'Unexpected number of channels ({mat.shape[1]}) in labjack data file')
+            if irow + mat.shape[0] > data.shape[0]:
+                nRowsMissing = irow + mat.shape[0] - data.shape[0]
+                extension = np.full((nRowsMissing, data.shape[1]), np.nan, dtype=dtype)
+                data = np.concatenate([data, extension], axis=0)
+            data[irow: irow + mat.shape[0], :] = mat
+            irow += mat.shape[0]
+
+    return data[:irow]
+
+def _sortDataFiles(labjack_folder, fileNumberRange=(None, None)):
+    """
+    Determine the correct sequence of dat files
     """
 
-    # determine the correct sequence of files
     files = [
         str(file)
             for file in pl.Path(labjack_folder).iterdir() if file.suffix == '.dat'
@@ -61,8 +107,8 @@ def loadLabjackData(labjack_folder, fileNumberRange=(None, None)):
     file_numbers = [int(file.rstrip('.dat').split('_')[-1]) for file in files]
     sort_index = np.argsort(file_numbers)
 
-    # create the matrix
-    data = list()
+    #
+    sequence = list()
     for ifile in sort_index:
         if fileNumberRange[0] is not None:
             if ifile < fileNumberRange[0]:
@@ -70,13 +116,20 @@ def loadLabjackData(labjack_folder, fileNumberRange=(None, None)):
         if fileNumberRange[1] is not None:
             if ifile > fileNumberRange[1]:
                 continue
-        dat = os.path.join(labjack_folder, files[ifile])
-        mat = readDataFile(dat)
-        for irow in range(mat.shape[0]):
-            data.append(mat[irow,:].tolist())
+        sequence.append(os.path.join(labjack_folder, files[ifile]))
+
+    return sequence
+
+def loadLabjackData(labjack_folder, fileNumberRange=(None, None), nProcesses=None, dtype=np.float64):
+    """
+    Concatenate the dat files into a matrix of the shape N samples x N channels
+    """
+
+    files = _sortDataFiles(labjack_folder, fileNumberRange)
+    data = _readDataFiles(files, nProcesses, dtype)
 
     #
-    return np.array(data)
+    return data
 
 def extractLabjackEvent(
     data,
@@ -63,6 +63,99 @@ def extractPulseTrains(
 
     return pulseTrainsFiltered
 
+def padPulseTrains(pulseTrains, pad=100):
+    """
+    Stack pulse trains into a matrix padded (on the right) with NaNs
+    """
+
+    if len(pulseTrains) == 0:
+        return np.array([])
+    lengths = np.array([len(pulseTrain) for pulseTrain in pulseTrains])
+    if lengths.max() > pad:
+        raise Exception(f'Pulse train with {lengths.max()} state transitions exceeds the padded size ({pad})')
+    padded = np.full([len(pulseTrains), pad], np.nan)
+    padded[np.arange(pad) < lengths[:, None]] = np.concatenate(pulseTrains)
+
+    return padded
+
+def decodePaddedPulseTrains(pulseTrainsPadded, samplingRate, barcodeBitSize=0.03, wrapperBitSize=0.01):
+    """
+    Decode every pulse train of a NaN-padded matrix (N trains x M samples) at once
+
+    returns
+    -------
+    values
+        Decoded barcode values (corrected for 32-bit integer overflow)
+    indices
+        Sample index of the first state transition of each pulse train
+    """
+
+    pulseTrainsPadded = np.asarray(pulseTrainsPadded, dtype=np.float64)
+    if pulseTrainsPadded.size == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    nTrains, nColumns = pulseTrainsPadded.shape
+    pulseTrains = np.trunc(pulseTrainsPadded) # Same as casting each sample index to an integer
+    lengths = np.invert(np.isnan(pulseTrains)).sum(1)
+    rowIndices = np.arange(nTrains)
+
+    # Wrapper edges
+    wrapperFallingEdges = pulseTrains[:, 1]
+    wrapperRisingEdges = pulseTrains[rowIndices, lengths - 2]
+    barcodeLeftEdges = wrapperFallingEdges + round(wrapperBitSize * samplingRate)
+    barcodeRightEdges = wrapperRisingEdges - round(wrapperBitSize * samplingRate)
+
+    # Determine the state at the beginning and end of the data window
+    firstStateTransitions = pulseTrains[:, 2]
+    initialSignalStates = (firstStateTransitions - barcodeLeftEdges) / samplingRate < 0.001
+    finalStateTransitions = pulseTrains[rowIndices, lengths - 3]
+    finalSignalStates = (barcodeRightEdges - finalStateTransitions) / samplingRate < 0.001
+
+    # State transitions (plus the barcode edges if the signal is low at either edge)
+    columnIndices = np.arange(nColumns)
+    transitions = np.hstack([
+        barcodeLeftEdges[:, None],
+        pulseTrains,
+        barcodeRightEdges[:, None]
+    ])
+    mask = np.hstack([
+        np.invert(initialSignalStates)[:, None],
+        (columnIndices >= 2) & (columnIndices[None, :] < (lengths - 2)[:, None]),
+        np.invert(finalSignalStates)[:, None],
+    ])
+    transitions = transitions[mask]
+    transitionRowIndices = np.nonzero(mask)[0]
+
+    # Number of bits stored in each interval between state transitions
+    intervalMask = transitionRowIndices[1:] == transitionRowIndices[:-1]
+    intervals = np.diff(transitions)[intervalMask]
+    intervalRowIndices = transitionRowIndices[1:][intervalMask]
+    nBits = np.rint(intervals / (barcodeBitSize * samplingRate)).astype(np.int64)
+    nBits = np.clip(nBits, 0, None)
+
+    # The state alternates from one interval to the next
+    firstIntervalIndices = np.searchsorted(intervalRowIndices, rowIndices)
+    intervalNumbers = np.arange(intervalRowIndices.size) - firstIntervalIndices[intervalRowIndices]
+    states = initialSignalStates[intervalRowIndices] ^ (intervalNumbers % 2 == 1)
+
+    # Expand the states into bits
+    nBitsPerTrain = np.bincount(intervalRowIndices, weights=nBits, minlength=nTrains)
+    if np.any(nBitsPerTrain != 32):
+        raise Exception(f'More or less that 32 bits decoded')
+    bits = np.repeat(states, nBits).reshape(nTrains, 32).astype(np.int64)
+
+    # Pack the bits (the first bit is the least significant bit)
+    values = bits @ (np.int64(2) ** np.arange(32, dtype=np.int64))
+
+    # 32-bit integer overflow
+    overflow = np.where(values == 2 ** 32 - 1)[0]
+    if overflow.size != 0:
+        values[overflow[0] + 1:] += 2 ** 32
+
+    #
+    indices = pulseTrains[:, 0].astype(np.int64)
+
+    return values, indices
+
 def decodePulseTrains(pulseTrains, device='lj', barcodeBitSize=0.03, wrapperBitSize=0.01):
     """
     """
@@ -77,59 +170,15 @@ def decodePulseTrains(pulseTrains, device='lj', barcodeBitSize=0.03, wrapperBitS
     else:
         raise Exception(f'Invalid device: {device}')
 
-    values, indices = list(), list()
-
-    offset = 0
-    for pulseTrain in pulseTrains:
-
-        # 
-        wrapperFallingEdge = pulseTrain[1]
-        wrapperRisingEdge = pulseTrain[-2]
-        barcodeLeftEdge = wrapperFallingEdge + round(wrapperBitSize * samplingRate)
-        barcodeRightEdge = wrapperRisingEdge - round(wrapperBitSize * samplingRate)
-        
-        # Determine the state at the beginning and end of the data window
-        firstStateTransition = pulseTrain[2]
-        if (firstStateTransition - barcodeLeftEdge) / samplingRate < 0.001:
-            initialSignalState = currentSignalState = True
-        else:
-            initialSignalState = currentSignalState = False
-        finalStateTransition = pulseTrain[-3]
-        if (barcodeRightEdge - finalStateTransition) / samplingRate < 0.001:
-            finalSignalState = True
-        else:
-            finalSignalState = False
-
-        # Determine what indices to use for computing time intervals between state transitions
-        if initialSignalState == True and finalSignalState == True:
-            iterable = pulseTrain[2: -2]
-        elif initialSignalState == True and finalSignalState == False:
-            iterable = np.concatenate([pulseTrain[2:-2], np.array([barcodeRightEdge])])
-        elif initialSignalState == False and finalSignalState == False:
-            iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2], np.array([barcodeRightEdge])])
-        elif initialSignalState == False and finalSignalState == True:
-            iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2]])
-        
-        # Determine how many bits are stored in each time interval and keep track of the signal state
-        bitList = list()
-        for nSamples in np.diff(iterable):
-            nBits = int(round(nSamples / (barcodeBitSize * samplingRate)))
-            for iBit in range(nBits):
-                bitList.append(1 if currentSignalState else 0)
-            currentSignalState = not currentSignalState
-
-        # Decode the strings of bits
-        bitString = ''.join(map(str, bitList[::-1]))
-        if len(bitString) != 32:
-            raise Exception(f'More or less that 32 bits decoded')
-        value = int(bitString, 2) + offset
-
-        # 32-bit integer overflow
-        if value == 2 ** 32 - 1:
-            offset = 2 ** 32
-
-        #
-        values.append(value)
-        indices.append(pulseTrain[0])
-
-    return np.array(values), np.array(indices)
\ No newline at end of file
+    #
+    if len(pulseTrains) == 0:
+        return np.array([]), np.array([])
+    pad = max([len(pulseTrain) for pulseTrain in pulseTrains])
+    values, indices = decodePaddedPulseTrains(
+        padPulseTrains(pulseTrains, pad),
+        samplingRate,
+        barcodeBitSize,
+        wrapperBitSize
+    )
+
+    return values, indices
@@ -1,5 +1,6 @@
 import os
 import sys
+import functools
 import numpy as np
 import pathlib as pl
 import subprocess as sp
@@ -169,8 +170,9 @@ def psth(target_events, relative_events, binsize=0.01, window=(-0.5, 1), edges=N
     else:
         return edges, M
 
-def psth2(event1, event2, window=(-1, 1), binsize=None, returnTimestamps=False, returnShape=False):
+def _computeBinEdges(window, binsize=None):
     """
+    Compute the bin edges and bin centers for a PSTH
     """
 
     # Case of a single bin
@@ -178,7 +180,6 @@ def psth2(event1, event2, window=(-1, 1), binsize=None, returnTimestamps=False,
         nBins = 1
         binEdges = window
         t = window[0] + np.diff(window).item() / 2
-        i = None
 
     # Check that the time range is evenly divisible by the binsize
     else:
@@ -195,31 +196,285 @@ def psth2(event1, event2, window=(-1, 1), binsize=None, returnTimestamps=False,
         binEdges = np.linspace(start, stop, nBins + 1)
         t = binEdges[:-1] + binsize / 2
 
+    return t, nBins, np.asarray(binEdges, dtype=float)
+
+def _findEventsWithinWindow(event1, event2, window):
+    """
+    Find every event in event2 within the window around each event in event1
+
+    Returns the relative timestamps, the index of the reference event (row), and
+    the index of the target event for every pair of events (ordered by row and
+    then by the order of event2)
+    """
+
+    # Sort the target events (the original order is restored below)
+    sortingIndex = None
+    sortedEvent2 = event2
+    if event2.size > 1 and np.all(event2[:-1] <= event2[1:]) == False:
+        sortingIndex = np.argsort(event2, kind='stable')
+        sortedEvent2 = event2[sortingIndex]
+
+    # Find the range of candidate events for each reference event
+    tolerance = 1e-6
+    iLeft = np.searchsorted(sortedEvent2, event1 + window[0] - tolerance, side='left')
+    iRight = np.searchsorted(sortedEvent2, event1 + window[1] + tolerance, side='right')
+    nCandidates = np.clip(iRight - iLeft, 0, None)
+
+    # Gather the candidates (flattened across trials)
+    rowIndices = np.repeat(np.arange(event1.size), nCandidates)
+    offsets = np.repeat(np.cumsum(nCandidates) - nCandidates, nCandidates)
+    candidateIndices = np.arange(rowIndices.size) - offsets + np.repeat(iLeft, nCandidates)
+    if sortingIndex is not None:
+        candidateIndices = sortingIndex[candidateIndices]
+        order = np.lexsort([candidateIndices, rowIndices])
+        candidateIndices = candidateIndices[order]
+        rowIndices = rowIndices[order]
+
+    # Apply the same inclusion criteria as a trial-by-trial computation
+    relative = event2[candidateIndices] - event1[rowIndices]
+    withinWindowMask = np.logical_and(
+        relative >= window[0],
+        relative <= window[1]
+    )
+
+    return relative[withinWindowMask], rowIndices[withinWindowMask], candidateIndices[withinWindowMask]
+
+def _digitizeRelativeTimestamps(relative, binEdges):
+    """
+    Assign relative timestamps to bins (identical to np.histogram, i.e., the last bin is closed)
+    """
+
+    nBins = binEdges.size - 1
+    binIndices = np.searchsorted(binEdges, relative, side='right') - 1
+    binIndices[relative == binEdges[-1]] = nBins - 1
+    withinEdgesMask = np.logical_and(binIndices >= 0, relative <= binEdges[-1])
+
+    return binIndices, withinEdgesMask
+
+def psth2(event1, event2, window=(-1, 1), binsize=None, returnTimestamps=False, returnShape=False):
+    """
+    """
+
+    #
+    t, nBins, binEdges = _computeBinEdges(window, binsize)
+
     #
     if returnShape:
         return t, event1.size, nBins
 
     #
-    M = np.full([event1.size, nBins], np.nan)
-    relativeTimestamps = list()
-    for rowIndex, timestamp in enumerate(event1):
-        relative = event2 - timestamp
-        withinWindowMask = np.logical_and(
-            relative >= window[0],
-            relative <= window[1]
-        )
-        binCounts, binEdges = np.histogram(relative[withinWindowMask], bins=binEdges)
-        M[rowIndex, :] = binCounts
-        relativeTimestamps.append(relative[withinWindowMask])
-        # for ts in relative[withinWindowMask]:
-        #     relativeTimestamps.append(ts)
+    event1 = np.asarray(event1)
+    event2 = np.asarray(event2)
+    relative, rowIndices, eventIndices = _findEventsWithinWindow(event1, event2, window)
+
+    #
+    binIndices, withinEdgesMask = _digitizeRelativeTimestamps(relative, binEdges)
+    counts = np.bincount(
+        rowIndices[withinEdgesMask] * nBins + binIndices[withinEdgesMask],
+        minlength=event1.size * nBins
+    )
+    M = counts.reshape(event1.size, nBins).astype(float)
 
     #
     if returnTimestamps:
+        splitIndices = np.cumsum(np.bincount(rowIndices, minlength=event1.size))[:-1]
+        relativeTimestamps = np.split(relative, splitIndices) if event1.size != 0 else list()
         return t, M, relativeTimestamps
     else:
         return t, M
 
+def psth3(event1, spikeTimestamps, spikeClusters, clusters=None, window=(-1, 1), binsize=None, returnShape=False):
+    """
+    Compute the PSTHs for every unit in a population in a single pass
+
+    keywords
+    --------
+    event1
+        Timestamps of the reference events (trials)
+    spikeTimestamps
+        Timestamps of every spike in the recording
+    spikeClusters
+        Cluster label of every spike in the recording
+    clusters
+        Cluster labels of the units (determines the order of the first
+        dimension of the output, defaults to the unique cluster labels)
+
+    returns
+    -------
+    t
+        Bin centers
+    M
+        Spike counts with the shape N units x N trials x N bins
+    """
+
+    #
+    t, nBins, binEdges = _computeBinEdges(window, binsize)
+    event1 = np.asarray(event1)
+    if clusters is None:
+        clusters = np.unique(spikeClusters)
+    clusters = np.asarray(clusters)
+    nUnits, nTrials = clusters.size, event1.size
+
+    #
+    if returnShape:
+        return t, nUnits, nTrials, nBins
+
+    #
+    relative, rowIndices, spikeIndices = _findEventsWithinWindow(
+        event1,
+        np.asarray(spikeTimestamps),
+        window
+    )
+    binIndices, withinEdgesMask = _digitizeRelativeTimestamps(relative, binEdges)
+
+    # Map the cluster label of each spike to the index of the unit
+    sortingIndex = np.argsort(clusters)
+    labels = np.asarray(spikeClusters)[spikeIndices]
+    positions = np.clip(np.searchsorted(clusters[sortingIndex], labels), 0, max(nUnits - 1, 0))
+    unitIndices = sortingIndex[positions] if nUnits != 0 else positions
+    withinPopulationMask = clusters[unitIndices] == labels if nUnits != 0 else np.full(labels.size, False)
+    mask = np.logical_and(withinEdgesMask, withinPopulationMask)
+
+    #
+    counts = np.bincount(
+        (unitIndices[mask] * nTrials + rowIndices[mask]) * nBins + binIndices[mask],
+        minlength=nUnits * nTrials * nBins
+    )
+    M = counts.reshape(nUnits, nTrials, nBins)
+
+    return t, M
+
+def _countFineBins(window, resolution):
+    """
+    """
+
+    return int(np.ceil(round((window[1] - window[0]) / resolution, 6)))
+
+@functools.lru_cache(maxsize=32)
+def _computeGaussianKernelMatrix(start, resolution, nBins, t, sigma):
+    """
+    Gaussian kernel evaluated at each time point for every fine bin (N fine bins x N time points)
+    """
+
+    binCenters = start + (np.arange(nBins) + 0.5) * resolution
+    z = (np.array(t)[None, :] - binCenters[:, None]) / sigma
+    K = np.exp(-0.5 * z ** 2) / (sigma * np.sqrt(2 * np.pi))
+    K.setflags(write=False)
+
+    return K
+
+def _correctBandwidth(sigma, nSamples):
+    """
+    Scale the kernel width like scipy's gaussian_kde which computes the
+    bandwidth from the unbiased (ddof=1) variance of the sample, i.e.,
+    sigma * sqrt(n / (n - 1)) for a bandwidth factor of sigma / std(sample)
+    """
+
+    nSamples = np.around(np.asarray(nSamples, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(nSamples > 1, np.sqrt(nSamples / (nSamples - 1)), 1.0)
+
+    return sigma * factor
+
+def binRelativeTimestamps(relativeTimestamps, window, resolution=0.0005):
+    """
+    Bin the relative timestamps of each trial finely (N trials x N fine bins)
+
+    Timestamps are linearly binned, i.e., split between the two nearest bin
+    centers such that each row still sums to the number of timestamps
+
+    keywords
+    --------
+    relativeTimestamps
+        List of relative timestamps for each trial (e.g., returned by psth2
+        with returnTimestamps=True)
+    """
+
+    nBins = _countFineBins(window, resolution)
+    nTrials = len(relativeTimestamps)
+    if nTrials == 0:
+        return np.zeros([0, nBins])
+    trialIndices = np.repeat(np.arange(nTrials), [len(sample) for sample in relativeTimestamps])
+    sample = np.concatenate([np.asarray(sample, dtype=float) for sample in relativeTimestamps])
+
+    # Linear binning (each timestamp is split between the two nearest bin centers)
+    position = np.clip((sample - window[0]) / resolution - 0.5, 0, nBins - 1)
+    leftBinIndices = np.minimum(np.floor(position).astype(int), max(nBins - 2, 0))
+    fraction = np.clip(position - leftBinIndices, 0, 1)
+    rightBinIndices = np.minimum(leftBinIndices + 1, nBins - 1)
+    H = np.bincount(
+        np.concatenate([trialIndices * nBins + leftBinIndices, trialIndices * nBins + rightBinIndices]),
+        weights=np.concatenate([1 - fraction, fraction]),
+        minlength=nTrials * nBins
+    ).reshape(nTrials, nBins)
+
+    return H
+
+def kde2(histograms, window, t, sigma=0.005, resolution=0.0005, weights=None, nTrials=None, correctBandwidth=True):
+    """
+    Estimate firing rate with a fixed-bandwidth Gaussian KDE of finely binned spike timestamps
+
+    The histogram of each trial is smoothed once with a (cached) kernel
+    matrix and resamples are computed as weighted sums of the smoothed
+    trials, so many resamples cost a single matrix product.
+
+    keywords
+    --------
+    histograms
+        Binned relative timestamps (N trials x N fine bins, see binRelativeTimestamps)
+    window
+        Time window used to bin the relative timestamps
+    t
+        Time points at which the firing rate is evaluated
+    weights
+        Weight (or selection) matrix (N resamples x N trials), all trials are
+        pooled if None
+    nTrials
+        Number of trials used to normalize each resample (defaults to the sum of the weights)
+    correctBandwidth
+        Widen the kernel by sqrt(n / (n - 1)) where n is the number of
+        timestamps (matches scipy's gaussian_kde). Only applied if weights is
+        None, resamples are smoothed with the uncorrected kernel such that
+        they share a single matrix product (the correction is < 1 / (2n))
+
+    returns
+    -------
+    fr
+        Firing rate (N time points or N resamples x N time points)
+    """
+
+    t = np.atleast_1d(np.asarray(t, dtype=float))
+    nBins = _countFineBins(window, resolution)
+    if histograms.shape[1] != nBins:
+        raise Exception(f'Histograms must have {nBins} bins (window={window}, resolution={resolution})')
+    key = (float(window[0]), float(resolution), nBins, tuple(t.tolist()))
+
+    #
+    if weights is None:
+        if correctBandwidth:
+            sigma = _correctBandwidth(sigma, histograms.sum())
+        K = _computeGaussianKernelMatrix(*key, float(sigma))
+        fr = histograms.sum(0) @ K
+        if nTrials is None:
+            nTrials = histograms.shape[0]
+
+    # Smooth each trial once (resamples share the kernel, see correctBandwidth)
+    else:
+        weights = np.asarray(weights, dtype=float)
+        K = _computeGaussianKernelMatrix(*key, float(sigma))
+        fr = weights @ (histograms @ K)
+
+    #
+    if weights is not None:
+        if nTrials is None:
+            nTrials = weights.sum(1)
+        nTrials = np.broadcast_to(np.asarray(nTrials, dtype=float), (weights.shape[0],))[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fr = fr / nTrials
+
+    return fr
+
 def detectThresholdCrossing(a, threshold, timeout=None):
     """
     Determine where a threshold was crossing in a time series (agnostic of
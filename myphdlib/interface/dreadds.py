@@ -128,7 +128,7 @@ class StimuliProcessingMixinDreadds(StimuliProcessingMixin):
 
         #
         if xData is None:
-            M = self.load('labjack/matrix')
+            M = self.load('labjack/matrix', lazy=True)
             lightSensorSignal = M[:, self.labjackChannelMapping['stimulus']]
             xData = np.around(placeVerticalLines(lightSensorSignal), 0).astype(int)
         
@@ -304,7 +304,7 @@ class StimuliProcessingMixinDreadds(StimuliProcessingMixin):
                 trialParameters[key].append(value)
 
         # Load the labjack data
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
         start, stop = self.load('epochs/dg')
         signal = M[start: stop, self.labjackChannelMapping['stimulus']]
 
@@ -1,13 +1,149 @@
 import h5py
+import hashlib
 import numpy as np
+import pathlib as pl
 from dotmap import DotMap
-from myphdlib.general.toolkit import psth2
+from myphdlib.general.toolkit import psth2, binRelativeTimestamps, kde2
 from sklearn.neighbors import KernelDensity
 from scipy.stats import gaussian_kde
 
 # TODO
 # [ ] Load all of the unit property values on instatiation
 
+def hashSpikeData(spikeTimestamps, spikeClusters):
+    """
+    Return a checksum of the spike timestamps and clusters
+    """
+
+    sha = hashlib.sha1()
+    for value in (spikeTimestamps, spikeClusters):
+        sha.update(np.ascontiguousarray(value, dtype=np.float64))
+
+    return sha.hexdigest()
+
+def writeSpikeStore(folder, spikeTimestamps, spikeClusters):
+    """
+    Write the spike timestamps and clusters to flat npy files which can be memory-mapped
+    """
+
+    folder = pl.Path(folder)
+    if folder.exists() == False:
+        folder.mkdir()
+
+    # The store is incomplete until the offsets are written again
+    SpikeStore(folder).invalidate()
+
+    # NOTE: Hashed before sorting (like the spike data saved to the output file)
+    checksum = hashSpikeData(spikeTimestamps, spikeClusters)
+
+    # Every spike in order of time
+    sortingIndex = np.argsort(spikeTimestamps, kind='stable')
+    spikeTimestamps = spikeTimestamps[sortingIndex]
+    spikeClusters = spikeClusters[sortingIndex]
+    np.save(folder.joinpath('timestamps.npy'), spikeTimestamps)
+    np.save(folder.joinpath('clusters.npy'), spikeClusters)
+
+    # Every spike sorted by cluster (and in order of time within each cluster)
+    sortingIndex = np.argsort(spikeClusters, kind='stable')
+    sortedSpikeClusters = spikeClusters[sortingIndex]
+    np.save(folder.joinpath('sorted.npy'), spikeTimestamps[sortingIndex])
+    if sortedSpikeClusters.size == 0:
+        firstSpikeIndices = np.array([], dtype=np.int64)
+    else:
+        firstSpikeIndices = np.concatenate([[0], np.flatnonzero(np.diff(sortedSpikeClusters)) + 1])
+    np.save(folder.joinpath('units.npy'), sortedSpikeClusters[firstSpikeIndices])
+    with open(folder.joinpath('checksum.txt'), 'w') as stream:
+        stream.write(checksum)
+
+    # NOTE: The offsets are written last and mark the store as complete
+    np.save(folder.joinpath('offsets.npy'), np.append(firstSpikeIndices, sortedSpikeClusters.size))
+
+    return
+
+class SpikeStore():
+    """
+    Memory-mapped spike data written by writeSpikeStore
+
+    timestamps.npy  Spike timestamps in order of time
+    clusters.npy    Spike clusters in order of time
+    sorted.npy      Spike timestamps sorted by cluster (and time)
+    units.npy       Unique cluster labels
+    checksum.txt    Checksum of the spike data the store was written from
+    offsets.npy     Index of the first spike of each unit in sorted.npy
+    """
+
+    def __init__(self, folder):
+        """
+        """
+
+        self._folder = pl.Path(folder)
+
+        return
+
+    def exists(self):
+        """
+        """
+
+        return self._folder.joinpath('offsets.npy').exists()
+
+    def invalidate(self):
+        """
+        Mark the store as incomplete (e.g., when the spike data is rewritten)
+        """
+
+        file = self._folder.joinpath('offsets.npy')
+        if file.exists():
+            file.unlink()
+
+        return
+
+    @property
+    def checksum(self):
+        """
+        Checksum of the spike data the store was written from (None if unknown)
+        """
+
+        file = self._folder.joinpath('checksum.txt')
+        if file.exists() == False:
+            return None
+        with open(file, 'r') as stream:
+            checksum = stream.read().strip()
+
+        return checksum
+
+    def _load(self, filename, mmap=True):
+        """
+        """
+
+        return np.load(
+            str(self._folder.joinpath(filename)),
+            mmap_mode='r' if mmap else None
+        )
+
+    @property
+    def folder(self):
+        return self._folder
+
+    @property
+    def allSpikeTimestamps(self):
+        return self._load('timestamps.npy')
+
+    @property
+    def allSpikeClusters(self):
+        return self._load('clusters.npy')
+
+    @property
+    def spikeTimestampsByCluster(self):
+        return self._load('sorted.npy')
+
+    @property
+    def uniqueSpikeClusters(self):
+        return self._load('units.npy', mmap=False)
+
+    @property
+    def spikeOffsets(self):
+        return self._load('offsets.npy', mmap=False)
+
 class SingleUnit():
     """
     """
@@ -206,7 +342,8 @@ class SingleUnit():
         buffer=0.5,
         t=None,
         sample=None,
-        nTrials=None
+        nTrials=None,
+        resolution=0.0005,
         ):
         """
         Estimate FR using kernel density estimation
@@ -224,27 +361,38 @@ class SingleUnit():
                 binsize=None,
                 returnTimestamps=True
             )
-            sample = list()
-            for tr in sample_:
-                for ts in tr:
-                    sample.append(ts)
-            sample = np.array(sample)
+            sample = np.concatenate(sample_) if len(sample_) != 0 else np.array([])
             nTrials = M.shape[0]
 
         #
+        sample = np.asarray(sample)
         if sample.size < 3:
             raise Exception('Not enough events to perform KDE')
-        else:
-            f = gaussian_kde(sample)
-            f.set_bandwidth(sigma / sample.std())
 
         #
         if t is None:
             leftEdges = np.arange(responseWindow[0], responseWindow[1], binsize)
             t = np.around(leftEdges + (binsize / 2), 3)
 
-        y = f(t)
-        fr = y * (sample.size * binsize) / nTrials / binsize
+        # Binned KDE (the pooled sample is treated as a single trial)
+        # NOTE: The binning window is only extended by whole multiples of the
+        #       buffered window's width so that the cached kernel is reused
+        windowWidth = responseWindowBuffered[1] - responseWindowBuffered[0]
+        nLeft = max(0, int(np.ceil((responseWindowBuffered[0] - sample.min()) / windowWidth)))
+        nRight = max(0, int(np.ceil((sample.max() - responseWindowBuffered[1]) / windowWidth)))
+        binningWindow = (
+            round(responseWindowBuffered[0] - nLeft * windowWidth, 9),
+            round(responseWindowBuffered[1] + nRight * windowWidth, 9)
+        )
+        H = binRelativeTimestamps([sample], binningWindow, resolution)
+        fr = kde2(
+            H,
+            binningWindow,
+            t,
+            sigma=sigma,
+            resolution=resolution,
+            nTrials=nTrials
+        )
 
         return t, fr
 
@@ -292,7 +440,11 @@ class SingleUnit():
         """
 
         if self._index is None:
-            self._index = np.where(self.session.population.uniqueSpikeClusters == self.cluster)[0].item()
+            uniqueSpikeClusters = self.session.population.uniqueSpikeClusters
+            index = np.searchsorted(uniqueSpikeClusters, self.cluster)
+            if index >= uniqueSpikeClusters.size or uniqueSpikeClusters[index] != self.cluster:
+                raise Exception(f'Could not locate cluster {self.cluster} in the population')
+            self._index = int(index)
 
         return self._index
 
@@ -316,8 +468,7 @@ class SingleUnit():
         """
 
         if self._timestamps is None:
-            spikeIndices = np.where(self.session.population.allSpikeClusters == self.cluster)[0]
-            self._timestamps = self.session.population.allSpikeTimestamps[spikeIndices]
+            self._timestamps = self.session.population.getSpikeTimestamps(self.cluster)
 
         return self._timestamps
 
@@ -399,7 +550,7 @@ class SingleUnit():
                 if self.session.population.datasets[key] is None:
                     continue
                 probeDirection = key[3]
-                vrp[probeDirection] = round(1 - self.session.population.datasets[key][self.index], 3)
+                vrp[probeDirection] = np.around(1 - float(self.session.population.datasets[key][self.index]), 3) # NOTE: Rounded like Population.metrics
             self._visualResponseProbability = DotMap(vrp)
 
         return self._visualResponseProbability
@@ -607,7 +758,13 @@ class Population():
 
         self._session = session
         self._units = None
+        self._allUnits = None
+        self._selection = None
+        self._metrics = None
+        self._unitsByCluster = dict()
         self._index = 0
+        self._spikeTimestampsByCluster = None
+        self._spikeOffsets = None
         self._datasets = {
             ('population', 'metrics', 'pr'): None,
             ('population', 'metrics', 'rpvr'): None,
@@ -651,25 +808,102 @@ class Population():
         if self._units is not None:
             del self._units
         self._units = list()
+        self._allUnits = list()
+        self._metrics = None
+
+        # Read through the memory-mapped spike store (if it exists and was written from the current spike data)
+        store = SpikeStore(self._session.home.joinpath('spikes'))
+        entry = self._session.store.manifest().get('spikes/timestamps')
+        checksum = None if entry is None else entry['attrs'].get('checksum')
+        if store.exists() and (checksum is None or checksum == store.checksum):
+            self._allSpikeTimestamps = store.allSpikeTimestamps
+            self._allSpikeClusters = store.allSpikeClusters
+            self._spikeTimestampsByCluster = store.spikeTimestampsByCluster
+            self._uniqueSpikeClusters = store.uniqueSpikeClusters
+            self._spikeOffsets = store.spikeOffsets
+            for cluster in self.uniqueSpikeClusters:
+                unit = SingleUnit(self._session, cluster)
+                self._allUnits.append(unit)
+            self._select(np.full(len(self._allUnits), True))
+            return
 
         #
         self._allSpikeClusters = self._session.load('spikes/clusters')
         if self._allSpikeClusters is None:
-            self._units = list()
+            self._select(np.full(0, True))
             self._uniqueSpikeClusters = None
             self._allSpikeTimestamps = None
+            self._spikeTimestampsByCluster = None
+            self._spikeOffsets = None
             return
 
+        #
         self._allSpikeTimestamps = self._session.load('spikes/timestamps')
-        self._uniqueSpikeClusters = np.unique(self.allSpikeClusters)
+        self._indexSpikesByCluster()
 
         #
         for cluster in self.uniqueSpikeClusters:
             unit = SingleUnit(self._session, cluster)
-            self._units.append(unit)
+            self._allUnits.append(unit)
+        self._select(np.full(len(self._allUnits), True))
 
         return
 
+    def _indexSpikesByCluster(self):
+        """
+        Build a CSR-style index of the spikes (sorted by cluster, in order of time within each cluster)
+        """
+
+        sortingIndex = np.argsort(self._allSpikeClusters, kind='stable')
+        sortedSpikeClusters = self._allSpikeClusters[sortingIndex]
+        self._spikeTimestampsByCluster = self._allSpikeTimestamps[sortingIndex]
+        self._spikeTimestampsByCluster.flags.writeable = False
+
+        #
+        boundaries = np.flatnonzero(np.diff(sortedSpikeClusters)) + 1
+        if sortedSpikeClusters.size == 0:
+            firstSpikeIndices = np.array([], dtype=int)
+        else:
+            firstSpikeIndices = np.concatenate([[0], boundaries])
+        self._uniqueSpikeClusters = sortedSpikeClusters[firstSpikeIndices]
+        self._spikeOffsets = np.append(firstSpikeIndices, sortedSpikeClusters.size)
+
+        return
+
+    def _indexUnits(self):
+        """
+        Map cluster numbers to units (in the current selection of units)
+        """
+
+        self._unitsByCluster = {unit.cluster: unit for unit in self._units}
+
+        return
+
+    def _select(self, mask):
+        """
+        Select a subset of all units with a mask
+        """
+
+        self._selection = np.array(mask, dtype=bool)
+        self._units = [unit for unit, selected in zip(self._allUnits, self._selection) if selected]
+        self._indexUnits()
+
+        return
+
+    def getSpikeTimestamps(self, cluster):
+        """
+        Return the spike timestamps for a single cluster (a read-only view)
+        """
+
+        if self._spikeOffsets is None:
+            return None
+        index = np.searchsorted(self._uniqueSpikeClusters, cluster)
+        if index >= self._uniqueSpikeClusters.size or self._uniqueSpikeClusters[index] != cluster:
+            return np.array([])
+        start, stop = self._spikeOffsets[index], self._spikeOffsets[index + 1]
+
+        return self._spikeTimestampsByCluster[start: stop]
+
     def _loadPopulationDatasets(
         self
         ):
@@ -682,20 +916,82 @@ class Population():
                 datasetPath = '/'.join(parts)
                 if self._session.hasDataset(datasetPath):
                     self._datasets[k] = self._session.load(datasetPath)
-
+        self._metrics = None
 
         return
 
-    def indexByCluster(self, cluster):
+    def _buildMetricsTable(
+        self,
+        ):
         """
+        Collect the metrics used for filtering into one array per metric (aligned with all units)
         """
 
-        for unit in self._units:
-            if unit.cluster == cluster:
-                return unit
+        nUnits = len(self._allUnits)
+        def column(key, decimals=None):
+            values = self._datasets[key]
+            if values is None:
+                return np.full(nUnits, np.nan)
+            values = np.array(values, dtype=float)
+            if decimals is not None:
+                values = np.around(values, decimals)
+            return values
+
+        #
+        metrics = {
+            'spikeCount': np.diff(self._spikeOffsets) if self._spikeOffsets is not None else np.full(nUnits, 0),
+            'presenceRatio': column(('population', 'metrics', 'pr')),
+            'refractoryPeriodViolationRate': column(('population', 'metrics', 'rpvr')),
+            'amplitudeCutoff': column(('population', 'metrics', 'ac')),
+            'directionSelectivityIndex': column(('population', 'metrics', 'dsi')),
+            'luminancePolarityIndex': column(('population', 'metrics', 'lpi')),
+            'motionPreferenceIndex': column(('population', 'metrics', 'rpi')),
+            'label': column(('clustering', 'probe', 'labels')),
+        }
+
+        # Choose the amplitude of the positive or negative peak (see SingleUnit.visualResponseSign)
+        responsePolarityIndices = np.vstack([
+            column(('population', 'metrics', 'rsi', 'left')),
+            column(('population', 'metrics', 'rsi', 'right'))
+        ]).mean(0)
+        peakIndices = np.where(responsePolarityIndices < 0, 1, 0)
+
+        #
+        for probeDirection in ('left', 'right'):
+            metrics[f'visualResponseProbability/{probeDirection}'] = np.around(
+                1 - column(('population', 'zeta', 'probe', probeDirection, 'p')),
+                3
+            )
+            metrics[f'visualResponseLatency/{probeDirection}'] = column(('population', 'metrics', 'rl', 'probe', probeDirection), 3)
+            amplitudes = column(('population', 'metrics', 'vra', probeDirection), 3)
+            if amplitudes.ndim == 2:
+                amplitudes = amplitudes[np.arange(amplitudes.shape[0]), peakIndices]
+            metrics[f'visualResponseAmplitude/{probeDirection}'] = amplitudes
+
+        #
+        for key in metrics.keys():
+            metrics[key].flags.writeable = False
+        self._metrics = metrics
 
         return
 
+    @property
+    def metrics(self):
+        """
+        Columnar table of unit metrics (one array per metric, aligned with all units)
+        """
+
+        if self._metrics is None:
+            self._buildMetricsTable()
+
+        return self._metrics
+
+    def indexByCluster(self, cluster):
+        """
+        """
+
+        return self._unitsByCluster.get(cluster)
+
     def filter2(
         self,
         minimumFiringRate=None,
@@ -710,16 +1006,17 @@ class Population():
         self.unfilter()
 
         #
-        unitFilter = np.full(len(self._units), True)
-        for unitIndex, unit in enumerate(self._units):
-            if minimumFiringRate is not None and unit.timestamps.size / unit.session.tRange[-1] < minimumFiringRate:
-                unitFilter[unitIndex] = False
-            if minimumResponseAmplitude is not None and unit.visualResponseAmplitude[probeDirection] < minimumResponseAmplitude:
-                unitFilter[unitIndex] = False
+        unitFilter = np.full(len(self._allUnits), True)
+        if minimumFiringRate is not None:
+            firingRates = self.metrics['spikeCount'] / self._session.tRange[-1]
+            unitFilter[firingRates < minimumFiringRate] = False
+        if minimumResponseAmplitude is not None:
+            amplitudes = self.metrics[f'visualResponseAmplitude/{probeDirection}']
+            unitFilter[amplitudes < minimumResponseAmplitude] = False
 
         #
         if applyFilter:
-            self._units = self[unitFilter]
+            self._select(unitFilter)
 
         return unitFilter
 
@@ -742,12 +1039,11 @@ class Population():
         # Reset the list of units
         if reload:
             self.unfilter()
-        filtered = np.full(len(self._units), False)
 
         #
         if self.count() == 0:
             return
-        if self._units[0].session.probeTimestamps is None:
+        if self._session.probeTimestamps is None:
             return
 
         #
@@ -756,64 +1052,81 @@ class Population():
         else:
             probeDirections = ('left', 'right')
 
-        #
-        units = list()
-        for unitIndex, unit in enumerate(self._units):
-
-            # Filter out units with poor clustering quality metric scores
-            if presenceRatio is not None and unit.presenceRatio < presenceRatio:
-                continue
-            if refractoryPeriodViolationRate is not None and unit.refractoryPeriodViolationRate > refractoryPeriodViolationRate:
-                continue
-            if amplitudeCutoff is not None and unit.amplitudeCutoff > amplitudeCutoff:
-                continue
-
-
-            # Filter out units with no or weak visual responses
-            filtersPassed = False
-            for probeDirection in probeDirections:
-                if visualResponseProbability is not None and unit.visualResponseProbability[probeDirection] < visualResponseProbability:
-                    continue
-                if visualResponseAmplitude is not None and unit.visualResponseAmplitude[probeDirection] < visualResponseAmplitude:
-                    continue
-                filtersPassed = True
-            if filtersPassed == False:
-                continue
-
-            # Filter out units with peak responses that are too fast or too delayed
-            filterPassed = True
+        # Datasets required by the enabled filters must exist
+        required = list()
+        if presenceRatio is not None:
+            required.append(('population', 'metrics', 'pr'))
+        if refractoryPeriodViolationRate is not None:
+            required.append(('population', 'metrics', 'rpvr'))
+        if amplitudeCutoff is not None:
+            required.append(('population', 'metrics', 'ac'))
+        for probeDirection in probeDirections:
+            if visualResponseProbability is not None:
+                required.append(('population', 'zeta', 'probe', probeDirection, 'p'))
+            if visualResponseAmplitude is not None:
+                required.append(('population', 'metrics', 'vra', probeDirection))
+            if visualResponseLatencyRange is not None:
+                required.append(('population', 'metrics', 'rl', 'probe', probeDirection))
+        for key in required:
+            if self._datasets[key] is None:
+                raise Exception(f'Could not filter units ({"/".join(key)} dataset is missing)')
+
+        # NOTE: Comparisons with NaN are False, so NaN values never exclude a unit
+        metrics = self.metrics
+        filtered = self._selection.copy()
+
+        # Filter out units with poor clustering quality metric scores
+        if presenceRatio is not None:
+            filtered &= np.invert(metrics['presenceRatio'] < presenceRatio)
+        if refractoryPeriodViolationRate is not None:
+            filtered &= np.invert(metrics['refractoryPeriodViolationRate'] > refractoryPeriodViolationRate)
+        if amplitudeCutoff is not None:
+            filtered &= np.invert(metrics['amplitudeCutoff'] > amplitudeCutoff)
+
+        # Filter out units with no or weak visual responses (in every probe direction)
+        filtersPassed = np.full(filtered.size, False)
+        for probeDirection in probeDirections:
+            passed = np.full(filtered.size, True)
+            if visualResponseProbability is not None:
+                passed &= np.invert(metrics[f'visualResponseProbability/{probeDirection}'] < visualResponseProbability)
+            if visualResponseAmplitude is not None:
+                passed &= np.invert(metrics[f'visualResponseAmplitude/{probeDirection}'] < visualResponseAmplitude)
+            filtersPassed |= passed
+        filtered &= filtersPassed
+
+        # Filter out units with peak responses that are too fast or too delayed
+        if visualResponseLatencyRange is not None:
             for probeDirection in probeDirections:
-                if visualResponseLatencyRange is not None:
-                    if unit.visualResponseLatency[probeDirection] < visualResponseLatencyRange[0]:
-                        filterPassed = False
-                        break
-                    if unit.visualResponseLatency[probeDirection] > visualResponseLatencyRange[1]:
-                        filterPassed = False
-                        break
-            if filterPassed == False:
-                continue
-
-            #
-            if unit.timestamps.size < spikeCountMinimum:
-                continue
+                latencies = metrics[f'visualResponseLatency/{probeDirection}']
+                failed = np.logical_or(
+                    latencies < visualResponseLatencyRange[0],
+                    latencies > visualResponseLatencyRange[1]
+                )
+                if failed.ndim > 1:
+                    failed = failed.any(axis=tuple(range(1, failed.ndim)))
+                filtered &= np.invert(failed)
 
-            # All filters passed
-            units.append(unit)
-            filtered[unitIndex] = True
+        #
+        if spikeCountMinimum is not None:
+            filtered &= np.invert(metrics['spikeCount'] < spikeCountMinimum)
 
         #
         if returnMask:
-            return filtered
+            return filtered[self._selection]
         else:
-            self._units = units
+            self._select(filtered)
 
     def unfilter(
         self,
         ):
         """
+        Select all units (without reloading the single-unit data)
         """
 
-        self._loadSingleUnitData()
+        if self._allUnits is None:
+            self._loadSingleUnitData()
+        else:
+            self._select(np.full(len(self._allUnits), True))
 
         return
 
@@ -836,6 +1149,14 @@ class Population():
     def uniqueSpikeClusters(self):
         return self._uniqueSpikeClusters
 
+    @property
+    def spikeTimestampsByCluster(self):
+        return self._spikeTimestampsByCluster
+
+    @property
+    def spikeOffsets(self):
+        return self._spikeOffsets
+
     @property
     def datasets(self):
         return self._datasets
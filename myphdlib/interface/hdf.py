@@ -0,0 +1,464 @@
+import h5py
+import numpy as np
+import pathlib as pl
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Open handles shared by every manager in this process (keyed by filename)
+_handles = dict()
+
+class DatasetProxy():
+    """
+    Sliceable reference to a dataset which only reads the requested hyperslab
+
+    Usage
+    -----
+    M = session.load('labjack/matrix', lazy=True)
+    signal = M[:, 5]
+    """
+
+    def __init__(self, manager, path):
+        """
+        """
+
+        self._manager = manager
+        self._path = path
+        dataset = self._dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+
+        return
+
+    @property
+    def _dataset(self):
+        return self._manager.reader()[self._path]
+
+    @property
+    def attrs(self):
+        return dict(self._dataset.attrs)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        value = self._dataset[key]
+        self._manager.bytesRead += np.asarray(value).nbytes
+        return value
+
+    def __array__(self, dtype=None, copy=None):
+        value = self[()]
+        if dtype is not None:
+            value = value.astype(dtype)
+        return value
+
+class FileHandleManager():
+    """
+    Keeps a single handle to an hdf file open between reads
+
+    A read-only handle is opened on demand and upgraded to a read/write
+    handle only when something needs to be written. The writer is closed
+    again after each write unless the write happens inside of a batch.
+    Loaded datasets can optionally be kept in an LRU cache (keyed by path)
+    which is invalidated whenever the path is saved or removed.
+    """
+
+    def __init__(self, filename, cacheSize=0):
+        """
+        """
+
+        self._filename = pl.Path(filename)
+        self._cache = OrderedDict()
+        self._cacheSize = cacheSize
+
+        #
+        self.hits = 0
+        self.misses = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+
+        return
+
+    def __getstate__(self):
+        """
+        Cached data is not transferred when pickled
+        """
+
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+
+        return state
+
+    @property
+    def _entry(self):
+        """
+        Shared handle for this file
+        """
+
+        key = str(self._filename)
+        if key not in _handles:
+            _handles[key] = {'handle': None, 'mode': None, 'depth': 0, 'manifest': None}
+
+        return _handles[key]
+
+    def _normalize(self, path):
+        """
+        """
+
+        return path.strip('/')
+
+    def _open(self, mode):
+        """
+        """
+
+        # The writer can also be used for reading
+        entry = self._entry
+        if entry['handle'] is not None:
+            if entry['handle'].id.valid == False:
+                entry['handle'] = None
+                entry['mode'] = None
+            elif mode == 'r' or entry['mode'] == 'a':
+                return entry['handle']
+            else:
+                self.close()
+
+        #
+        if mode == 'r' and self._filename.exists() == False:
+            raise Exception(f'Output file does not exist')
+        entry['handle'] = h5py.File(str(self._filename), mode)
+        entry['mode'] = mode
+
+        return entry['handle']
+
+    def reader(self):
+        """
+        Return an open (read-only) handle
+        """
+
+        return self._open('r')
+
+    def writer(self):
+        """
+        Return an open (read/write) handle, creating the file if necessary
+        """
+
+        return self._open('a')
+
+    def release(self):
+        """
+        Close the writer unless a batch of writes is in progress
+        """
+
+        entry = self._entry
+        if entry['depth'] == 0 and entry['mode'] == 'a':
+            self.close()
+
+        return
+
+    def close(self):
+        """
+        Close the open handle (if any)
+        """
+
+        entry = self._entry
+        if entry['handle'] is not None:
+            if entry['handle'].id.valid:
+                entry['handle'].close()
+            entry['handle'] = None
+            entry['mode'] = None
+
+        return
+
+    @staticmethod
+    def closeAll():
+        """
+        Close every handle opened in this process (e.g., before forking worker processes)
+        """
+
+        for entry in _handles.values():
+            if entry['handle'] is not None and entry['handle'].id.valid:
+                entry['handle'].close()
+            entry['handle'] = None
+            entry['mode'] = None
+
+        return
+
+    @contextmanager
+    def batch(self):
+        """
+        Keep the writer open across many writes
+        """
+
+        entry = self._entry
+        entry['depth'] += 1
+        try:
+            yield self.writer()
+        finally:
+            entry['depth'] -= 1
+            if entry['depth'] == 0:
+                entry['manifest'] = None # Direct writes to the handle are not tracked
+            self.release()
+
+        return
+
+    def refresh(self):
+        """
+        Reopen the file and rebuild the manifest (e.g., after another process wrote to it)
+        """
+
+        if self._entry['depth'] == 0:
+            self.close()
+        self._entry['manifest'] = None
+        self.invalidate()
+
+        return
+
+    def manifest(self):
+        """
+        Return a dictionary which maps each dataset path to its shape, dtype, and attributes
+
+        The manifest is built with a single visit of the file and kept up to
+        date by save and remove
+        """
+
+        entry = self._entry
+        if entry['manifest'] is None:
+            datasets, groups = dict(), set([''])
+            if self._filename.exists():
+                def visitor(name, obj):
+                    if type(obj) == h5py.Dataset:
+                        datasets[name] = {
+                            'shape': obj.shape,
+                            'dtype': obj.dtype,
+                            'attrs': dict(obj.attrs)
+                        }
+                    else:
+                        groups.add(name)
+                    return
+                self.reader().visititems(visitor)
+            entry['manifest'] = (datasets, groups)
+
+        return entry['manifest'][0]
+
+    def _groups(self):
+        """
+        """
+
+        self.manifest()
+
+        return self._entry['manifest'][1]
+
+    def _updateManifest(self, key, dataset=None):
+        """
+        Remove a path (and anything below it) from the manifest and optionally add a new dataset
+        """
+
+        entry = self._entry
+        if entry['manifest'] is None:
+            return
+        datasets, groups = entry['manifest']
+
+        #
+        for path in list(datasets.keys()):
+            if path == key or path.startswith(key + '/'):
+                del datasets[path]
+        for path in list(groups):
+            if path == key or path.startswith(key + '/'):
+                groups.remove(path)
+
+        #
+        if dataset is not None:
+            datasets[key] = {
+                'shape': dataset.shape,
+                'dtype': dataset.dtype,
+                'attrs': dict(dataset.attrs)
+            }
+            parts = key.split('/')
+            for i in range(1, len(parts)):
+                groups.add('/'.join(parts[:i]))
+
+        return
+
+    @property
+    def cacheSize(self):
+        return self._cacheSize
+
+    @cacheSize.setter
+    def cacheSize(self, value):
+        self._cacheSize = value
+        while len(self._cache) > self._cacheSize:
+            self._cache.popitem(last=False)
+        return
+
+    def invalidate(self, path=None):
+        """
+        Drop a path (and anything below it) from the cache
+        """
+
+        if path is None:
+            self._cache.clear()
+            return
+
+        path = self._normalize(path)
+        for key in list(self._cache.keys()):
+            if key == path or key.startswith(path + '/') or path == '':
+                del self._cache[key]
+
+        return
+
+    def has(self, path):
+        """
+        """
+
+        if self._filename.exists() == False:
+            return False
+        key = self._normalize(path)
+
+        return key in self.manifest() or key in self._groups()
+
+    def load(self, path, returnMetadata=False, lazy=False):
+        """
+        """
+
+        key = self._normalize(path)
+        if key in self._cache and lazy == False:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            value, attrs = self._cache[key]
+            if returnMetadata:
+                return value.copy(), dict(attrs)
+            else:
+                return value.copy()
+
+        #
+        file = self.reader()
+        try:
+            obj = file[key]
+        except KeyError:
+            obj = None
+
+        #
+        if type(obj) == h5py.Dataset and lazy:
+            proxy = DatasetProxy(self, key)
+            if returnMetadata:
+                return proxy, dict(obj.attrs)
+            else:
+                return proxy
+        elif type(obj) == h5py.Dataset:
+            value, attrs = np.array(obj), dict(obj.attrs)
+            self.misses += 1
+            self.bytesRead += value.nbytes
+            if self._cacheSize > 0:
+                self._cache[key] = (value.copy(), attrs)
+                while len(self._cache) > self._cacheSize:
+                    self._cache.popitem(last=False)
+            if returnMetadata:
+                return value, dict(attrs)
+            else:
+                return value
+        elif type(obj) == h5py.Group:
+            return obj
+
+        if returnMetadata:
+            return None, {}
+        else:
+            return None
+
+    def save(self, path, value, overwrite=True, metadata={}, chunks=None, compression=None):
+        """
+        """
+
+        key = self._normalize(path)
+        file = self.writer()
+        try:
+
+            #
+            if key in file:
+                if overwrite:
+                    del file[key]
+                else:
+                    raise Exception(f'{path} dataset already exists')
+
+            #
+            dataset = file.create_dataset(
+                key,
+                value.shape,
+                value.dtype,
+                data=value,
+                chunks=chunks,
+                compression=compression
+            )
+            if len(metadata) != 0 and type(metadata) == dict:
+                for k in metadata.keys():
+                    dataset.attrs[k] = metadata[k]
+            self.bytesWritten += value.nbytes
+            self._updateManifest(key, dataset)
+
+        except Exception:
+            self._entry['manifest'] = None
+            raise
+
+        finally:
+            self.invalidate(key)
+            self.release()
+
+        return
+
+    def setAttributes(self, path, attrs):
+        """
+        Set attributes of an existing dataset without rewriting its data
+        """
+
+        key = self._normalize(path)
+        file = self.writer()
+        try:
+            if key not in file:
+                raise Exception(f'{path} does not exist')
+            obj = file[key]
+            for k, v in attrs.items():
+                obj.attrs[k] = v
+            if type(obj) == h5py.Dataset:
+                self._updateManifest(key, obj)
+        finally:
+            self.invalidate(key)
+            self.release()
+
+        return
+
+    def remove(self, path):
+        """
+        """
+
+        key = self._normalize(path)
+        file = self.writer()
+        try:
+            if key in file:
+                del file[key]
+            self._updateManifest(key)
+        finally:
+            self.invalidate(key)
+            self.release()
+
+        return
+
+    def statistics(self):
+        """
+        Return the cache and I/O counters
+        """
+
+        statistics = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytesRead': self.bytesRead,
+            'bytesWritten': self.bytesWritten,
+            'cached': len(self._cache),
+        }
+
+        return statistics
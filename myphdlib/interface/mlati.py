@@ -29,7 +29,7 @@ class StimuliProcessingMixinMlati(StimuliProcessingMixin):
 
         #
         if xData is None:
-            M = self.load('labjack/matrix')
+            M = self.load('labjack/matrix', lazy=True)
             lightSensorSignal = M[:, self.labjackChannelMapping['stimulus']]
             xData = np.around(placeVerticalLines(lightSensorSignal), 0).astype(int)
         
@@ -171,7 +171,7 @@ class StimuliProcessingMixinMlati(StimuliProcessingMixin):
             }
 
             # Extract raw signal
-            M = self.load('labjack/matrix')
+            M = self.load('labjack/matrix', lazy=True)
             start, stop = self.load(f'epochs/sn/{block}')
             signal = M[start: stop, self.labjackChannelMapping['stimulus']]
 
@@ -394,7 +394,7 @@ class StimuliProcessingMixinMlati(StimuliProcessingMixin):
         }
 
         # Load labjack data
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
 
         #
         iterable = zip(
@@ -567,7 +567,7 @@ class StimuliProcessingMixinMlati(StimuliProcessingMixin):
             return
 
         #
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
         start, stop = self.load('epochs/fs')
         signal = M[start: stop, self.labjackChannelMapping['stimulus']]
 
@@ -830,7 +830,7 @@ class StimuliProcessingMixinMlati(StimuliProcessingMixin):
                 trialParameters[key].append(value)
 
         # Load the labjack data
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
         start, stop = self.load('epochs/dg')
         signal = M[start: stop, self.labjackChannelMapping['stimulus']]
 
@@ -95,6 +95,9 @@ class EventsProcessingMixinMuscimol(EventsProcessingMixin):
     def _estimateTimestampingFunction(self):
         return
 
+    def _estimateClockModel(self):
+        return
+
     def _computeRelativeEventTiming(self):
         return
 
@@ -142,7 +145,7 @@ class StimuliProcessingMixinMuscimol(StimuliProcessingMixin):
 
         #
         if xData is None:
-            M = self.load('labjack/matrix')
+            M = self.load('labjack/matrix', lazy=True)
             lightSensorSignal = M[:, self.labjackChannelMapping['stimulus']]
             xData = np.array([
                 np.where(np.diff(lightSensorSignal) > 0.5)[0][0] - bufferInSamples,
@@ -196,7 +199,7 @@ class StimuliProcessingMixinMuscimol(StimuliProcessingMixin):
             gratingMotionByBlock = gratingMotionDuringEvents[::2]
 
             # 
-            M = self.load('labjack/matrix')
+            M = self.load('labjack/matrix', lazy=True)
             signal = M[:, self.labjackChannelMapping['stimulus']]
             filtered = filterPulsesFromPhotologicDevice(signal)
             eventIndices = np.where(
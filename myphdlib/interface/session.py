@@ -7,6 +7,7 @@ from datetime import date
 from types import SimpleNamespace
 from scipy.interpolate import interp1d as interp
 from myphdlib.interface.ephys import Population
+from myphdlib.interface.hdf import FileHandleManager
 
 class SessionBase():
     """
@@ -30,6 +31,8 @@ class SessionBase():
         self._eye = eye
         self._folders = None
         self._labjackSamplingRate = None
+        self._referenceSampleNumber = None
+        self._clock = None
         self._population = None
         self._probeTimestamps = None
         self._probeLatencies = None
@@ -44,6 +47,7 @@ class SessionBase():
         self._tRange = None
         self._barcodeValues = None
         self._barcodeTimestamps = None
+        self._store = None
 
         #
         self._loadBasicMetadata()
@@ -173,56 +177,24 @@ class SessionBase():
                 line = f'{key_}: {value_}\n'
                 stream.write(line)
     
-    def load(self, path, returnMetadata=False):
+    def load(self, path, returnMetadata=False, lazy=False):
         """
+        Load a dataset from the output file
+
+        If lazy is True a sliceable proxy is returned instead of an array
+        and only the requested hyperslab is read, e.g., M[:, channelIndex]
         """
 
         if self.hdf.exists() == False:
             raise Exception(f'Output file does not exist')
-        
-        obj = None
-        with h5py.File(str(self.hdf), 'r') as file:
-            try:
-                obj = file[path]
-                if type(obj) == h5py.Dataset:
-                    if returnMetadata:
-                        return np.array(obj), dict(obj.attrs)
-                    else:
-                        return np.array(obj)
-                elif type(obj) == h5py.Group:
-                    return obj
-            except KeyError:
-                pass
-
-        if returnMetadata:
-            return None, {}
-        else:
-            return None
+
+        return self.store.load(path, returnMetadata, lazy)
     
-    def save(self, path, value, overwrite=True, metadata={}):
+    def save(self, path, value, overwrite=True, metadata={}, chunks=None, compression=None):
         """
         """
 
-        if self.hdf.exists() == False:
-            file = h5py.File(str(self.hdf), 'w')
-        else:
-            file = h5py.File(str(self.hdf), 'a')
-        
-        #
-        if path in file.keys():
-            if overwrite:
-                del file[path]
-            else:
-                raise Exception(f'{path} dataset already exists')
-        
-        #
-        dataset = file.create_dataset(path, value.shape, value.dtype, data=value)
-        if len(metadata) != 0 and type(metadata) == dict:
-            for k in metadata.keys():
-                dataset.attrs[k] = metadata[k]
-
-        #
-        file.close()        
+        self.store.save(path, value, overwrite, metadata, chunks, compression)
 
         return
     
@@ -234,9 +206,47 @@ class SessionBase():
         if self.hdf.exists() == False:
             raise Exception('Output file does not exists')
         
-        with h5py.File(str(self.hdf), 'a') as file:
-            if path in file.keys():
-                del file[path]
+        self.store.remove(path)
+
+        return
+
+    def batch(self):
+        """
+        Context manager which keeps the output file open for writing
+
+        Usage
+        -----
+        with session.batch() as file:
+            session.save(...)
+            session.save(...)
+        """
+
+        return self.store.batch()
+
+    def enableCache(self, cacheSize=128):
+        """
+        Keep up to N recently loaded datasets in memory
+        """
+
+        self.store.cacheSize = cacheSize
+
+        return
+
+    def disableCache(self):
+        """
+        """
+
+        self.store.cacheSize = 0
+
+        return
+
+    def close(self):
+        """
+        Close any open handle to the output file
+        """
+
+        if self._store is not None:
+            self._store.close()
 
         return
     
@@ -255,15 +265,7 @@ class SessionBase():
         """
         """
 
-        pathsInFile = list()
-        with h5py.File(self.hdf, 'r') as file:
-            file.visit(lambda name: pathsInFile.append(name))
-
-        datasetsInFile = list()
-        with h5py.File(self.hdf, 'r') as file:
-            for path in pathsInFile:
-                if type(file[path]) == h5py.Dataset:
-                    datasetsInFile.append(path)
+        datasetsInFile = list(self.store.manifest().keys())
 
         #
         for path in datasetsInFile:
@@ -283,13 +285,26 @@ class SessionBase():
         outputFile = self.home.joinpath('output.hdf')
         if outputFile.exists() and overwrite == False:
             return
+        self.close()
         with h5py.File(str(outputFile), 'w') as file:
             pass
+        self.store.refresh()
 
         return
 
     @property
     def hdf(self): return self.home.joinpath('output.hdf')
+
+    @property
+    def store(self):
+        """
+        Handle manager for the output file
+        """
+
+        if self._store is None:
+            self._store = FileHandleManager(self.hdf)
+
+        return self._store
     
     @property
     def leftCameraMovie(self): return
@@ -429,11 +444,34 @@ class SessionBase():
 
         return self._tRange
     
+    def _loadClockAttribute(self, key):
+        """
+        Look up a value stored with the clock alignment model (if any)
+        """
+
+        entry = self.store.manifest().get('clock/knots')
+        if entry is None or key not in entry['attrs']:
+            return None
+
+        return entry['attrs'][key].item()
+
     @property
     def referenceSampleNumber(self):
         """
         """
 
+        if self._referenceSampleNumber is None:
+            self._referenceSampleNumber = self._loadClockAttribute('referenceSampleNumber')
+        if self._referenceSampleNumber is None:
+            self._referenceSampleNumber = self._readReferenceSampleNumber()
+
+        return self._referenceSampleNumber
+
+    def _readReferenceSampleNumber(self):
+        """
+        Parse the first sample number of the recording from the sync messages file
+        """
+
         file = self.folders.ephys.joinpath('sync_messages.txt')
         if file.exists() == False:
             raise Exception('Could not locate the ephys sync messages file')
@@ -521,6 +559,78 @@ class SessionBase():
             self._barcodeTimestamps['neuropixels'] = self.load('barcodes/neuropixels/indices')
         return self._barcodeTimestamps
 
+    def _computeClockModel(self):
+        """
+        Fit a piecewise-linear model which maps labjack sample indices to
+        Neuropixels sample indices (relative to the first sample of the
+        recording) using the barcodes shared by both devices
+
+        returns
+        -------
+        model
+            Dictionary with the knot points (N x 2), the slope of each
+            segment (N - 1), and the residual of each knot with respect to
+            the line through the first and last knots (in samples)
+        """
+
+        # Barcodes might not have been decoded (e.g., sessions without a labjack data matrix)
+        barcodesMissing = any([
+            value is None
+                for value in list(self.barcodeValues.values()) + list(self.barcodeTimestamps.values())
+        ])
+        if barcodesMissing:
+            x = np.zeros(0)
+        else:
+            barcodeValuesCommon, barcodeIndicesLabjack, barcodeIndicesNeuropixels = np.intersect1d(
+                self.barcodeValues['labjack'], self.barcodeValues['neuropixels'], return_indices=True
+            )
+            x = self.barcodeTimestamps['labjack'][barcodeIndicesLabjack].astype(np.float64)
+            y = self.barcodeTimestamps['neuropixels'][barcodeIndicesNeuropixels].astype(np.float64)
+
+        # No shared barcodes (e.g., sessions without an ephys recording)
+        if x.size == 0:
+            model = {
+                'knots': np.zeros([0, 2]),
+                'slopes': np.zeros(0),
+                'residuals': np.zeros(0),
+            }
+            return model
+
+        #
+        y -= self.referenceSampleNumber
+        index = np.argsort(x, kind='stable')
+        x, y = x[index], y[index]
+        slopes = np.diff(y) / np.diff(x)
+        if x.size > 1:
+            m = (y[-1] - y[0]) / (x[-1] - x[0])
+            residuals = y - (y[0] + (x - x[0]) * m)
+        else:
+            residuals = np.zeros(1)
+        model = {
+            'knots': np.vstack([x, y]).T,
+            'slopes': slopes,
+            'residuals': residuals,
+        }
+
+        return model
+
+    @property
+    def clock(self):
+        """
+        Clock alignment model (loaded from the output file if it was saved)
+        """
+
+        if self._clock is None:
+            if self.hasDataset('clock/knots'):
+                self._clock = {
+                    key: self.load(f'clock/{key}')
+                        for key in ('knots', 'slopes', 'residuals')
+                }
+            else:
+                self._clock = self._computeClockModel()
+
+        return self._clock
+
     def computeTimestamps(
         self,
         eventIndices,
@@ -529,42 +639,35 @@ class SessionBase():
         returnSampleIndices=False
         ):
         """
+        Convert labjack sample indices to timestamps in the ephys recording
         """
         
         #
-        eventIndices = np.atleast_1d(eventIndices)
+        eventIndices = np.atleast_1d(eventIndices).astype(np.float64)
         eventMask = np.invert(np.isnan(eventIndices))
         eventTimestamps = np.full(eventIndices.size, np.nan)
 
-        barcodeValuesCommon, barcodeIndicesLabjack, barcodeIndicesNeuropixels = np.intersect1d(
-            self.barcodeValues['labjack'], self.barcodeValues['neuropixels'], return_indices=True
-        )
-
-        barcodeTimestampsLabjack = self.barcodeTimestamps['labjack'][barcodeIndicesLabjack]
-        barcodeTimestampsNeuropixels = self.barcodeTimestamps['neuropixels'][barcodeIndicesNeuropixels]
-        
         #
-        if useInterpolation:
-            f = interp(
-                barcodeTimestampsLabjack,
-                barcodeTimestampsNeuropixels - self.referenceSampleNumber,
-                fill_value='extrapolate'
-            )
-            try:
-                eventTimestamps[eventMask] = np.around(f(eventIndices[eventMask]), 0)
-            except:
-                import pdb; pdb.set_trace()
+        knots = self.clock['knots']
+        if knots.shape[0] < 2:
+            raise Exception('At least 2 barcodes shared by the labjack and Neuropixels are required for timestamping')
+        x, y = knots[:, 0], knots[:, 1]
+        x_ = eventIndices[eventMask]
 
-        #
+        # Piecewise-linear interpolation (extrapolated from the first and last segments)
+        if useInterpolation:
+            slopes = self.clock['slopes']
+            t = np.interp(x_, x, y)
+            leftMask = x_ < x[0]
+            t[leftMask] = y[0] + (x_[leftMask] - x[0]) * slopes[0]
+            rightMask = x_ > x[-1]
+            t[rightMask] = y[-1] + (x_[rightMask] - x[-1]) * slopes[-1]
+
+        # Line through the first and last knots
         else:
-            m = (barcodeTimestampsNeuropixels[-1] - barcodeTimestampsNeuropixels[0]) / \
-                (barcodeTimestampsLabjack[-1] - barcodeTimestampsLabjack[0])
-            b = barcodeTimestampsNeuropixels[0] - barcodeTimestampsLabjack[0] * m
-            t = np.around(
-                (eventIndices[eventMask] * m + b) - self.referenceSampleNumber,
-                0
-            )
-            eventTimestamps[eventMask] = t
+            m = (y[-1] - y[0]) / (x[-1] - x[0])
+            t = y[0] + (x_ - x[0]) * m
+        eventTimestamps[eventMask] = np.around(t, 0)
 
         #
         if returnSampleIndices:
@@ -614,6 +717,18 @@ class SessionBase():
         """
         """
 
+        if self._labjackSamplingRate is None:
+            self._labjackSamplingRate = self._loadClockAttribute('labjackSamplingRate')
+        if self._labjackSamplingRate is None:
+            self._labjackSamplingRate = self._readLabjackSamplingRate()
+
+        return self._labjackSamplingRate
+
+    def _readLabjackSamplingRate(self):
+        """
+        Determine the sampling rate from the first labjack data file
+        """
+
         files = [
             file for file in pl.Path(self.folders.labjack).iterdir()
                 if file.suffix == '.dat'
@@ -641,14 +756,8 @@ class SessionBase():
 
         if self.hdf.exists() == False:
             return False
-        
 
-        with h5py.File(self.hdf, 'r') as file:
-            try:
-                dataset = file[path]
-                return True
-            except KeyError:
-                return False
+        return self.store.has(path)
 
     def hasTrainingDataForSaccadeClassification(
         self,
@@ -3,6 +3,12 @@ from joblib import Parallel, delayed
 from myphdlib.general.toolkit import psth2
 # from myphdlib.pipeline.main import ModuleBase
 import numpy as np
+import pathlib as pl
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import nullcontext
 
 # TODO
 # [ ] Recompute the visual response amplitudes and compute respone amplitudes to saccades
@@ -10,31 +16,44 @@ import numpy as np
 # [ ] Measure baseline activity? Maybe don't do this yet
 
 def _runZetaTestForBatch(
-    units,
+    spikeTimestamps,
+    spikeSlices,
+    unitIndices,
     eventTimestamps,
     responseWindow,
     latencyMetric='peak',
     minimumSpikeCount=100,
-    iBatch=0,
-    nBatches=0,
     ):
     """
+    Run the ZETA test for a batch of units
+
+    keywords
+    --------
+    spikeTimestamps
+        Spike timestamps sorted by unit (or the path to a .npy file which
+        stores them and is memory-mapped by the worker)
+    spikeSlices
+        Offset and length of the spike train of each unit (N units x 2)
+    unitIndices
+        Index of each unit in the population
     """
 
-    units[0].session.log(f'Running batch ZETA test ({iBatch + 1} out of {nBatches})')
+    #
+    if type(spikeTimestamps) == str:
+        spikeTimestamps = np.load(spikeTimestamps, mmap_mode='r')
 
     #
     tOffset = 0 - responseWindow[0]
     responseWindowAdjusted = np.array(responseWindow) + tOffset
 
     #
-    result = np.full([len(units), 3], np.nan)
-    for i, unit in enumerate(units):
-        if unit.timestamps.size < minimumSpikeCount:
+    result = np.full([len(unitIndices), 3], np.nan)
+    for i, (unitIndex, (offset, length)) in enumerate(zip(unitIndices, spikeSlices)):
+        if length < minimumSpikeCount:
             p, tLatency = np.nan, np.nan
         else:
             p, dZeta, dRate = zetatest(
-                unit.timestamps,
+                np.array(spikeTimestamps[offset: offset + length]),
                 eventTimestamps - tOffset,
                 dblUseMaxDur=np.max(responseWindowAdjusted),
                 tplRestrictRange=responseWindowAdjusted,
@@ -46,7 +65,7 @@ def _runZetaTestForBatch(
                 tLatency = dZeta['vecLatencies'][2].item() - tOffset
             else:
                 tLatency = np.nan
-        result[i, :] = np.array([unit.index, p, tLatency])
+        result[i, :] = np.array([unitIndex, p, tLatency])
 
     return result
 
@@ -61,9 +80,18 @@ class ActivityProcessingMixin(object):
         nUnitsPerBatch=10,
         latencyMetric='peak',
         minimumSpikeCount=100,
-        overwrite=False
+        overwrite=False,
+        restart=False,
+        nBatchesPerCheckpoint=None,
         ):
         """
+        Run the ZETA test for every unit and each probe/saccade condition
+
+        Results are checkpointed to scratch/zeta/<event>/<direction> after
+        each round of batches, and an interrupted run resumes with the units
+        which have not been tested yet (unless restart is True). The
+        checkpoints are merged into zeta/<event>/<direction>/p|latency once
+        every unit has been tested.
         """
 
         eventNames = (
@@ -96,64 +124,215 @@ class ActivityProcessingMixin(object):
             self.saccadeTimestamps[self.saccadeLabels == -1, 0]
         )
 
-        #
+        # Collect the conditions which need to be tested
+        conditions = list()
         for ev, n, d in zip(eventTimestamps, eventNames, eventDirections):
-
-            # Check if dataset already exists
             if self.hasDataset(f'zeta/{n}/{d}/p') and overwrite == False:
                 self.log(f'Skipping ZETA test for activity related to {n}s (direction={d}, window=[{responseWindow[0]}, {responseWindow[1]}] sec)', level='info')
                 continue
+            conditions.append((np.array(ev), n, d))
+        if len(conditions) == 0:
+            return
+
+        # Workers only receive the offset and length of each unit's spike train
+        units = list(self.population)
+        unitIndices = np.array([unit.index for unit in units], dtype=int)
+        spikeOffsets = self.population.spikeOffsets
+        spikeSlices = np.vstack([
+            spikeOffsets[unitIndices],
+            spikeOffsets[unitIndices + 1] - spikeOffsets[unitIndices]
+        ]).T if len(units) != 0 else np.zeros([0, 2], dtype=int)
+        if nBatchesPerCheckpoint is None:
+            nBatchesPerCheckpoint = os.cpu_count() if parallelize else 1
+
+        # Publish the spike timestamps once (workers memory-map the file)
+        with tempfile.TemporaryDirectory() as folder:
+            spikeTimestamps = self.population.spikeTimestampsByCluster
+            if parallelize and len(units) != 0:
+                if isinstance(spikeTimestamps, np.memmap):
+                    spikeTimestamps = str(spikeTimestamps.filename)
+                else:
+                    filename = pl.Path(folder).joinpath('spikes.npy')
+                    np.save(filename, spikeTimestamps)
+                    spikeTimestamps = str(filename)
+
+            # The same pool of workers is used for every condition
+            with Parallel(n_jobs=-1) if parallelize else nullcontext() as parallel:
+                for ev, n, d in conditions:
+
+                    # Resume from the checkpoint (if any)
+                    settings = {
+                        'responseWindow': list(responseWindow),
+                        'latencyMetric': latencyMetric,
+                        'minimumSpikeCount': minimumSpikeCount,
+                        'events': hashlib.sha1(np.ascontiguousarray(ev, dtype=np.float64)).hexdigest(),
+                    }
+                    checkpoint = self._loadZetaCheckpoint(n, d, settings, restart)
+                    unitMask = np.invert(np.isin(unitIndices, checkpoint[:, 0]))
+                    batches = [
+                        (spikeSlices[unitMask][i: i + nUnitsPerBatch], unitIndices[unitMask][i: i + nUnitsPerBatch])
+                            for i in range(0, unitMask.sum(), nUnitsPerBatch)
+                    ]
+                    nBatches = len(batches)
+
+                    #
+                    if unitMask.sum() != unitMask.size:
+                        self.log(f'Resuming ZETA test for activity related to {n}s (direction={d}, {unitMask.size - unitMask.sum()} out of {unitMask.size} units already tested)', level='info')
+                    else:
+                        self.log(f'Running ZETA test for activity related to {n}s (direction={d}, window=[{responseWindow[0]}, {responseWindow[1]}] sec, {nBatches} batches)', level='info')
+
+                    # Process batches in rounds and checkpoint the results after each round
+                    for start in range(0, nBatches, nBatchesPerCheckpoint):
+                        batchesInRound = batches[start: start + nBatchesPerCheckpoint]
+
+                        # Parallel processsing
+                        if parallelize:
+                            results = parallel(delayed(_runZetaTestForBatch)(
+                                spikeTimestamps,
+                                batchSlices,
+                                batchIndices,
+                                ev,
+                                responseWindow,
+                                latencyMetric,
+                                minimumSpikeCount,
+                                )
+                                    for batchSlices, batchIndices in batchesInRound
+                            )
 
-            #
-            self.log(f'Running ZETA test for activity related to {n}s (direction={d}, window=[{responseWindow[0]}, {responseWindow[1]}] sec)', level='info')
-
-            # Create batches of units
-            batches = [
-                self.population[i:i + nUnitsPerBatch]
-                    for i in range(0, len(self.population), nUnitsPerBatch)
-            ]
-            nBatches = len(batches)
-
-            # Parallel processsing
-            if parallelize:
-                results = Parallel(n_jobs=-1)(delayed(_runZetaTestForBatch)(
-                    batch,
-                    ev,
-                    responseWindow,
-                    latencyMetric,
-                    minimumSpikeCount,
-                    iBatch,
-                    nBatches
-                    )
-                        for iBatch, batch in enumerate(batches)
+                        # Serial processing
+                        else:
+                            results = list()
+                            for batchSlices, batchIndices in batchesInRound:
+                                result = _runZetaTestForBatch(
+                                    spikeTimestamps,
+                                    batchSlices,
+                                    batchIndices,
+                                    ev,
+                                    responseWindow=responseWindow,
+                                    latencyMetric=latencyMetric,
+                                    minimumSpikeCount=minimumSpikeCount,
+                                )
+                                results.append(result)
+
+                        #
+                        self._checkpointZetaResults(n, d, np.vstack(results))
+                        self.log(f'{min(start + nBatchesPerCheckpoint, nBatches)} out of {nBatches} batches complete', level='info')
+
+                    # Save p-values and latencies
+                    self._mergeZetaCheckpoint(n, d, unitIndices)
+
+        return
+
+    def _loadZetaCheckpoint(
+        self,
+        eventName,
+        eventDirection,
+        settings,
+        restart=False,
+        ):
+        """
+        Return the checkpointed results (unit index, p-value, latency) for a condition
+
+        The checkpoint is discarded if it was created with different settings
+        """
+
+        path = f'scratch/zeta/{eventName}/{eventDirection}'
+        settings = json.dumps(settings, sort_keys=True)
+        self.store.invalidate(path)
+        with self.batch() as stream:
+            if path in stream:
+                if restart or stream[path].attrs.get('settings') != settings:
+                    del stream[path]
+            if path not in stream:
+                dataset = stream.create_dataset(
+                    path,
+                    shape=(0, 3),
+                    maxshape=(None, 3),
+                    dtype=np.float64,
                 )
+                dataset.attrs['settings'] = settings
+            checkpoint = np.array(stream[path])
 
-            # Serial processing
-            else:
-                results = list()
-                for iBatch, batch in enumerate(batches):
-                    result = _runZetaTestForBatch(
-                        batch,
-                        ev,
-                        responseWindow=responseWindow,
-                        latencyMetric=latencyMetric,
-                        minimumSpikeCount=minimumSpikeCount,
-                        iBatch=iBatch,
-                        nBatches=nBatches
-                    )
-                    results.append(result)
-
-            # Stack and sort the results
-            results = np.vstack([result for result in results])
-            unitIndices = results[:, 0]
-            results = results[np.argsort(unitIndices), :]
-
-            # Save p-values and latencies
-            self.save(f'zeta/{n}/{d}/p', results[:, 1])
-            self.save(f'zeta/{n}/{d}/latency', results[:, 2])
+        return checkpoint
+
+    def _checkpointZetaResults(
+        self,
+        eventName,
+        eventDirection,
+        results,
+        ):
+        """
+        Append results (unit index, p-value, latency) to the checkpoint for a condition
+        """
+
+        path = f'scratch/zeta/{eventName}/{eventDirection}'
+        self.store.invalidate(path)
+        with self.batch() as stream:
+            dataset = stream[path]
+            nRows = dataset.shape[0]
+            dataset.resize(nRows + results.shape[0], axis=0)
+            dataset[nRows:, :] = results
+            stream.flush()
 
         return
 
+    def _mergeZetaCheckpoint(
+        self,
+        eventName,
+        eventDirection,
+        unitIndices,
+        ):
+        """
+        Save the checkpointed results to zeta/<event>/<direction> and delete the checkpoint
+        """
+
+        path = f'scratch/zeta/{eventName}/{eventDirection}'
+        checkpoint = self.load(path)
+
+        # Keep one row per unit (sorted by unit index)
+        checkpoint = checkpoint[np.isin(checkpoint[:, 0], unitIndices)]
+        uniqueUnitIndices, rowIndices = np.unique(checkpoint[::-1, 0], return_index=True)
+        results = checkpoint[::-1][rowIndices]
+        self.save(f'zeta/{eventName}/{eventDirection}/p', results[:, 1])
+        self.save(f'zeta/{eventName}/{eventDirection}/latency', results[:, 2])
+
+        #
+        self.remove(path)
+        if len([key for key in self.store.manifest().keys() if key.startswith('scratch/')]) == 0:
+            self.remove('scratch')
+
+        return
+
+    def _queryZetaTestStatus(
+        self,
+        ):
+        """
+        Report the progress of the ZETA test for each condition
+        """
+
+        nUnits = len(self.population)
+        unitIndices = np.array([unit.index for unit in self.population], dtype=int)
+        status = dict()
+        for n, d in (('probe', 'left'), ('probe', 'right'), ('saccade', 'nasal'), ('saccade', 'temporal')):
+            if self.hasDataset(f'scratch/zeta/{n}/{d}'):
+                checkpoint = self.load(f'scratch/zeta/{n}/{d}')
+                nTested = int(np.isin(unitIndices, checkpoint[:, 0]).sum())
+                state = 'in progress'
+            elif self.hasDataset(f'zeta/{n}/{d}/p'):
+                nTested = nUnits
+                state = 'complete'
+            else:
+                nTested = 0
+                state = 'not started'
+            status[f'{n}/{d}'] = {
+                'state': state,
+                'tested': nTested,
+                'total': nUnits,
+            }
+            self.log(f'ZETA test for {n}s (direction={d}): {state} ({nTested} out of {nUnits} units)', level='info')
+
+        return status
+
     def _runActivityModule(
         self,
         zeta=False,
@@ -163,8 +342,11 @@ class ActivityProcessingMixin(object):
         """
         """
 
+        # NOTE: Conditions which are already complete are skipped and interrupted conditions are resumed
         if zeta:
-            if self.hasDataset('zeta/probe/left/p') == False or redo:
-                self._runZetaTests(overwrite=True, parallelize=parallelize)
+            conditions = ('probe/left', 'probe/right', 'saccade/nasal', 'saccade/temporal')
+            complete = all([self.hasDataset(f'zeta/{condition}/p') for condition in conditions])
+            if complete == False or redo:
+                self._runZetaTests(overwrite=redo, restart=redo, parallelize=parallelize)
 
         return
\ No newline at end of file
@@ -259,6 +259,12 @@ pathsToKeep = {
     "tfp/m",
     "tfp/xp",
 
+    # Clock alignment model
+    "clock",
+    "clock/knots",
+    "clock/residuals",
+    "clock/slopes",
+
     # Normalized PETHs for clustering
     "peths",
     "peths/probe",
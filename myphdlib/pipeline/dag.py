@@ -0,0 +1,478 @@
+import json
+import inspect
+import hashlib
+import numpy as np
+
+# Name of the attribute which stores the hash of the inputs and parameters used to create a dataset
+HASH_ATTRIBUTE = 'dagHash'
+
+def _labjackDataFiles(session):
+    """
+    """
+
+    if session.folders.labjack is None:
+        return list()
+
+    return sorted(session.folders.labjack.glob('*.dat'))
+
+def _ephysEventFiles(session):
+    """
+    """
+
+    if session.folders.ephys is None:
+        return list()
+    files = sorted(session.folders.ephys.joinpath('events').rglob('*.npy'))
+    files.extend(sorted(session.folders.ephys.rglob('sync_messages.txt')))
+
+    return files
+
+def _cameraTimestampFiles(session):
+    """
+    """
+
+    return [file for file in (session.leftCameraTimestamps, session.rightCameraTimestamps) if file is not None]
+
+def _eyePoseFiles(session):
+    """
+    """
+
+    return [file for file in (session.leftEyePose, session.rightEyePose) if file is not None]
+
+class Step():
+    """
+    A single step of the pipeline
+
+    keywords
+    --------
+    method
+        Name of the session method which runs the step
+    inputs
+        Datasets read by the step ({eye} is replaced with the session's eye)
+    outputs
+        Datasets written by the step
+    parameters
+        Keyword arguments passed to the method (part of the hash)
+    sources
+        Function which returns the raw data files read by the step (the size
+        and modification time of each file are part of the hash)
+    module
+        Name of the pipeline module the step belongs to
+    """
+
+    def __init__(
+        self,
+        method,
+        inputs=(),
+        outputs=(),
+        parameters=None,
+        sources=None,
+        module='events',
+        ):
+        """
+        """
+
+        self.method = method
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.parameters = dict() if parameters is None else dict(parameters)
+        self.sources = sources
+        self.module = module
+
+        return
+
+    @property
+    def name(self):
+        return self.method
+
+    def resolveInputs(self, session):
+        return [path.format(eye=session.eye) for path in self.inputs]
+
+    def resolveOutputs(self, session):
+        return [path.format(eye=session.eye) for path in self.outputs]
+
+# Declaration of the pipeline steps (in order of execution)
+PIPELINE = (
+
+    # Saccades module
+    Step(
+        '_extractEyePosition',
+        outputs=('pose/uncorrected',),
+        parameters={'likelihoodThreshold': 0.99, 'pupilCenterName': 'pupilCenter'},
+        sources=_eyePoseFiles,
+        module='saccades',
+    ),
+    Step(
+        '_correctEyePosition',
+        inputs=('pose/uncorrected',),
+        outputs=('pose/corrected',),
+        parameters={'pad': 1e6},
+        sources=_cameraTimestampFiles,
+        module='saccades',
+    ),
+    Step(
+        '_interpolateEyePosition',
+        inputs=('pose/corrected',),
+        outputs=('pose/interpolated',),
+        parameters={'maximumConsecutiveDroppedFrames': 4},
+        module='saccades',
+    ),
+    Step(
+        '_decomposeEyePosition',
+        inputs=('pose/interpolated',),
+        outputs=('pose/decomposed', 'pose/missing/left', 'pose/missing/right'),
+        parameters={'nNeighbors': 5},
+        module='saccades',
+    ),
+    Step(
+        '_reorientEyePosition',
+        inputs=('pose/decomposed', 'pose/corrected'),
+        outputs=('pose/reoriented',),
+        parameters={'reflect': 'left'},
+        module='saccades',
+    ),
+    Step(
+        '_filterEyePosition',
+        inputs=('pose/reoriented', 'pose/missing/left', 'pose/missing/right'),
+        outputs=('pose/filtered',),
+        parameters={'t': 25},
+        module='saccades',
+    ),
+    Step(
+        '_detectPutativeSaccades',
+        inputs=('pose/filtered',),
+        outputs=(
+            'saccades/putative/left/indices',
+            'saccades/putative/left/waveforms',
+            'saccades/putative/right/indices',
+            'saccades/putative/right/waveforms',
+        ),
+        parameters={
+            'amplitudeThreshold': 0.99,
+            'minimumInterPeakInterval': 0.075,
+            'perisaccadicWindow': (-0.2, 0.2),
+            'centerSaccadeWaveforms': False,
+            'smoothingWindowSize': 0.025,
+        },
+        module='saccades',
+    ),
+
+    # Events module
+    Step(
+        '_createLabjackDataMatrix',
+        outputs=('labjack/matrix',),
+        parameters={'fileNumberRange': (None, None)},
+        sources=_labjackDataFiles,
+    ),
+    Step(
+        '_extractLabjackTimespace',
+        inputs=('labjack/matrix',),
+        outputs=('labjack/timespace',),
+    ),
+    Step(
+        '_extractBarcodeSignals',
+        inputs=('labjack/matrix',),
+        outputs=('barcodes/labjack/trains', 'barcodes/neuropixels/trains'),
+        parameters={'maximumWrapperPulseDuration': 0.011, 'minimumBarcodeInterval': 3, 'pad': 100},
+        sources=_ephysEventFiles,
+    ),
+    Step(
+        '_decodeBarcodeSignals',
+        inputs=('barcodes/labjack/trains', 'barcodes/neuropixels/trains'),
+        outputs=(
+            'barcodes/labjack/indices',
+            'barcodes/labjack/values',
+            'barcodes/neuropixels/indices',
+            'barcodes/neuropixels/values',
+        ),
+        parameters={'barcodeBitSize': 0.03, 'wrapperBitSize': 0.01},
+    ),
+    Step(
+        '_estimateTimestampingFunction',
+        inputs=(
+            'barcodes/labjack/indices',
+            'barcodes/labjack/values',
+            'barcodes/neuropixels/indices',
+            'barcodes/neuropixels/values',
+        ),
+        outputs=('tfp/m', 'tfp/b', 'tfp/xp', 'tfp/fp'),
+        sources=_ephysEventFiles,
+    ),
+    Step(
+        '_estimateClockModel',
+        inputs=(
+            'barcodes/labjack/indices',
+            'barcodes/labjack/values',
+            'barcodes/neuropixels/indices',
+            'barcodes/neuropixels/values',
+        ),
+        outputs=('clock/knots', 'clock/slopes', 'clock/residuals'),
+        sources=_ephysEventFiles,
+    ),
+    Step(
+        '_findDroppedFrames',
+        outputs=(
+            'frames/left/dropped',
+            'frames/left/intervals',
+            'frames/right/dropped',
+            'frames/right/intervals',
+        ),
+        sources=_cameraTimestampFiles,
+    ),
+    Step(
+        '_timestampCameraTrigger',
+        inputs=('labjack/matrix', 'tfp/m', 'tfp/b', 'tfp/xp', 'tfp/fp', 'clock/knots', 'clock/slopes'),
+        outputs=('labjack/cameras/missing', 'labjack/cameras/timestamps'),
+        parameters={'factor': 1.3},
+    ),
+    Step(
+        '_timestampVideoFrames',
+        inputs=('labjack/cameras/timestamps', 'frames/left/dropped', 'frames/right/dropped'),
+        outputs=('frames/left/timestamps', 'frames/right/timestamps'),
+    ),
+    Step(
+        '_timestampSaccades',
+        inputs=(
+            'labjack/cameras/timestamps',
+            'saccades/predicted/left/epochs',
+            'saccades/predicted/left/indices',
+            'saccades/predicted/right/epochs',
+            'saccades/predicted/right/indices',
+            'frames/left/dropped',
+            'frames/right/dropped',
+        ),
+        outputs=('saccades/predicted/left/timestamps', 'saccades/predicted/right/timestamps'),
+        parameters={'saccadeEpochBoundaries': (-0.005, 0.005)},
+    ),
+    Step(
+        '_computeRelativeEventTiming',
+        inputs=(
+            'stimuli/dg/probe/timestamps',
+            'stimuli/dg/probe/motion',
+            'saccades/predicted/{eye}/timestamps',
+            'saccades/predicted/{eye}/labels',
+        ),
+        outputs=(
+            'stimuli/dg/probe/dos',
+            'stimuli/dg/probe/tts',
+            'saccades/predicted/{eye}/dop',
+            'saccades/predicted/{eye}/ttp',
+        ),
+    ),
+)
+
+def _sortSteps(steps):
+    """
+    Sort steps such that each step comes after the steps which create its inputs
+    """
+
+    producers = dict()
+    for step in steps:
+        for path in step.outputs:
+            producers[path] = step.name
+
+    #
+    dependencies = {
+        step.name: set([producers[path] for path in step.inputs if path in producers and producers[path] != step.name])
+            for step in steps
+    }
+    ordered, remaining = list(), list(steps)
+    while len(remaining) != 0:
+        done = set([step.name for step in ordered])
+        for step in remaining:
+            if dependencies[step.name].issubset(done):
+                ordered.append(step)
+                remaining.remove(step)
+                break
+        else:
+            raise Exception('Pipeline steps contain a circular dependency')
+
+    return ordered
+
+def _hashObject(obj):
+    """
+    """
+
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+def _fingerprintSourceFiles(files):
+    """
+    """
+
+    fingerprint = list()
+    for file in files:
+        stat = file.stat()
+        fingerprint.append([file.name, stat.st_size, stat.st_mtime_ns])
+
+    return fingerprint
+
+def _fingerprintDataset(session, path):
+    """
+    Return the hash stored with a dataset or (for datasets created outside of the pipeline) a hash of its content
+    """
+
+    entry = session.store.manifest().get(path)
+    if entry is None:
+        return None
+    if HASH_ATTRIBUTE in entry['attrs']:
+        return str(entry['attrs'][HASH_ATTRIBUTE])
+    value = np.ascontiguousarray(session.load(path))
+    sha = hashlib.sha1(value.view(np.uint8) if value.size != 0 else b'')
+    sha.update(f'{value.shape}{value.dtype}'.encode())
+
+    return sha.hexdigest()
+
+def _selectKeywordArguments(method, kwargs):
+    """
+    Keep only the keyword arguments which a (bound) method accepts
+
+    Some session types override steps with fewer parameters (e.g., the
+    Muscimol sessions)
+    """
+
+    parameters = inspect.signature(method).parameters.values()
+    if any([parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters]):
+        return dict(kwargs)
+    names = [parameter.name for parameter in parameters]
+
+    return {key: value for key, value in kwargs.items() if key in names}
+
+def computeStepHash(session, step, parameters=None, planned=None):
+    """
+    Hash the step, its parameters, its inputs, and its source files
+
+    keywords
+    --------
+    planned
+        Hashes of the outputs of upstream steps which are going to be re-run
+    """
+
+    planned = dict() if planned is None else planned
+    parameters_ = dict(step.parameters)
+    if parameters is not None:
+        parameters_.update(parameters)
+    inputs = dict()
+    for path in step.resolveInputs(session):
+        if path in planned:
+            inputs[path] = planned[path]
+        else:
+            inputs[path] = _fingerprintDataset(session, path)
+    sources = list() if step.sources is None else _fingerprintSourceFiles(step.sources(session))
+
+    return _hashObject({
+        'step': step.name,
+        'parameters': parameters_,
+        'inputs': inputs,
+        'sources': sources,
+    })
+
+def planPipeline(
+    session,
+    modules=None,
+    parameters=None,
+    force=False,
+    steps=PIPELINE,
+    ):
+    """
+    Determine which steps of the pipeline need to be (re-)run
+
+    keywords
+    --------
+    modules
+        Names of the modules to include (all modules if None)
+    parameters
+        Dictionary which maps step names to keyword arguments (overrides the
+        default parameters of each step)
+
+    returns
+    -------
+    plan
+        List of (step, hash, reason) tuples for each step which needs to run
+    """
+
+    parameters = dict() if parameters is None else parameters
+    manifest = session.store.manifest()
+
+    #
+    plan, planned = list(), dict()
+    for step in _sortSteps(steps):
+        if modules is not None and step.module not in modules:
+            continue
+        stepHash = computeStepHash(session, step, parameters.get(step.name), planned)
+
+        #
+        outputs = step.resolveOutputs(session)
+        existing = [path for path in outputs if path in manifest]
+        reason = None
+        if force:
+            reason = 'forced'
+        elif len(existing) == 0:
+            reason = 'missing outputs'
+        else:
+            for path in existing:
+                storedHash = manifest[path]['attrs'].get(HASH_ATTRIBUTE)
+                if storedHash is None:
+                    reason = 'untracked outputs'
+                    break
+                elif str(storedHash) != stepHash:
+                    reason = 'inputs or parameters changed'
+                    break
+
+        #
+        if reason is not None:
+            plan.append((step, stepHash, reason))
+            for path in outputs:
+                planned[path] = stepHash
+
+    return plan
+
+def runPipeline(
+    session,
+    modules=None,
+    parameters=None,
+    force=False,
+    adopt=False,
+    dryRun=False,
+    steps=PIPELINE,
+    ):
+    """
+    Run only the steps of the pipeline whose inputs, parameters, or source files changed
+
+    keywords
+    --------
+    adopt
+        Stamp outputs which were created before their hash was tracked
+        instead of re-running the steps which created them
+    dryRun
+        Report the steps which would run without running them
+
+    returns
+    -------
+    plan
+        List of (step name, reason) tuples for the steps which ran (or would run)
+    """
+
+    parameters = dict() if parameters is None else parameters
+    plan = planPipeline(session, modules, parameters, force, steps)
+
+    #
+    for step, stepHash, reason in plan:
+        if dryRun:
+            session.log(f'{step.name} is out of date ({reason})')
+            continue
+        session.log(f'Running {step.name} ({reason})')
+
+        #
+        if adopt and reason == 'untracked outputs':
+            pass
+        else:
+            kwargs = dict(step.parameters)
+            kwargs.update(parameters.get(step.name, dict()))
+            method = getattr(session, step.method)
+            method(**_selectKeywordArguments(method, kwargs))
+
+        # Stamp the outputs
+        for path in step.resolveOutputs(session):
+            if session.hasDataset(path):
+                session.store.setAttributes(path, {HASH_ATTRIBUTE: stepHash})
+
+    return [(step.name, reason) for step, stepHash, reason in plan]
@@ -2,6 +2,17 @@ import os
 import re
 import numpy as np
 import pathlib as pl
+from myphdlib.general.labjack import (
+    readDataFile,
+    loadLabjackData,
+    _sortDataFiles,
+    NSAMPLES,
+    NCHANNELS
+)
+from myphdlib.general.sync import (
+    padPulseTrains,
+    decodePaddedPulseTrains
+)
 
 samplingRateNeuropixels = 30000
 
@@ -18,75 +29,168 @@ def _readDataFile(dat):
     Read a single labjack dat file into a numpy array
     """
 
-    #
-    nSamples, nChannels = _getDataDimensions(dat)
+    return readDataFile(dat)
+
+def _iterateFrameIntervals(file, chunkSize=2 ** 24):
+    """
+    Parse a camera timestamps file (one frame interval per line) in chunks
+    """
 
-    # read out the binary file
-    with open(dat, 'rb') as stream:
-        lines = stream.readlines()
+    remainder = b''
+    with open(file, 'rb') as stream:
+        while True:
+            chunk = stream.read(chunkSize)
+            if len(chunk) == 0:
+                break
+            chunk = remainder + chunk
+            splitIndex = chunk.rfind(b'\n') + 1
+            chunk, remainder = chunk[:splitIndex], chunk[splitIndex:]
+            if len(chunk.strip()) != 0:
+                yield np.fromstring(chunk.decode(), dtype=np.int64, sep=' ')
+    if len(remainder.strip()) != 0:
+        yield np.fromstring(remainder.decode(), dtype=np.int64, sep=' ')
+
+    return
+
+def _readFrameIntervals(file, chunkSize=2 ** 24):
+    """
+    """
 
-    # Corrupted or empty dat files
-    if len(lines) == 0:
-        data = np.full((nSamples, nChannels), np.nan)
-        return data
+    chunks = list(_iterateFrameIntervals(file, chunkSize))
+    if len(chunks) == 0:
+        return np.array([], dtype=np.int64)
+
+    return np.concatenate(chunks)
+
+def _expandFrameIntervals(observedFrameIntervals, factor):
+    """
+    Insert the frames dropped during each (long) frame interval
+
+    returns
+    -------
+    droppedFrames
+        True for each dropped frame
+    frameIntervals
+        Observed frame intervals with the dropped frames assigned an interval of factor
+    """
+
+    # Each interval spans at least one frame and the last frame is the observed frame
+    nFrames = np.maximum(np.rint(observedFrameIntervals / factor).astype(np.int64), 1)
+    observedFrameIndices = np.cumsum(nFrames) - 1
+    nFramesTotal = int(nFrames.sum())
 
     #
-    for iline, line in enumerate(lines):
-        if bool(re.search('.*\t.*\t.*\t.*\t.*\t.*\t.*\r\n', line.decode())) and line.decode().startswith('Time') == False:
-            break
-
-    # split into header and content
-    header  = lines[:iline ]
-    content = lines[ iline:]
-
-    # extract data and convert to float or int
-    nrows = len(content)
-    ncols = len(content[0].decode().rstrip('\r\n').split('\t'))
-    shape = (nrows, ncols)
-    data = np.zeros(shape)
-    for iline, line in enumerate(content):
-        elements = line.decode().rstrip('\r\n').split('\t')
-        elements = [float(el) for el in elements]
-        data[iline, :] = elements
-
-    return np.array(data)
+    droppedFrames = np.full(nFramesTotal, True)
+    droppedFrames[observedFrameIndices] = False
+    frameIntervals = np.full(nFramesTotal, float(factor))
+    frameIntervals[observedFrameIndices] = observedFrameIntervals
+
+    return droppedFrames, frameIntervals
 
 class EventsProcessingMixin(object):
     """
     """
 
-    def _createLabjackDataMatrix(self, fileNumberRange=(None, None)):
+    def _createLabjackDataMatrix(self, fileNumberRange=(None, None), nProcesses=None, stream=False, restart=False):
         """
         Concatenate the dat files into a matrix of the shape N samples x N channels
         """
 
+        #
+        if stream:
+            self._streamLabjackDataMatrix(fileNumberRange, restart)
+            return
+
         self.log('Creating labjack data matrix')
 
-        # determine the correct sequence of files
-        files = [
-            str(file)
-                for file in self.folders.labjack.iterdir() if file.suffix == '.dat'
-        ]
-        file_numbers = [int(file.rstrip('.dat').split('_')[-1]) for file in files]
-        sort_index = np.argsort(file_numbers)
-
-        # create the matrix
-        data = list()
-        for ifile in sort_index:
-            if fileNumberRange[0] is not None:
-                if ifile < fileNumberRange[0]:
-                    continue
-            if fileNumberRange[1] is not None:
-                if ifile > fileNumberRange[1]:
-                    continue
-            dat = self.folders.labjack.joinpath(files[ifile])
-            mat = _readDataFile(dat)
-            for irow in range(mat.shape[0]):
-                data.append(mat[irow,:].tolist())
+        # Read the dat files in parallel (in order of file number)
+        M = loadLabjackData(self.folders.labjack, fileNumberRange, nProcesses)
+
+        # Chunk by column so that single-channel reads only touch that channel
+        chunks = (max(1, min(M.shape[0], NSAMPLES)), 1)
+        self.save('labjack/matrix', M, chunks=chunks)
+        if self.hasDataset('labjack/files'):
+            self.remove('labjack/files')
+        return
+
+    def _streamLabjackDataMatrix(self, fileNumberRange=(None, None), restart=False, compression='gzip'):
+        """
+        Append the dat files to a resizable labjack data matrix one file at a time
+
+        The numbers of the files already ingested are stored in labjack/files
+        so that an interrupted run resumes where it left off. The number of
+        rows and the number of files ingested are committed together in a
+        single attribute of the matrix (progress) after each file, and
+        anything written past that point is discarded when resuming.
+        """
+
+        #
+        files = _sortDataFiles(self.folders.labjack, fileNumberRange)
+        fileNumbers = [int(pl.Path(file).stem.split('_')[-1]) for file in files]
 
         #
-        M = np.array(data)
-        self.save('labjack/matrix', M)
+        self.store.invalidate('labjack')
+        with self.batch() as stream:
+
+            # Start over if requested or if the matrix was not built by this method
+            if 'labjack/matrix' in stream:
+                if restart or 'labjack/files' not in stream:
+                    del stream['labjack/matrix']
+            if 'labjack/files' in stream:
+                if restart or 'labjack/matrix' not in stream:
+                    del stream['labjack/files']
+
+            # Create empty datasets
+            if 'labjack/matrix' not in stream:
+                matrix = stream.create_dataset(
+                    'labjack/matrix',
+                    shape=(0, NCHANNELS),
+                    maxshape=(None, NCHANNELS),
+                    dtype=np.float64,
+                    chunks=(NSAMPLES, 1),
+                    compression=compression
+                )
+                matrix.attrs['progress'] = np.array([0, 0], dtype=np.int64)
+                stream.create_dataset(
+                    'labjack/files',
+                    shape=(0,),
+                    maxshape=(None,),
+                    dtype=np.int64,
+                )
+            matrix = stream['labjack/matrix']
+            ingested = stream['labjack/files']
+
+            # Discard any rows or file numbers from a file that was only partially ingested
+            if 'progress' in matrix.attrs:
+                nFiles, nRows = [int(value) for value in matrix.attrs['progress']]
+            else:
+                nFiles, nRows = ingested.shape[0], int(matrix.attrs['nRows'])
+            if matrix.shape[0] != nRows:
+                matrix.resize(nRows, axis=0)
+            if ingested.shape[0] != nFiles:
+                ingested.resize(nFiles, axis=0)
+            completed = set(ingested[:].tolist())
+            if len(completed) != 0:
+                self.log(f'Resuming labjack data matrix creation ({len(completed)} out of {len(files)} files already ingested)')
+            else:
+                self.log('Creating labjack data matrix')
+
+            #
+            for file, fileNumber in zip(files, fileNumbers):
+                if fileNumber in completed:
+                    continue
+                mat = readDataFile(file)
+                if mat.shape[1] != matrix.shape[1]:
+                    raise Exception(f'Unexpected number of channels ({mat.shape[1]}) in labjack data file: {file}')
+                matrix.resize(nRows + mat.shape[0], axis=0)
+                matrix[nRows: nRows + mat.shape[0], :] = mat
+                nRows += mat.shape[0]
+                nFiles += 1
+                ingested.resize(nFiles, axis=0)
+                ingested[-1] = fileNumber
+                matrix.attrs['progress'] = np.array([nFiles, nRows], dtype=np.int64)
+                stream.flush()
+
         return
 
     def _extractLabjackTimespace(self):
@@ -95,7 +199,7 @@ class EventsProcessingMixin(object):
 
         self.log('Extracting labjack timespace')
 
-        labjackDataMatrix = self.load('labjack/matrix')
+        labjackDataMatrix = self.load('labjack/matrix', lazy=True)
         labjackTimespace = labjackDataMatrix[:, 0]
         self.save('labjack/timespace', labjackTimespace)
 
@@ -127,7 +231,7 @@ class EventsProcessingMixin(object):
         }
 
         # Load labjack data matrix
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
 
         #
         for device in ('labjack', 'neuropixels'):
@@ -180,16 +284,7 @@ class EventsProcessingMixin(object):
                 pulseTrainsFiltered.append(pulseTrain)
 
             #
-            padded = list()
-            for pulseTrainFiltered in pulseTrainsFiltered:
-                row = list()
-                for index in pulseTrainFiltered:
-                    row.append(index)
-                nRight = pad - len(row)
-                for value in np.full(nRight, np.nan):
-                    row.append(value)
-                padded.append(row)
-            padded = np.array(padded)
+            padded = padPulseTrains(pulseTrainsFiltered, pad)
             self.save(f'barcodes/{device}/trains', padded)
 
         return
@@ -215,69 +310,16 @@ class EventsProcessingMixin(object):
                 self.save(f'barcodes/{device}/indices', np.array([]).astype(float))
                 self.save(f'barcodes/{device}/values', np.array([]).astype(float))
                 continue
-            pulseTrains = [
-                row[np.invert(np.isnan(row))].astype(np.int32).tolist()
-                    for row in pulseTrainsPadded
-            ]
-            barcodeValues, barcodeIndices = list(), list()
-
-            #
-            offset = 0
-            for pulseTrain in pulseTrains:
-
-                # 
-                wrapperFallingEdge = pulseTrain[1]
-                wrapperRisingEdge = pulseTrain[-2]
-                barcodeLeftEdge = wrapperFallingEdge + round(wrapperBitSize * samplingRate)
-                barcodeRightEdge = wrapperRisingEdge - round(wrapperBitSize * samplingRate)
-                
-                # Determine the state at the beginning and end of the data window
-                firstStateTransition = pulseTrain[2]
-                if (firstStateTransition - barcodeLeftEdge) / samplingRate < 0.001:
-                    initialSignalState = currentSignalState = True
-                else:
-                    initialSignalState = currentSignalState = False
-                finalStateTransition = pulseTrain[-3]
-                if (barcodeRightEdge - finalStateTransition) / samplingRate < 0.001:
-                    finalSignalState = True
-                else:
-                    finalSignalState = False
-
-                # Determine what indices to use for computing time intervals between state transitions
-                if initialSignalState == True and finalSignalState == True:
-                    iterable = pulseTrain[2: -2]
-                elif initialSignalState == True and finalSignalState == False:
-                    iterable = np.concatenate([pulseTrain[2:-2], np.array([barcodeRightEdge])])
-                elif initialSignalState == False and finalSignalState == False:
-                    iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2], np.array([barcodeRightEdge])])
-                elif initialSignalState == False and finalSignalState == True:
-                    iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2]])
-                
-                # Determine how many bits are stored in each time interval and keep track of the signal state
-                bitList = list()
-                for nSamples in np.diff(iterable):
-                    nBits = int(round(nSamples / (barcodeBitSize * samplingRate)))
-                    for iBit in range(nBits):
-                        bitList.append(1 if currentSignalState else 0)
-                    currentSignalState = not currentSignalState
-
-                # Decode the strings of bits
-                bitString = ''.join(map(str, bitList[::-1]))
-                if len(bitString) != 32:
-                    raise Exception(f'More or less that 32 bits decoded')
-                value = int(bitString, 2) + offset
-
-                # 32-bit integer overflow
-                if value == 2 ** 32 - 1:
-                    offset = 2 ** 32
-
-                #
-                barcodeValues.append(value)
-                barcodeIndices.append(pulseTrain[0])
+            barcodeValues, barcodeIndices = decodePaddedPulseTrains(
+                pulseTrainsPadded,
+                samplingRate,
+                barcodeBitSize=barcodeBitSize,
+                wrapperBitSize=wrapperBitSize
+            )
 
             #
-            self.save(f'barcodes/{device}/indices', np.array(barcodeIndices))
-            self.save(f'barcodes/{device}/values', np.array(barcodeValues))
+            self.save(f'barcodes/{device}/indices', barcodeIndices)
+            self.save(f'barcodes/{device}/values', barcodeValues)
 
         return
 
@@ -352,7 +394,38 @@ class EventsProcessingMixin(object):
 
         return
 
-    def _findDroppedFrames(self, pad=1000000):
+    def _estimateClockModel(self):
+        """
+        Save the piecewise-linear model which aligns the labjack and Neuropixels clocks
+
+        The sampling rate of the labjack and the first sample number of the
+        ephys recording are stored with the knots so that they don't need to
+        be parsed from the raw data files again
+        """
+
+        self.log('Estimating clock alignment model')
+
+        # Barcodes might have been decoded again
+        self._barcodeValues = None
+        self._barcodeTimestamps = None
+        self._clock = None
+
+        #
+        model = self._computeClockModel()
+        metadata = {
+            'labjackSamplingRate': self.labjackSamplingRate,
+        }
+        if model['knots'].shape[0] != 0:
+            metadata['referenceSampleNumber'] = self.referenceSampleNumber
+            metadata['rms'] = float(np.sqrt(np.mean(np.power(model['residuals'], 2))))
+            metadata['maximumResidual'] = float(np.max(np.abs(model['residuals'])))
+        for key in ('slopes', 'residuals', 'knots'):
+            self.save(f'clock/{key}', model[key], metadata=metadata if key == 'knots' else {})
+        self._clock = model
+
+        return
+
+    def _findDroppedFrames(self):
         """
         """
 
@@ -360,12 +433,12 @@ class EventsProcessingMixin(object):
 
         #
         if self.primaryCamera == 'left':
-            frameIntervals = np.loadtxt(self.leftCameraTimestamps, dtype=np.int64)
+            primaryCameraTimestamps = self.leftCameraTimestamps
         elif self.primaryCamera == 'right':
-            frameIntervals = np.loadtxt(self.rightCameraTimestamps, dtype=np.int64)
+            primaryCameraTimestamps = self.rightCameraTimestamps
         else:
             raise Exception('Could not determine the primary camera')
-        factor = np.median(frameIntervals)
+        factor = np.median(_readFrameIntervals(primaryCameraTimestamps))
 
         #
         for eye in ('left', 'right'):
@@ -375,35 +448,16 @@ class EventsProcessingMixin(object):
             if file is None:
                 self.log(f'Could not find the timestamps for the {eye} camera video', level='warning')
                 continue
-            observedFrameIntervals = np.loadtxt(file, dtype=np.int64) # in ms
-            droppedFrames = np.full(observedFrameIntervals.size + 1 + pad, -1.0).astype(float)
-            frameIntervals = np.full(observedFrameIntervals.size + 1 + pad, -1.0).astype(float)
-
-            #
-            frameIndex = 0
-            nDropped = 0
 
-            #
-            for frameInterval in observedFrameIntervals:
-                nFrames = int(round(frameInterval / factor, 0))
-                if nFrames > 1:
-                    nDropped += nFrames - 1
-                    for iFrame in range(nFrames - 1):
-                        droppedFrames[frameIndex] = 1
-                        frameIntervals[frameIndex] = factor
-                        frameIndex += 1
-                droppedFrames[frameIndex] = 0
-                frameIntervals[frameIndex] = frameInterval
-                frameIndex += 1
-            
-            #
-            excessFrameIndices = np.where(droppedFrames == -1)[0]
-            droppedFrames = np.delete(droppedFrames, excessFrameIndices)
-            droppedFrames = droppedFrames.astype(bool)
+            # NOTE: Chunks are independent since each interval is expanded on its own
+            droppedFrames, frameIntervals = list(), list()
+            for observedFrameIntervals in _iterateFrameIntervals(file): # in ms
+                droppedFramesInChunk, frameIntervalsInChunk = _expandFrameIntervals(observedFrameIntervals, factor)
+                droppedFrames.append(droppedFramesInChunk)
+                frameIntervals.append(frameIntervalsInChunk)
+            droppedFrames = np.concatenate(droppedFrames) if len(droppedFrames) != 0 else np.array([], dtype=bool)
+            frameIntervals = np.concatenate(frameIntervals) if len(frameIntervals) != 0 else np.array([], dtype=float)
             self.save(f'frames/{eye}/dropped', droppedFrames)
-
-            #
-            frameIntervals = np.delete(frameIntervals, excessFrameIndices)
             self.save(f'frames/{eye}/intervals', frameIntervals)
             
         return
@@ -422,24 +476,23 @@ class EventsProcessingMixin(object):
         self.log('Timestamping camera trigger signal')
 
         # Load the raw signal
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
         signal = M[:, self.labjackChannelMapping['cameras']]
 
         # Find long intervals where data was dropped by the labjack device
         peaks = np.where(np.abs(np.diff(signal)) > 0.5)[0]
         intervals = np.diff(peaks) / self.labjackSamplingRate
-        missing = list()
 
-        #
+        # Each long interval is followed by the edges which were missed
         threshold = 1 / self.fps * factor
-        for interval, flag in zip(intervals, intervals > threshold):
-            missing.append(False)
-            if flag:
-                nFrames = int(round(interval / (1 / self.fps), 0))
-                for iFrame in range(nFrames - 1):
-                    missing.append(True)
-        missing.append(False)
-        missing = np.array(missing)
+        nMissing = np.where(
+            intervals > threshold,
+            np.maximum(np.rint(intervals / (1 / self.fps)).astype(np.int64) - 1, 0),
+            0
+        )
+        observedEdgeIndices = np.concatenate([[0], np.cumsum(nMissing + 1)])
+        missing = np.full(observedEdgeIndices[-1] + 1, True)
+        missing[observedEdgeIndices] = False
 
         #
         if missing.sum() > 0:
@@ -611,17 +664,20 @@ class EventsProcessingMixin(object):
 
         return
 
-    def _runEventsModule(self, redo=False):
+    def _runEventsModule(self, redo=False, stream=False):
         """
         """
 
-
-        if self.hasDataset('labjack/matrix') == False or redo:
+        # NOTE: The streaming writer resumes (or skips) a partially created matrix
+        if stream:
+            self._createLabjackDataMatrix(stream=True, restart=redo)
+        elif self.hasDataset('labjack/matrix') == False or redo:
             self._createLabjackDataMatrix()
         self._extractLabjackTimespace()
         self._extractBarcodeSignals()
         self._decodeBarcodeSignals()
         self._estimateTimestampingFunction()
+        self._estimateClockModel()
         self._findDroppedFrames()
         self._timestampCameraTrigger()
         self._timestampVideoFrames()
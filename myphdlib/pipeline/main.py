@@ -1,55 +1,247 @@
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from myphdlib.pipeline.prediction import (
     predictSaccadeDirection,
     predictSaccadeEpochs
 )
 from myphdlib.interface.factory import SessionFactory
+from myphdlib.pipeline.profiling import SessionProfiler
+from myphdlib.pipeline.dag import runPipeline
+from myphdlib.interface.hdf import FileHandleManager
+from contextlib import nullcontext
+
+def _runSessionStage(job):
+    """
+    Run one stage of the pipeline for a single session
+
+    Exceptions are caught and returned so that one failing session does not
+    interrupt the processing of the other sessions
+    """
+
+    session, stage, kwargs = job
+    result = {
+        'session': f'{session.date} ({session.animal})',
+        'stage': stage,
+        'elapsed': None,
+        'error': None,
+    }
+
+    #
+    if kwargs['profile']:
+        profiler = SessionProfiler(session, filename=f'profile-{stage}.json')
+    else:
+        profiler = nullcontext()
+
+    #
+    t1 = time.time()
+    try:
+        with profiler:
+            if stage == 'saccades' and kwargs['incremental']:
+                runPipeline(session, modules=('saccades',), force=kwargs['redo'], adopt=True)
+            elif stage == 'saccades':
+                session._runSaccadesModule()
+            elif stage == 'pipeline':
+                if kwargs['incremental']:
+                    runPipeline(session, modules=('events',), force=kwargs['redo'], adopt=True)
+                else:
+                    session._runEventsModule(kwargs['redo'])
+                session._runStimuliModule()
+                session._runActivityModule(kwargs['zeta'], kwargs['redo'])
+                session._runSpikesModule()
+            else:
+                raise Exception(f'{stage} is not a valid stage')
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['elapsed'] = round(time.time() - t1, 2)
+
+    return result
+
+def _runSessionStageInWorker(job):
+    """
+    Load a session from its folder and run one stage of the pipeline
+
+    Workers only receive the session class, folder, and eye such that no
+    state (e.g., open file handles) is inherited from the parent process
+    """
+
+    cls, home, eye, stage, kwargs = job
+    session = cls(home, eye=eye)
+    try:
+        result = _runSessionStage((session, stage, kwargs))
+    finally:
+        session.close()
+
+    return result
+
+def _runStage(
+    sessions,
+    stage,
+    nWorkers=1,
+    **kwargs
+    ):
+    """
+    Run one stage of the pipeline for each session (in parallel if nWorkers != 1)
+    """
+
+    nSessions = len(sessions)
+    if nSessions == 0:
+        return list()
+
+    #
+    results = list()
+    if nWorkers == 1:
+        for session in sessions:
+            results.append(_runSessionStage((session, stage, kwargs)))
+            end = '\r' if len(results) != nSessions else None
+            print(f'Running {stage} stage ({len(results)} out of {nSessions} sessions complete)', end=end)
+
+    #
+    else:
+
+        # Handles opened by the parent (e.g., by hasDataset) must not be inherited by the workers
+        for session in sessions:
+            session.close()
+        FileHandleManager.closeAll()
+
+        #
+        jobs = [
+            (type(session), str(session.home), session._eye, stage, kwargs)
+                for session in sessions
+        ]
+        # NOTE: Pool workers are daemonic and can't start their own pools (e.g.,
+        #       to read the labjack data files), executor workers can
+        with ProcessPoolExecutor(nWorkers) as executor:
+            futures = [executor.submit(_runSessionStageInWorker, job) for job in jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+                end = '\r' if len(results) != nSessions else None
+                print(f'Running {stage} stage ({len(results)} out of {nSessions} sessions complete)', end=end)
+
+        # Sessions were modified by the worker processes
+        for session in sessions:
+            session.store.refresh()
+
+    #
+    order = {f'{session.date} ({session.animal})': i for i, session in enumerate(sessions)}
+    results.sort(key=lambda result: order[result['session']])
+
+    return results
+
+def summarizeResults(results):
+    """
+    Print the elapsed time and status of each session for each stage
+    """
+
+    nFailed = 0
+    for result in results:
+        status = 'failed' if result['error'] is not None else 'ok'
+        print(f'{result["stage"]:<12}{result["session"]:<36}{status:<8}{result["elapsed"]:>10} s')
+        if result['error'] is not None:
+            nFailed += 1
+            print(result['error'])
+    print(f'{len(results) - nFailed} out of {len(results)} jobs completed without error')
+
+    return
 
 def process(
     sessions,
     redo=False,
     zeta=False,
     saccadePredictionExperiments=('Mlati', 'Dreadds', 'Muscimol'),
+    profile=False,
+    nWorkers=1,
+    incremental=False,
     ):
     """
+    Run the full pipeline
+
+    keywords
+    --------
+    profile
+        Profile each processing step (reports are written to the session
+        folders as profile-<stage>.json)
+    nWorkers
+        Number of sessions processed in parallel (None uses every core)
+    incremental
+        Only run the steps of the saccades and events modules whose inputs or
+        parameters changed (see myphdlib.pipeline.dag). Outputs which were
+        created before their hash was tracked (e.g., by a non-incremental
+        run) are adopted instead of recomputed
+
+    returns
+    -------
+    results
+        Elapsed time and error (if any) for each session and stage
     """
 
+    results = list()
+    kwargs = {
+        'redo': redo,
+        'zeta': zeta,
+        'profile': profile,
+        'incremental': incremental,
+    }
+
     # Process eye position data and detect putative saccades
-    for session in sessions:
-        if session.hasDataset('saccades/putative') == False or redo:
-            session._runSaccadeModule()
+    sessionsToProcess = [
+        session for session in sessions
+            if session.hasDataset('saccades/putative') == False or redo or incremental
+    ]
+    results.extend(_runStage(sessionsToProcess, 'saccades', nWorkers, **kwargs))
+    failed = set([result['session'] for result in results if result['error'] is not None])
 
     # Collect sessions missing predicted saccades
     sessionsToAnalyze = list()
     for session in sessions:
+        if f'{session.date} ({session.animal})' in failed:
+            continue
         if session.hasDataset('saccades/predicted')== False or redo:
             sessionsToAnalyze.append(session)
 
-    # Predict saccade parameters
+    # Predict saccade parameters (requires the putative saccades for every session)
     if len(sessionsToAnalyze) != 0:
+        t1 = time.time()
+        try:
+
+            # Collect sessions used to train saccade classifier
+            factory = SessionFactory()
+            sessionsForTraining = factory.produce(
+                experiment=saccadePredictionExperiments
+            )
 
-        # Collect sessions used to train saccade classifier
-        factory = SessionFactory()
-        sessionsForTraining = factory.produce(
-            experiment=saccadePredictionExperiments
-        )
+            # Predict saccade direction
+            predictSaccadeDirection(
+                sessionsToAnalyze,
+                sessionsForTraining
+            )
 
-        # Predict saccade direction
-        predictSaccadeDirection(
-            sessionsToAnalyze,
-            sessionsForTraining
-        )
+            # Predict saccade onset and offset
+            predictSaccadeEpochs(
+                sessionsToAnalyze,
+                sessionsForTraining,
+            )
 
-        # Predict saccade onset and offset
-        predictSaccadeEpochs(
-            sessionsToAnalyze,
-            sessionsForTraining,
-        )
+        except Exception:
+            error = traceback.format_exc()
+            for session in sessionsToAnalyze:
+                key = f'{session.date} ({session.animal})'
+                failed.add(key)
+                results.append({
+                    'session': key,
+                    'stage': 'prediction',
+                    'elapsed': round(time.time() - t1, 2),
+                    'error': error,
+                })
 
     # Main pipeline
-    for session in sessions:
-        session._runEventsModule(redo)
-        session._runStimuliModule()
-        session._runActivityModule(zeta, redo)
-        session._runSpikesModule()
+    sessionsToProcess = [
+        session for session in sessions
+            if f'{session.date} ({session.animal})' not in failed
+    ]
+    results.extend(_runStage(sessionsToProcess, 'pipeline', nWorkers, **kwargs))
+
+    #
+    summarizeResults(results)
 
-    return
\ No newline at end of file
+    return results
@@ -1,5 +1,5 @@
 import numpy as np
-from myphdlib.general.toolkit import psth2
+from myphdlib.general.toolkit import psth2, psth3
 
 def _getPerisaccadicEpochs(
     leftEdge=-0.5,
@@ -14,6 +14,28 @@ def _getPerisaccadicEpochs(
     binEdges = np.vstack([leftEdges, rightEdges]).T
     return binEdges
 
+def _computePopulationPeths(
+    session,
+    eventTimestamps,
+    responseWindow=(-0.2, 0.5),
+    binsize=0.02,
+    ):
+    """
+    Compute spike counts for every unit in the population (N units x N trials x N bins)
+    """
+
+    clusters = np.array([unit.cluster for unit in session.population])
+    t, M = psth3(
+        eventTimestamps,
+        session.population.allSpikeTimestamps,
+        session.population.allSpikeClusters,
+        clusters,
+        window=responseWindow,
+        binsize=binsize
+    )
+
+    return t, M
+
 def _loadEventData(
     session,
     protocol='dg'
@@ -86,7 +108,7 @@ def _loadEventData(
     return probeData, saccadeData
 
 def _getResponseTemplatesForSaccades(
-    unit,
+    session,
     probeData=None,
     saccadeData=None,
     responseWindow=(-0.2, 0.5),
@@ -95,11 +117,13 @@ def _getResponseTemplatesForSaccades(
     protocol='dg'
     ):
     """
+    Compute the saccade response of every unit (N units x N bins) for each
+    combination of grating motion and saccade direction
     """
 
     # Load event data (if necessary)
     if any([probeData is None, saccadeData is None]):
-        probeData, saccadeData = _loadEventData(unit.session, protocol=protocol)
+        probeData, saccadeData = _loadEventData(session, protocol=protocol)
     
     # Unpack event data
     probeTimestamps, probeLatencies, gratingMotionDuringProbes, saccadeLabelsProximate = probeData
@@ -115,11 +139,12 @@ def _getResponseTemplatesForSaccades(
     )
 
     #
+    nUnits = session.population.count()
     responseTemplates = {
-        ('left', 'nasal'): np.full(nBins, np.nan),
-        ('left', 'temporal'): np.full(nBins, np.nan),
-        ('right', 'nasal'): np.full(nBins, np.nan),
-        ('right', 'temporal'): np.full(nBins, np.nan),
+        ('left', 'nasal'): np.full([nUnits, nBins], np.nan),
+        ('left', 'temporal'): np.full([nUnits, nBins], np.nan),
+        ('right', 'nasal'): np.full([nUnits, nBins], np.nan),
+        ('right', 'temporal'): np.full([nUnits, nBins], np.nan),
     }
     trialIndices = {
         ('left', 'nasal'): None,
@@ -152,12 +177,13 @@ def _getResponseTemplatesForSaccades(
         trialIndices[(gratingDirection, saccadeDirection)] = trialIndicesForUniqueCondition
         if trialIndicesForUniqueCondition.size == 0:
             continue
-        t, fr = unit.peth(
+        t, M = _computePopulationPeths(
+            session,
             saccadeTimestamps[trialIndicesForUniqueCondition],
             responseWindow=responseWindow,
             binsize=binsize
         )
-        responseTemplates[(gratingDirection, saccadeDirection)] = fr
+        responseTemplates[(gratingDirection, saccadeDirection)] = M.mean(1) / binsize
 
     return responseTemplates, tBins, trialIndices
 
@@ -225,25 +251,15 @@ class TimeHistogramProcessingMixin():
             ))[0]
 
             #
-            for iUnit, unit in enumerate(self.population):
-
-                #
-                if iUnit + 1 == nUnits:
-                    end = None
-                else:
-                    end = '\r'
-                self.log(f'Extracting visual-only PSTHs for unit {iUnit + 1} out of {nUnits} (motion={probeMotion}, protocol={protocol})', end=end)    
-
-                t, M = psth2(
-                    probeTimestamps[trialIndices],
-                    unit.timestamps,
-                    window=responseWindow,
-                    binsize=binsize
-                )
-                fr = M.mean(0) / binsize
-                sd = M.std(0) / binsize
-                peths[iUnit] = fr
-                error[iUnit] = sd
+            self.log(f'Extracting visual-only PSTHs for {nUnits} units (motion={probeMotion}, protocol={protocol})')
+            t, M = _computePopulationPeths(
+                self,
+                probeTimestamps[trialIndices],
+                responseWindow=responseWindow,
+                binsize=binsize
+            )
+            peths[:] = M.mean(1) / binsize
+            error[:] = M.std(1) / binsize
             self.save(f'{datasetPath}/fr', peths, metadata=metadata) # Mean firing rate
             self.save(f'{datasetPath}/sd', error, metadata=metadata) # Standard deviation across trials per bin
 
@@ -315,25 +331,15 @@ class TimeHistogramProcessingMixin():
             ))[0]
 
             #
-            for iUnit, unit in enumerate(self.population):
-
-                #
-                if iUnit + 1 == nUnits:
-                    end = None
-                else:
-                    end = '\r'
-                self.log(f'Extracting saccade-only PSTHs for unit {iUnit + 1} out of {nUnits} (direction={saccadeDirection}, protocol={protocol})', end=end)   
-
-                t, M = psth2(
-                    saccadeTimestamps[trialIndices],
-                    unit.timestamps,
-                    window=responseWindow,
-                    binsize=binsize
-                )
-                fr = M.mean(0) / binsize
-                sd = M.std(0) / binsize
-                peths[iUnit] = fr
-                error[iUnit] = sd
+            self.log(f'Extracting saccade-only PSTHs for {nUnits} units (direction={saccadeDirection}, protocol={protocol})')
+            t, M = _computePopulationPeths(
+                self,
+                saccadeTimestamps[trialIndices],
+                responseWindow=responseWindow,
+                binsize=binsize
+            )
+            peths[:] = M.mean(1) / binsize
+            error[:] = M.std(1) / binsize
             
             #
             self.save(f'{datasetPath}/fr', peths, metadata=metadata)
@@ -398,44 +404,34 @@ class TimeHistogramProcessingMixin():
                 continue
 
             #
-            for iUnit, unit in enumerate(self.population):
+            self.log(f'Extracting peri-saccadic PSTHs for {nUnits} units (motion={probeMotion}, protocol={protocol})')
+            for iBin, (leftEdge, rightEdge) in enumerate(binEdges):
 
                 #
-                if iUnit + 1 == nUnits:
-                    end = None
-                else:
-                    end = '\r'
-                self.log(f'Extracting peri-saccadic PSTHs for unit {iUnit + 1} out of {nUnits} (motion={probeMotion}, protocol={protocol})', end=end)   
-                
-                for iBin, (leftEdge, rightEdge) in enumerate(binEdges):
+                perisaccadicWindow = (leftEdge, rightEdge)
+                trialIndices = np.where(np.logical_and(
+                    np.logical_and(
+                        probeLatencies >= perisaccadicWindow[0],
+                        probeLatencies <= perisaccadicWindow[1]
+                    ),
+                    gratingMotionDuringProbes == probeMotion
+                ))[0]
 
-                    #
-                    perisaccadicWindow = (leftEdge, rightEdge)
-                    trialIndices = np.where(np.logical_and(
-                        np.logical_and(
-                            probeLatencies >= perisaccadicWindow[0],
-                            probeLatencies <= perisaccadicWindow[1]
-                        ),
-                        gratingMotionDuringProbes == probeMotion
-                    ))[0]
-
-                    #
-                    if trialIndices.size == 0:
-                        peths[iUnit, :, iBin] = np.full(nBins, np.nan)
-                        error[iUnit, :, iBin] = np.full(nBins, np.nan)
-                        continue
+                #
+                if trialIndices.size == 0:
+                    peths[:, :, iBin] = np.full([nUnits, nBins], np.nan)
+                    error[:, :, iBin] = np.full([nUnits, nBins], np.nan)
+                    continue
 
-                    #
-                    t, M = psth2(
-                        probeTimestamps[trialIndices],
-                        unit.timestamps,
-                        window=responseWindow,
-                        binsize=binsize
-                    )
-                    fr = M.mean(0) / binsize
-                    sd = M.std(0) / binsize
-                    peths[iUnit, :, iBin] = fr
-                    error[iUnit, :, iBin] = sd
+                #
+                t, M = _computePopulationPeths(
+                    self,
+                    probeTimestamps[trialIndices],
+                    responseWindow=responseWindow,
+                    binsize=binsize
+                )
+                peths[:, :, iBin] = M.mean(1) / binsize
+                error[:, :, iBin] = M.std(1) / binsize
             
             #
             self.save(f'{datasetPath}/fr', peths, metadata=metadata)
@@ -501,84 +497,80 @@ class TimeHistogramProcessingMixin():
                 self.save(datasetPath, peths, metadata=metadata)
                 continue
 
-            #
-            for iUnit, unit in enumerate(self.population):
+            # Saccade responses of every unit for each unique condition
+            responseWindowPadded = np.array([
+                responseWindow[0] - windowPadSize,
+                responseWindow[1] + windowPadSize
+            ])
+            responseTemplates, tBinsPadded, trialIndicesForUniqueConditions = _getResponseTemplatesForSaccades(
+                self,
+                probeData,
+                saccadeData,
+                responseWindow=responseWindowPadded,
+                perisaccadicWindow=perisaccadicWindow,
+                binsize=binsize
+            )
 
-                #
-                if iUnit + 1 == nUnits:
-                    end = None
-                else:
-                    end = '\r'
-                self.log(f'Extracting latency-shifted saccade PSTHs for unit {iUnit + 1} out of {nUnits} (motion={probeMotion}, protocol={protocol})', end=end)   
+            #
+            self.log(f'Extracting latency-shifted saccade PSTHs for {nUnits} units (motion={probeMotion}, protocol={protocol})')
+            for iBin, (leftEdge, rightEdge) in enumerate(binEdges):
 
                 #
-                if interp:
-                    responseWindowPadded = np.array([
-                        responseWindow[0] - windowPadSize,
-                        responseWindow[1] + windowPadSize
-                    ])
-                    responseTemplates, tBinsPadded, trialIndicesForUniqueConditions = _getResponseTemplatesForSaccades(
-                        unit,
-                        probeData,
-                        saccadeData,
-                        responseWindow=responseWindowPadded,
-                        perisaccadicWindow=perisaccadicWindow,
-                        binsize=binsize
-                    )
-                
-                for iBin, (leftEdge, rightEdge) in enumerate(binEdges):
+                trialIndices = np.where(np.logical_and(
+                    np.logical_and(
+                        probeLatencies >= leftEdge,
+                        probeLatencies <= rightEdge
+                    ),
+                    gratingMotionDuringProbes == probeMotion
+                ))[0]
+                if trialIndices.size == 0:
+                    continue
+
+                # Latency-shifted saccade response of every unit for each trial
+                curves = list()
+                iterable = zip(
+                    gratingMotionDuringProbes[trialIndices],
+                    probeLatencies[trialIndices],
+                    saccadelabelsProximate[trialIndices]
+                )
+                for probeMotion_, probeLatency, saccadeLabel in iterable:
 
                     #
-                    trialIndices = np.where(np.logical_and(
-                        np.logical_and(
-                            probeLatencies >= leftEdge,
-                            probeLatencies <= rightEdge
-                        ),
-                        gratingMotionDuringProbes == probeMotion
-                    ))[0]
-                    if trialIndices.size == 0:
-                        peths[iUnit, :, iBin] = np.full(nBins, np.nan)
-                        continue
-                
+                    gratingDirection = 'left' if probeMotion_ == -1 else 'right'
+                    saccadeDirection = 'temporal' if saccadeLabel == -1 else 'nasal'
+
+                    # Interpolate the response templates (linearly, like np.interp)
+                    if interp:
+                        fp = responseTemplates[(gratingDirection, saccadeDirection)]
+                        xp = tBinsPadded
+                        x = tBins + probeLatency
+                        i = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, xp.size - 2)
+                        w = (x - xp[i]) / (xp[i + 1] - xp[i])
+                        curve = fp[:, i] * (1 - w) + fp[:, i + 1] * w
+                        curve[:, np.logical_or(x < xp[0], x > xp[-1])] = np.nan
+
                     #
-                    curves = list()
-                    iterable = zip(
-                        gratingMotionDuringProbes[trialIndices],
-                        probeLatencies[trialIndices],
-                        saccadelabelsProximate[trialIndices]
-                    )
-                    for probeMotion_, probeLatency, saccadeLabel in iterable:
-
-                        #
-                        probeDirection = 'left' if probeMotion_ == -1 else 'right'
-                        saccadeDirection = 'temporal' if saccadeLabel == -1 else 'nasal'
-
-                        #
-                        if interp:
-                            fp = responseTemplates[(probeDirection, saccadeDirection)]
-                            xp = tBinsPadded
-                            x = tBins + probeLatency
-                            curve = np.interp(x, xp, fp, left=np.nan, right=np.nan)
-                        
-                        #
-                        else:
-                            saccadeIndices = trialIndicesForUniqueConditions[(probeDirection, saccadeDirection)]
-                            if saccadeIndices is None:
-                                continue
-                            saccadeTimestamps = self.saccadeTimestamps[saccadeIndices, 0] + probeLatency
-                            t, M = psth2(
-                                saccadeTimestamps,
-                                unit.timestamps,
-                                window=responseWindow,
-                                binsize=binsize
-                            )
-                            curve = M.mean(0) / binsize
-
-                        curves.append(curve)
-                    curves = np.array(curves)
-                    peths[iUnit, :, iBin] = np.nanmean(curves, axis=0)
-                    error[iUnit, :, iBin] = np.nanstd(curves, axis=0)
-            
+                    else:
+                        saccadeIndices = trialIndicesForUniqueConditions[(gratingDirection, saccadeDirection)]
+                        if saccadeIndices is None or saccadeIndices.size == 0:
+                            continue
+                        t, M = _computePopulationPeths(
+                            self,
+                            saccadeTimestamps[saccadeIndices] + probeLatency,
+                            responseWindow=responseWindow,
+                            binsize=binsize
+                        )
+                        curve = M.mean(1) / binsize
+
+                    curves.append(curve)
+
+                # N trials x N units x N bins
+                if len(curves) == 0:
+                    continue
+                curves = np.array(curves)
+                peths[:, :, iBin] = np.nanmean(curves, axis=0)
+                error[:, :, iBin] = np.nanstd(curves, axis=0)
+
             #
             self.save(f'{datasetPath}/fr', peths, metadata=metadata)
             self.save(f'{datasetPath}/sd', error, metadata=metadata)
@@ -595,8 +587,17 @@ class TimeHistogramProcessingMixin():
         binsize=0.02,
         protocol='dg',
         overwrite=True,
+        nRunsPerChunk=500,
+        seed=None,
         ):
         """
+        Extract visual-only PETHs for random subsets of the extra-saccadic trials
+
+        The spike counts (N units x N trials x N bins) are computed once and
+        each chunk of runs is represented as a selection matrix (N runs x N
+        trials) such that the resampled PETHs of every unit are computed with
+        a single matrix product. The first run is the PETH for every trial.
+        The seed of the random number generator is saved with the dataset.
         """
 
         #
@@ -608,11 +609,15 @@ class TimeHistogramProcessingMixin():
             returnShape=True,
         )
         nUnits = self.population.count()
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        generator = np.random.default_rng(seed)
 
         #
         metadata = {
             't': tBins,
             'binsize': binsize,
+            'seed': seed,
         }
 
         # Select event data
@@ -623,18 +628,15 @@ class TimeHistogramProcessingMixin():
         probeTimestamps, probeLatencies, gratingMotionDuringProbes, saccadelabelsProximate = probeData
         saccadeTimestamps, saccadeLatencies, saccadelabels, gratingMotionDuringSacccades = saccadeData
 
-        #
+        # Check the number of trials for each motion before any dataset is overwritten
+        trials = dict()
         for probeMotion, probeDirection in zip([-1, 1], ['left', 'right']):
 
             #
             datasetPath = f'peths/rProbe/{protocol}/{probeDirection}'
             if self.hasDataset(datasetPath) and overwrite == False:
                 continue
-            peths = np.full([nUnits, nBins, nRuns + 1], np.nan)
-
-            #
             if self.probeTimestamps is None:
-                self.save(datasetPath, peths, metadata=metadata)
                 continue
 
             # Identify extra-saccadic trials
@@ -650,43 +652,67 @@ class TimeHistogramProcessingMixin():
             nTrials = int(round(trialIndices.size * rTrials))
             if nTrials < minimumTrialCount:
                 nTrials = minimumTrialCount
+            if nTrials > trialIndices.size:
+                raise Exception(f'Not enough extra-saccadic trials to draw samples of {nTrials} trials (motion={probeMotion}, protocol={protocol})')
+            trials[probeMotion] = (trialIndices, nTrials)
+
+        #
+        for probeMotion, probeDirection in zip([-1, 1], ['left', 'right']):
 
             #
-            for iUnit, unit in enumerate(self.population):
+            datasetPath = f'peths/rProbe/{protocol}/{probeDirection}'
+            if self.hasDataset(datasetPath) and overwrite == False:
+                continue
 
-                #
-                t, fr = unit.peth(
-                    probeTimestamps[trialIndices],
-                    responseWindow=responseWindow,
-                    binsize=binsize
+            # Runs are written to the dataset one chunk at a time
+            self.store.invalidate(datasetPath)
+            with self.batch() as stream:
+                if datasetPath in stream:
+                    del stream[datasetPath]
+                dataset = stream.create_dataset(
+                    datasetPath,
+                    shape=(nUnits, nBins, nRuns + 1),
+                    dtype=np.float64,
+                    chunks=(nUnits, nBins, min(nRunsPerChunk, nRuns + 1)) if nUnits != 0 else None,
+                    fillvalue=np.nan,
                 )
-                peths[iUnit, :, 0] = fr
+                for key, value in metadata.items():
+                    dataset.attrs[key] = value
 
-                #
-                if iUnit + 1 == nUnits:
-                    end = None
-                else:
-                    end = '\r'
-                self.log(f'Extracting visual-only PSTHs for unit {iUnit + 1} out of {nUnits} (motion={probeMotion}, protocol={protocol})', end=end)
+            #
+            if self.probeTimestamps is None:
+                continue
+            trialIndices, nTrials = trials[probeMotion]
+
+            # Spike counts (N units x N bins x N trials)
+            t, M = _computePopulationPeths(
+                self,
+                probeTimestamps[trialIndices],
+                responseWindow=responseWindow,
+                binsize=binsize
+            )
+            M = M.transpose(0, 2, 1).astype(np.float64)
 
-                #
-                for iRun in range(nRuns):
+            #
+            with self.batch() as stream:
+                dataset = stream[datasetPath]
+                dataset[:, :, 0] = M.sum(2) / trialIndices.size / binsize
+                for start in range(0, nRuns, nRunsPerChunk):
+                    stop = min(start + nRunsPerChunk, nRuns)
+                    self.log(f'Extracting visual-only PSTHs for runs {start + 1}-{stop} out of {nRuns} (motion={probeMotion}, protocol={protocol})', end=None if stop == nRuns else '\r')
+
+                    # Draw the trials for each run without replacement
+                    nRunsInChunk = stop - start
+                    selected = np.argpartition(
+                        generator.random([nRunsInChunk, trialIndices.size]),
+                        nTrials - 1,
+                        axis=1
+                    )[:, :nTrials]
+                    selection = np.zeros([nRunsInChunk, trialIndices.size])
+                    selection[np.arange(nRunsInChunk)[:, None], selected] = 1
 
                     #
-                    trialIndicesResampled = np.random.choice(
-                        trialIndices,
-                        size=nTrials,
-                        replace=False
-                    )
-
-                    t, fr = unit.peth(
-                        probeTimestamps[trialIndicesResampled],
-                        responseWindow=responseWindow,
-                        binsize=binsize
-                    )
-                    peths[iUnit, :, iRun + 1] = fr
-
-            self.save(datasetPath, peths, metadata=metadata)
+                    dataset[:, :, start + 1: stop + 1] = M @ selection.T / nTrials / binsize
 
         return
 
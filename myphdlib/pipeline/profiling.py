@@ -0,0 +1,333 @@
+import sys
+import json
+import time
+import argparse
+import functools
+import tracemalloc
+import numpy as np
+import pathlib as pl
+from datetime import datetime
+from contextlib import contextmanager
+
+# Profilers attached to sessions (keyed by the id of the session)
+_activeProfilers = dict()
+
+# Original (unwrapped) methods keyed by class and method name
+_originalMethods = dict()
+
+def _collectProcessingSteps(session):
+    """
+    Find the processing steps (private methods of the mixin classes) of a session
+    """
+
+    steps = list()
+    for cls in type(session).__mro__:
+        if cls.__name__ in ('SessionBase', 'object'):
+            continue
+        for name, attr in cls.__dict__.items():
+            if name.startswith('_') == False or name.startswith('__'):
+                continue
+            if callable(attr) == False or isinstance(attr, (staticmethod, classmethod, property)):
+                continue
+            steps.append((cls, name))
+
+    return steps
+
+def _wrapMethod(cls, name):
+    """
+    Replace a method with a wrapper that reports to the profiler of the session (if any)
+    """
+
+    if (cls, name) in _originalMethods:
+        return
+    func = cls.__dict__[name]
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        profiler = _activeProfilers.get(id(self))
+        if profiler is None:
+            return func(self, *args, **kwargs)
+        with profiler.step(name):
+            return func(self, *args, **kwargs)
+
+    _originalMethods[(cls, name)] = func
+    setattr(cls, name, wrapper)
+
+    return
+
+def _unwrapMethods():
+    """
+    Restore the original methods
+    """
+
+    for (cls, name), func in _originalMethods.items():
+        setattr(cls, name, func)
+    _originalMethods.clear()
+
+    return
+
+class SessionProfiler():
+    """
+    Times and memory-profiles each processing step of a session
+
+    Every private method of the mixin classes is timed while the profiler is
+    active. Steps are recorded by their call path (e.g.,
+    _runEventsModule/_decodeBarcodeSignals) along with the number of calls,
+    the elapsed time, the peak memory allocated, and the number of bytes read
+    from and written to the output file. The report is written to a JSON file
+    in the session folder each time the profiler is exited.
+
+    Memory is only traced if traceMemory is True (the peak memory is 0
+    otherwise). Tracing slows down allocation-heavy steps severalfold, so
+    the elapsed time and the peak memory should be measured in separate runs.
+
+    Usage
+    -----
+    with SessionProfiler(session):
+        session._runEventsModule()
+    """
+
+    def __init__(self, session, traceMemory=False, filename='profile.json'):
+        """
+        """
+
+        self._session = session
+        self._traceMemory = traceMemory
+        self._filename = filename
+        self._records = dict()
+        self._stack = list()
+        self._depth = 0
+        self._startedTracing = False
+        self._created = None
+
+        return
+
+    def __enter__(self):
+        """
+        """
+
+        if self._depth == 0:
+            if self._created is None:
+                self._created = datetime.now().isoformat(timespec='seconds')
+            for cls, name in _collectProcessingSteps(self._session):
+                _wrapMethod(cls, name)
+            _activeProfilers[id(self._session)] = self
+            if self._traceMemory and tracemalloc.is_tracing() == False:
+                tracemalloc.start()
+                self._startedTracing = True
+        self._depth += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        """
+
+        self._depth -= 1
+        if self._depth == 0:
+            _activeProfilers.pop(id(self._session), None)
+            if len(_activeProfilers) == 0:
+                _unwrapMethods()
+            if self._startedTracing:
+                tracemalloc.stop()
+                self._startedTracing = False
+            self.save()
+
+        return False
+
+    def _readIOCounters(self):
+        """
+        """
+
+        store = self._session.store
+        return store.bytesRead, store.bytesWritten
+
+    @contextmanager
+    def step(self, name):
+        """
+        Record a single call to a processing step
+        """
+
+        # Keep track of the peak memory of the enclosing step
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(self._stack) != 0:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+
+        #
+        path = '/'.join([frame['name'] for frame in self._stack] + [name])
+        bytesRead, bytesWritten = self._readIOCounters()
+        frame = {
+            'name': name,
+            'start': current,
+            'peak': current,
+        }
+        self._stack.append(frame)
+        t1 = time.perf_counter()
+
+        #
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t1
+            self._stack.pop()
+            if tracing and tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                frame['peak'] = max(frame['peak'], peak)
+                if len(self._stack) != 0:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame['peak'])
+                tracemalloc.reset_peak()
+            bytesRead_, bytesWritten_ = self._readIOCounters()
+
+            #
+            if path not in self._records:
+                self._records[path] = {
+                    'name': name,
+                    'path': path,
+                    'depth': path.count('/'),
+                    'calls': 0,
+                    'elapsed': 0.0,
+                    'peakMemory': 0,
+                    'bytesRead': 0,
+                    'bytesWritten': 0,
+                    'failed': 0,
+                }
+            record = self._records[path]
+            record['calls'] += 1
+            record['elapsed'] += elapsed
+            record['peakMemory'] = max(record['peakMemory'], frame['peak'] - frame['start'])
+            record['bytesRead'] += bytesRead_ - bytesRead
+            record['bytesWritten'] += bytesWritten_ - bytesWritten
+            if sys.exc_info()[0] is not None:
+                record['failed'] += 1
+
+        return
+
+    @property
+    def report(self):
+        """
+        """
+
+        report = {
+            'animal': str(self._session.animal),
+            'date': str(self._session.date),
+            'home': str(self._session.home),
+            'created': self._created,
+            'memoryTraced': self._traceMemory,
+            'steps': list(self._records.values()),
+        }
+
+        return report
+
+    def save(self):
+        """
+        Write the report to the session folder
+        """
+
+        filename = self._session.home.joinpath(self._filename)
+        with open(filename, 'w') as stream:
+            json.dump(self.report, stream, indent=4)
+
+        return filename
+
+def summarizeProfilingReports(
+    reports,
+    depth=None,
+    sortBy='elapsed',
+    verbose=True,
+    ):
+    """
+    Aggregate profiling reports across sessions
+
+    keywords
+    --------
+    reports
+        Paths to report files or folders to search for report files
+    depth
+        Only include steps at this depth of the call path (0 for the
+        _run*Module methods), all steps are included if None
+    sortBy
+        Column used to sort the summary (in descending order)
+    """
+
+    # Collect report files
+    files = list()
+    for report in reports:
+        report = pl.Path(report)
+        if report.is_dir():
+            files.extend(sorted(report.rglob('profile*.json')))
+        elif report.exists():
+            files.append(report)
+
+    # Aggregate by call path
+    summary = dict()
+    for file in files:
+        with open(file, 'r') as stream:
+            report = json.load(stream)
+        for record in report['steps']:
+            if depth is not None and record['depth'] != depth:
+                continue
+            path = record['path']
+            if path not in summary:
+                summary[path] = {
+                    'depth': record['depth'],
+                    'sessions': 0,
+                    'calls': 0,
+                    'elapsed': list(),
+                    'peakMemory': 0,
+                    'bytesRead': 0,
+                    'bytesWritten': 0,
+                    'failed': 0,
+                }
+            entry = summary[path]
+            entry['sessions'] += 1
+            entry['calls'] += record['calls']
+            entry['elapsed'].append(record['elapsed'])
+            entry['peakMemory'] = max(entry['peakMemory'], record['peakMemory'])
+            entry['bytesRead'] += record['bytesRead']
+            entry['bytesWritten'] += record['bytesWritten']
+            entry['failed'] += record['failed']
+
+    #
+    for path, entry in summary.items():
+        elapsed = np.array(entry.pop('elapsed'))
+        entry['elapsed'] = float(elapsed.sum())
+        entry['mean'] = float(elapsed.mean())
+        entry['max'] = float(elapsed.max())
+    paths = sorted(summary.keys(), key=lambda path: summary[path][sortBy], reverse=True)
+    summary = {path: summary[path] for path in paths}
+
+    #
+    if verbose:
+        # Percentages are relative to the total time spent in the top-level steps
+        total = sum([entry['elapsed'] for entry in summary.values() if entry['depth'] == 0])
+        print(f'Summary of {len(files)} profiling report(s)')
+        print(f'{"step":<48}{"sessions":>10}{"calls":>10}{"total (s)":>12}{"mean (s)":>12}{"max (s)":>12}{"%":>8}{"peak (MB)":>12}{"read (MB)":>12}{"write (MB)":>12}')
+        for path, entry in summary.items():
+            fraction = entry['elapsed'] / total * 100 if total != 0 else np.nan
+            print(
+                f'{path:<48}'
+                f'{entry["sessions"]:>10}'
+                f'{entry["calls"]:>10}'
+                f'{entry["elapsed"]:>12.2f}'
+                f'{entry["mean"]:>12.2f}'
+                f'{entry["max"]:>12.2f}'
+                f'{fraction:>8.1f}'
+                f'{entry["peakMemory"] / 1e6:>12.1f}'
+                f'{entry["bytesRead"] / 1e6:>12.1f}'
+                f'{entry["bytesWritten"] / 1e6:>12.1f}'
+            )
+
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize pipeline profiling reports across sessions')
+    parser.add_argument('reports', nargs='+', help='Report files or folders to search for profile*.json files')
+    parser.add_argument('--depth', type=int, default=None, help='Only include steps at this depth (0 for the _run*Module methods)')
+    parser.add_argument('--sort', default='elapsed', help='Column used to sort the summary')
+    args = parser.parse_args()
+    summarizeProfilingReports(args.reports, depth=args.depth, sortBy=args.sort)
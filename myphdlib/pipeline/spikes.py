@@ -3,6 +3,7 @@ import time
 import mat73
 import numpy as np
 from myphdlib.general.toolkit import psth2
+from myphdlib.interface.ephys import SpikeStore, writeSpikeStore, hashSpikeData
 from myphdlib.extensions.matlab import runMatlabScript, locatMatlabAddonsFolder
 from simple_spykes.util.ecephys import run_quality_metrics
 
@@ -37,11 +38,21 @@ class SpikesProcessingMixin(object):
     def _extractSpikeDatasets(
         self,
         sorting='manual',
+        store=False,
         ):
         """
+        Extract the spike timestamps and clusters from the Kilosort output
+
+        If store is True the spikes are also written to a memory-mapped spike
+        store (see myphdlib.interface.ephys.SpikeStore) which the population
+        reads from instead of the output file
         """
 
         if self.hasDataset('spikes/clusters') and self.hasDataset('spikes/timestamps'):
+            spikeStore = SpikeStore(self.home.joinpath('spikes'))
+            checksum = self.store.manifest()['spikes/timestamps']['attrs'].get('checksum')
+            if store and (spikeStore.exists() == False or checksum not in (None, spikeStore.checksum)):
+                self._extractSpikeStore()
             return
         self.log(f'Extracting spike clusters and timestamps', level='info')
 
@@ -66,9 +77,33 @@ class SpikesProcessingMixin(object):
                 3
             )
 
-        #
-        self.save('spikes/timestamps', spikeTimestamps)
+        # The checksum is used to detect spike stores written from other spike data
+        checksum = hashSpikeData(spikeTimestamps, spikeClusters)
+        self.save('spikes/timestamps', spikeTimestamps, metadata={'checksum': checksum})
         self.save('spikes/clusters', spikeClusters)
+        if store:
+            self._extractSpikeStore(spikeTimestamps, spikeClusters)
+        else:
+            SpikeStore(self.home.joinpath('spikes')).invalidate()
+            self._population = None
+
+        return
+
+    def _extractSpikeStore(
+        self,
+        spikeTimestamps=None,
+        spikeClusters=None
+        ):
+        """
+        Write the spike timestamps and clusters to the memory-mapped spike store
+        """
+
+        self.log(f'Writing spike store', level='info')
+        if spikeTimestamps is None or spikeClusters is None:
+            spikeTimestamps = self.load('spikes/timestamps')
+            spikeClusters = self.load('spikes/clusters')
+        writeSpikeStore(self.home.joinpath('spikes'), spikeTimestamps, spikeClusters)
+        self._population = None
 
         return
 
@@ -345,11 +380,12 @@ class SpikesProcessingMixin(object):
     def _runSpikesModule(
         self,
         sorting='manual',
+        store=False,
         ):
         """
         """
 
-        self._extractSpikeDatasets(sorting)
+        self._extractSpikeDatasets(sorting, store)
         self._extractQualityLabels()
         self._measureSpikeSortingQuality(sorting)
 
@@ -15,7 +15,7 @@ class StimuliProcessingMixin():
         self.log('Processing data from the moving bars stimulus')
 
         #
-        M = self.load('labjack/matrix')
+        M = self.load('labjack/matrix', lazy=True)
         start, stop = self.load('epochs/mb')
         signal = M[start: stop, self.labjackChannelMapping['stimulus']]
 
@@ -1,5 +1,5 @@
 import numpy as np
-from myphdlib.general.toolkit import psth2
+from myphdlib.general.toolkit import psth2, psth3
 
 class TuningProcessingMixin(object):
     """
@@ -197,43 +197,48 @@ class TuningProcessingMixin(object):
         nRows, nCols = stimulusFields['on'][0].shape
         values, counts = np.unique(stimulusFields['on'], axis=0, return_counts=True)
         nTrials = counts[0]
+        clusters = np.array([unit.cluster for unit in self.population])
         heatmaps = {
-            'on': list(),
-            'off': list()
+            'on': None,
+            'off': None
         }
-        for unit in self.population:
-            hm = {
-                'on': np.full([nRows, nCols], 0.0),
-                'off': np.full([nRows, nCols], 0.0)
-            }
-            for block in heatmaps.keys():
-                t, M = psth2(
-                    spotTimestamps[block],
-                    unit.timestamps,
-                    window=baselineWindow,
-                    binsize=None
-                )
-                bl = M.flatten() / np.diff(baselineWindow).item()
-                mu, sigma = bl.mean(), bl.std()
-                if sigma == 0:
-                    hm[block] = np.full([nRows, nCols], np.nan)
-                    continue
-                for t, f in zip(spotTimestamps[block], stimulusFields[block]):
-                    t, M = psth2(
-                        np.array([t]),
-                        unit.timestamps,
-                        window=responseWindow,
-                        binsize=None
-                    )
-                    fr = M.flatten().item() / np.diff(responseWindow).item()
-                    z = round((fr - mu) / sigma, 2)
-                    i, j = np.where(f != -1)
-                    hm[block][i, j] += z
-                hm[block] /= nTrials
-            for block in heatmaps.keys():
-                heatmaps[block].append(hm[block])
         for block in heatmaps.keys():
-            heatmaps[block] = np.array(heatmaps[block])
+
+            # Count spikes for every unit and trial in one pass (N units x N trials)
+            t, M = psth3(
+                spotTimestamps[block],
+                self.population.allSpikeTimestamps,
+                self.population.allSpikeClusters,
+                clusters,
+                window=baselineWindow,
+                binsize=None
+            )
+            bl = M[:, :, 0] / np.diff(baselineWindow).item()
+            mu, sigma = bl.mean(1), bl.std(1)
+            t, M = psth3(
+                spotTimestamps[block],
+                self.population.allSpikeTimestamps,
+                self.population.allSpikeClusters,
+                clusters,
+                window=responseWindow,
+                binsize=None
+            )
+            fr = M[:, :, 0] / np.diff(responseWindow).item()
+
+            # Z-score the responses (units without any variance in the baseline are skipped)
+            # NOTE: The z-scores used to be rounded one at a time with round on numpy floats, which is np.around
+            unitMask = sigma != 0
+            z = np.full(fr.shape, 0.0)
+            z[unitMask] = np.around(
+                (fr[unitMask] - mu[unitMask].reshape(-1, 1)) / sigma[unitMask].reshape(-1, 1),
+                2
+            )
+
+            # Project the z-scores onto the stimulus fields (N trials x N pixels)
+            design = np.array(stimulusFields[block] != -1, dtype=float).reshape(spotTimestamps[block].size, nRows * nCols)
+            hm = (z @ design).reshape(clusters.size, nRows, nCols) / nTrials
+            hm[np.invert(unitMask)] = np.nan
+            heatmaps[block] = hm
 
         #
         for block in heatmaps.keys():
@@ -0,0 +1,14 @@
+import pytest
+import numpy as np
+
+ephys = pytest.importorskip('myphdlib.interface.ephys')
+
+def test_spike_store_checksum_matches_unsorted_spike_data(tmp_path):
+    spikeTimestamps = np.array([0.3, 0.1, 0.2, 0.5, 0.4])
+    spikeClusters = np.array([2, 1, 2, 1, 3])
+    folder = tmp_path.joinpath('spikes')
+    ephys.writeSpikeStore(folder, spikeTimestamps, spikeClusters)
+    store = ephys.SpikeStore(folder)
+    assert store.exists()
+    assert store.checksum == ephys.hashSpikeData(spikeTimestamps, spikeClusters)
+    assert np.array_equal(store.allSpikeTimestamps, np.sort(spikeTimestamps))
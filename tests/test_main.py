@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import pathlib as pl
+from multiprocessing import Pool
+
+main = pytest.importorskip('myphdlib.pipeline.main')
+from myphdlib.interface.hdf import FileHandleManager
+
+class FakeSession():
+    """
+    Minimal session which (like the labjack reader) starts its own pool
+    """
+
+    def __init__(self, home, eye='left'):
+        self.home = pl.Path(home)
+        self._eye = eye
+        self._store = None
+        self.date = self.home.name
+        self.animal = 'test'
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = FileHandleManager(self.home.joinpath('output.hdf'))
+        return self._store
+
+    def hasDataset(self, path):
+        return self.store.has(path)
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+    def _runEventsModule(self, redo=False):
+        with Pool(2) as pool:
+            values = pool.map(abs, [-1, -2])
+        self.store.save('labjack/matrix', np.array(values))
+
+    def _runStimuliModule(self):
+        return
+
+    def _runActivityModule(self, zeta=False, redo=False):
+        return
+
+    def _runSpikesModule(self):
+        return
+
+def test_runStage_with_workers_that_start_pools(tmp_path):
+    sessions = list()
+    for i in range(2):
+        home = tmp_path.joinpath(f'session{i}')
+        home.mkdir()
+        sessions.append(FakeSession(home))
+    results = main._runStage(
+        sessions,
+        'pipeline',
+        nWorkers=2,
+        redo=False,
+        zeta=False,
+        profile=False,
+        incremental=False
+    )
+    assert [result['error'] for result in results] == [None, None]
+    assert all([session.hasDataset('labjack/matrix') for session in sessions])